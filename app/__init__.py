@@ -21,7 +21,32 @@ This module contains the microservice code for
 """
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-import ibm_db_sa
+from sqlalchemy import orm
+from app.pool import TimedQueuePool
+from app.routing import RoutingSession
+from app.sharding import ShardQuery
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy with measured connection pools and read replica routing """
+
+    def create_session(self, options):
+        """ Makes sessions that read from a replica during read-only requests """
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        """ Adds the pre-ping and connect timeout, SQLite keeps its own pooling """
+        if info.drivername.startswith('sqlite'):
+            for option in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle'):
+                options.pop(option, None)
+        else:
+            options['poolclass'] = TimedQueuePool
+            options['pool_pre_ping'] = app.config['SQLALCHEMY_POOL_PRE_PING']
+            # ibm_db_sa drops URL options, DB2 reads ConnectTimeout from db2cli.ini
+            if info.drivername.startswith('postgres'):
+                options.setdefault('connect_args', {})['connect_timeout'] = \
+                    app.config['DB_CONNECT_TIMEOUT']
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
 
 # These next lines are positional:
 # 1) We need to create the Flask app
@@ -34,11 +59,15 @@ with app.app_context():
     app.config.from_object('config')
     app.logger.debug('Database URI {}'.format(app.config['SQLALCHEMY_DATABASE_URI']))
 
-# Initialize SQLAlchemy
-db = SQLAlchemy(app)
+# Initialize SQLAlchemy. The driver of the URI (ibm_db_sa, psycopg2, ...) is
+# imported by SQLAlchemy when the engine is first used, no other driver is loaded
+db = PooledSQLAlchemy(app, query_class=ShardQuery)
 
 from app import service, models
 
+# Set up the mappers now, in the master, rather than in the first query of every worker
+orm.configure_mappers()
+
 
 
 
@@ -0,0 +1,128 @@
+"""
+In-process Cache
+
+A bounded LRU cache whose entries also expire after a time to live.
+Entries can be tagged so that all of the entries which depend on a
+record are dropped together when that record is written.
+
+A value read from the database while its record is being written can
+be older than the write. The caller takes generation() before reading
+and hands it to set(), which does not store the value when one of its
+tags was invalidated in the meantime.
+
+Attributes:
+-----------
+hits - lookups answered from the cache
+misses - lookups that were not in the cache or had expired
+evictions - entries dropped to stay within the size limit or after expiring
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ A thread safe LRU cache with a time to live and tag invalidation """
+
+    def __init__(self, maxsize=10000, ttl=30, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()   # key -> (expires, value, tags)
+        self._tags = {}                 # tag -> set of keys
+        self._generation = 0            # bumped by every invalidation
+        self._invalidated = OrderedDict()   # tag -> generation it was last invalidated at
+        self._floor = 0                 # generation of the tags no longer remembered
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Returns the value cached for a key or None """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= self.clock():
+                self._untag(key, entry[2])
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries[key] = entry    # most recently used goes last
+            self.hits += 1
+            return entry[1]
+
+    def generation(self):
+        """ Returns the generation to hand to set() for a value about to be read """
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, tags=(), generation=None):
+        """ Caches a value for a key, tagged with the records it depends on
+
+        With a generation, the value is dropped instead when one of its
+        tags has been invalidated since that generation
+        """
+        with self._lock:
+            if generation is not None and self._stale(tags, generation):
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._untag(key, old[2])
+            tags = frozenset(tags)
+            self._entries[key] = (self.clock() + self.ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                oldest, entry = self._entries.popitem(last=False)
+                self._untag(oldest, entry[2])
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        """ Drops every entry carrying one of the tags """
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                self._invalidated.pop(tag, None)
+                self._invalidated[tag] = self._generation
+                for key in self._tags.pop(tag, ()):
+                    entry = self._entries.pop(key, None)
+                    if entry is not None:
+                        self._untag(key, entry[2])
+            # forget the oldest invalidations, the values read before them are refused
+            while len(self._invalidated) > self.maxsize:
+                self._floor = self._invalidated.popitem(last=False)[1]
+
+    def clear(self):
+        """ Drops every entry """
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._floor = self._generation
+
+    def stats(self):
+        """ Returns the size of the cache and its counters """
+        return {'size': len(self._entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _stale(self, tags, generation):
+        """ Returns True when a tag was invalidated after the generation (lock must be held) """
+        if generation < self._floor:
+            return True
+        return any(self._invalidated.get(tag, 0) > generation for tag in tags)
+
+    def _untag(self, key, tags):
+        """ Removes a key from the index of its tags (lock must be held) """
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
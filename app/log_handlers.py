@@ -0,0 +1,216 @@
+"""
+Log Handlers
+
+Structured, non-blocking logging for the service.
+
+JSONFormatter writes each record as one JSON object per line, with the
+fields passed in extra= next to the message. QueueHandler only puts the
+records in a bounded queue and a thread of its own formats and writes
+them, so a slow log pipe never holds up a request: while the queue is
+full new records are dropped and counted instead. Under gevent the
+writer is still an OS thread, fed through a queue of unpatched locks, as
+a greenlet would only write while the requests wait on I/O. PayloadLogger logs a
+sample of the request payloads with the sensitive fields masked.
+
+Attributes:
+-----------
+REDACTED - what the value of a sensitive field is replaced with
+"""
+import sys
+import json
+import time
+import Queue
+import random
+import logging
+import threading
+from datetime import datetime
+from app.metrics import greenlets
+
+REDACTED = '[REDACTED]'
+
+# the attributes of every LogRecord, anything else came in with extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats a record as a JSON object on one line """
+
+    def format(self, record):
+        entry = {'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'module': record.module,
+                 'message': record.getMessage()}
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, sort_keys=True, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """ The plain text format, followed by the payload of the records that have one """
+
+    def format(self, record):
+        text = super(TextFormatter, self).format(record)
+        if hasattr(record, 'payload'):
+            text = '{} {}'.format(text, json.dumps(record.payload, sort_keys=True, default=str))
+        return text
+
+
+class QueueHandler(logging.Handler):
+    """ Hands the records to a thread that writes them with the target handler """
+
+    def __init__(self, target, size=10000):
+        super(QueueHandler, self).__init__()
+        self.target = target
+        self.dropped = 0
+        if greenlets():
+            self._queue = OSThreadQueue(size)
+            self._thread = OSThread(self._write)
+        else:
+            self._queue = Queue.Queue(size)
+            self._thread = threading.Thread(target=self._write, name='log-writer')
+            self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:   # pylint: disable=broad-except
+            self.handleError(record)
+
+    def prepare(self, record):
+        """ Renders the message now: its arguments may change or need this thread later """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _write(self):
+        """ Writes the queued records until close() """
+        reported = 0
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            if record.levelno >= self.target.level:
+                self.target.handle(record)
+            if self.dropped > reported:
+                self.target.handle(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'Dropped %s log records while the queue was full',
+                    'args': (self.dropped - reported,)}))
+                reported = self.dropped
+
+    def close(self):
+        """ Writes the records still queued, then stops the thread """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(5)
+        self.target.close()
+        super(QueueHandler, self).close()
+
+
+class OSThreadQueue(object):
+    """ A bounded queue from the greenlets to an OS thread, on locks gevent did not patch """
+
+    def __init__(self, size):
+        from gevent._threading import Queue as UnpatchedQueue
+        self.size = size
+        self._queue = UnpatchedQueue()
+
+    def put_nowait(self, item):
+        """ Queues an item or raises Queue.Full """
+        # the greenlets run one at a time, nothing is queued between the check and the put
+        if self._queue.qsize() >= self.size:
+            raise Queue.Full
+        self._queue.put(item)
+
+    def put(self, item):
+        """ Queues an item, even past the size """
+        self._queue.put(item)
+
+    def get(self):
+        """ Waits for the next item """
+        return self._queue.get()
+
+
+class OSThread(object):
+    """ Runs a function in an OS thread while gevent has patched threading.Thread into greenlets """
+
+    def __init__(self, target):
+        from gevent._threading import Lock, start_new_thread
+        self.target = target
+        self._running = Lock()
+        self._start_new_thread = start_new_thread
+
+    def start(self):
+        """ Starts the thread """
+        self._running.acquire()
+        self._start_new_thread(self._run, ())
+
+    def _run(self):
+        try:
+            self.target()
+        finally:
+            self._running.release()
+
+    def is_alive(self):
+        """ Returns True until the function returned """
+        return self._running.locked()
+
+    def join(self, timeout):
+        """ Waits up to timeout seconds for the function to return, without blocking the hub """
+        deadline = time.time() + timeout
+        while self.is_alive() and time.time() < deadline:
+            time.sleep(0.01)
+
+
+class PayloadLogger(object):
+    """ Logs a sample of the payloads with their sensitive fields masked """
+
+    def __init__(self, logger, sample_rate=1.0, redact=(), rand=random.random):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.redact = frozenset(name.lower() for name in redact)
+        self.rand = rand
+
+    def log(self, message, payload):
+        """ Logs a payload at INFO in the payload field, for sample_rate of the calls """
+        if self.sample_rate <= 0 or not self.logger.isEnabledFor(logging.INFO):
+            return
+        if self.sample_rate < 1 and self.rand() >= self.sample_rate:
+            return
+        # the record is made here so it names the caller, not this module
+        caller = sys._getframe(1)   # pylint: disable=protected-access
+        self.logger.handle(self.logger.makeRecord(
+            self.logger.name, logging.INFO, caller.f_code.co_filename, caller.f_lineno, message,
+            None, None, caller.f_code.co_name, {'payload': redact(payload, self.redact)}))
+
+
+def redact(value, fields):
+    """ Returns a copy of a payload with the values of the named fields masked """
+    if isinstance(value, dict):
+        return dict((name, REDACTED if hasattr(name, 'lower') and name.lower() in fields
+                     else redact(item, fields)) for name, item in value.items())
+    if isinstance(value, list):
+        return [redact(item, fields) for item in value]
+    return value
+
+
+def make_handler(stream, json_format=False, queued=False, queue_size=10000,
+                 fmt='[%(asctime)s] %(levelname)s in %(module)s: %(message)s'):
+    """ Returns a handler that writes to a stream, in text or JSON, directly or from a thread """
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JSONFormatter() if json_format else TextFormatter(fmt))
+    if queued:
+        return QueueHandler(handler, queue_size)
+    return handler
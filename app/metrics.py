@@ -0,0 +1,316 @@
+"""
+Request Metrics
+
+Counts the requests of every route by status code, keeps a histogram of
+their latency in fixed buckets and the number of requests in flight.
+
+Recording a request only touches counters of the thread that served it,
+so there is no lock on the way. The counts of a thread that finished are
+folded into a retired total, so threads that come and go do not pile up
+counters. A background thread of every worker
+writes the totals of its threads to a file of its own in METRICS_DIR,
+and /metrics adds up the files of all of the workers. The master folds
+the file of a worker that exits into dead.json, so its counts are kept.
+Without a directory only the current process is reported.
+
+Attributes:
+-----------
+BUCKETS - the upper bounds of the latency buckets in seconds
+"""
+import os
+import sys
+import json
+import time
+import threading
+from bisect import bisect_left
+from timeit import default_timer
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNMATCHED = '<unmatched>'
+ROUTE = 'metrics.route'
+DEAD = 'dead.json'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counters(object):
+    """ The counts of the requests served by one thread """
+
+    def __init__(self):
+        self.requests = {}      # (route, method, status) -> count
+        self.latency = {}       # (route, method) -> counts per bucket, +Inf, then the sum
+        self.in_flight = 0
+
+
+class SharedCounters(object):
+    """ One set of Counters for all greenlets: they only switch while waiting on I/O """
+
+    def __init__(self):
+        self.counters = None
+
+
+class ClosingIterator(object):
+    """ The body of a response, calls back once the server has closed it """
+
+    def __init__(self, body, callback):
+        self.body = body
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.callback()
+
+
+class RequestMetrics(object):
+    """ Latency histograms, status codes and requests in flight per route """
+
+    def __init__(self, directory=None, flush_interval=1.0, buckets=BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._local = SharedCounters() if greenlets() else threading.local()
+        self._threads = {}      # thread ident -> (thread, Counters)
+        self._retired = Counters()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        """ Records every request of a Flask app under the rule it matched """
+        from flask import request
+
+        def remember_route():
+            rule = request.url_rule
+            if rule is not None:
+                request.environ[ROUTE] = rule.rule
+        app.before_request(remember_route)
+        app.wsgi_app = self.wrap(app.wsgi_app)
+
+    def wrap(self, wsgi_app):
+        """ Returns a WSGI app that records every request made to wsgi_app """
+        def instrumented(environ, start_response):
+            counters = self._counters()
+            statuses = []
+
+            def record_status(status, headers, exc_info=None):
+                statuses.append(status)
+                return start_response(status, headers, exc_info)
+
+            def record():
+                seconds = default_timer() - start
+                counters.in_flight -= 1
+                self.observe(environ.get(ROUTE, UNMATCHED), environ['REQUEST_METHOD'],
+                             statuses[0][:3] if statuses else '500', seconds, counters)
+
+            counters.in_flight += 1
+            start = default_timer()
+            try:
+                body = wsgi_app(environ, record_status)
+            except:
+                record()
+                raise
+            # a streamed body is still being answered until the server closes it
+            return ClosingIterator(body, record)
+        return instrumented
+
+    def observe(self, route, method, status, seconds, counters=None):
+        """ Counts one request of a route and the seconds it took """
+        if counters is None:
+            counters = self._counters()
+        key = (route, method, status)
+        counters.requests[key] = counters.requests.get(key, 0) + 1
+        key = (route, method)
+        histogram = counters.latency.get(key)
+        if histogram is None:
+            histogram = counters.latency[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def _counters(self):
+        """ Returns the Counters of the current thread, made on its first request """
+        counters = getattr(self._local, 'counters', None)
+        if counters is None:
+            counters = self._local.counters = Counters()
+            # the greenlets share counters that outlive the one that made them
+            thread = None if isinstance(self._local, SharedCounters) else threading.current_thread()
+            with self._lock:
+                if self._pid != os.getpid():
+                    # the threads of the master are not those of this worker
+                    self._pid = os.getpid()
+                    self._threads = {}
+                    self._retired = Counters()
+                    self._start_flusher()
+                self._retire_finished()
+                self._threads[thread and thread.ident] = (thread, counters)
+        return counters
+
+    def _retire_finished(self):
+        """ Folds the counts of the threads that finished into the retired total (lock must be held) """
+        for ident, (thread, counters) in list(self._threads.items()):
+            if thread is not None and not thread.is_alive():
+                add(self._retired, counters)
+                del self._threads[ident]
+
+    def _start_flusher(self):
+        """ Writes the totals of this process every flush_interval seconds """
+        if not self.directory:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except (IOError, OSError):
+                    pass
+        flusher = threading.Thread(target=run, name='metrics-flusher')
+        flusher.daemon = True
+        flusher.start()
+
+    def snapshot(self):
+        """ Returns the totals of every thread of this process """
+        total = Counters()
+        with self._lock:
+            self._retire_finished()
+            add(total, self._retired)
+            threads = list(self._threads.values())
+        for _, counters in threads:
+            add(total, counters)
+        return {'requests': [list(key) + [count] for key, count in total.requests.items()],
+                'latency': [list(key) + [histogram] for key, histogram in total.latency.items()],
+                'in_flight': total.in_flight}
+
+    def flush(self):
+        """ Writes the totals of this process to its file in the directory """
+        if self.directory and self._pid == os.getpid():
+            write_snapshot(os.path.join(self.directory, '{}.json'.format(self._pid)),
+                           self.snapshot())
+
+    def collect(self):
+        """ Returns the totals of all of the workers """
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            snapshot = read_snapshot(os.path.join(self.directory, name))
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        return merge(snapshots)
+
+    def retire(self, pid):
+        """ Folds the counts of a worker that exited into dead.json (called by the master) """
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, '{}.json'.format(pid))
+        snapshot = read_snapshot(path)
+        if snapshot is None:
+            return
+        dead = read_snapshot(os.path.join(self.directory, DEAD))
+        total = merge([snapshot] + ([dead] if dead is not None else []))
+        total['in_flight'] = 0
+        write_snapshot(os.path.join(self.directory, DEAD), total)
+        os.remove(path)
+
+    def clear(self):
+        """ Removes the files of earlier runs from the directory """
+        if not self.directory:
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.directory, name))
+
+    def render(self):
+        """ Returns the totals of all of the workers in the Prometheus text format """
+        return render(self.collect(), self.buckets)
+
+
+def greenlets():
+    """ Returns True when gevent has made threading.local local to each greenlet """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def add(total, counters):
+    """ Adds the counts of a thread to a total """
+    # list() copies a dict in one step, while its thread goes on counting
+    for key, count in list(counters.requests.items()):
+        total.requests[key] = total.requests.get(key, 0) + count
+    for key, histogram in list(counters.latency.items()):
+        summed = total.latency.setdefault(key, [0] * len(histogram))
+        for index, value in enumerate(list(histogram)):
+            summed[index] += value
+    total.in_flight += counters.in_flight
+
+
+def read_snapshot(path):
+    """ Returns the totals in a file, or None when it is gone or not a snapshot """
+    if not path.endswith('.json'):
+        return None
+    try:
+        with open(path) as snapshot:
+            return json.load(snapshot)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_snapshot(path, snapshot):
+    """ Replaces a file at once so that readers never see half of it """
+    temporary = '{}.tmp'.format(path)
+    with open(temporary, 'w') as output:
+        json.dump(snapshot, output)
+    os.rename(temporary, path)
+
+
+def merge(snapshots):
+    """ Adds up the totals of several processes """
+    requests, latency, in_flight = {}, {}, 0
+    for snapshot in snapshots:
+        for route, method, status, count in snapshot['requests']:
+            key = (route, method, status)
+            requests[key] = requests.get(key, 0) + count
+        for route, method, histogram in snapshot['latency']:
+            total = latency.setdefault((route, method), [0] * len(histogram))
+            for index, value in enumerate(histogram):
+                total[index] += value
+        in_flight += snapshot['in_flight']
+    return {'requests': [list(key) + [count] for key, count in requests.items()],
+            'latency': [list(key) + [histogram] for key, histogram in latency.items()],
+            'in_flight': in_flight}
+
+
+def render(snapshot, buckets=BUCKETS):
+    """ Formats totals as Prometheus metrics """
+    lines = ['# HELP http_requests_total Requests answered by route, method and status code',
+             '# TYPE http_requests_total counter']
+    for route, method, status, count in sorted(snapshot['requests']):
+        lines.append('http_requests_total{{{}}} {}'.format(
+            labels(route=route, method=method, status=status), count))
+    lines += ['# HELP http_request_duration_seconds Seconds taken to answer by route and method',
+              '# TYPE http_request_duration_seconds histogram']
+    bounds = [repr(float(bucket)) for bucket in buckets] + ['+Inf']
+    for route, method, histogram in sorted(snapshot['latency']):
+        cumulative = 0
+        for bound, count in zip(bounds, histogram):
+            cumulative += count
+            lines.append('http_request_duration_seconds_bucket{{{}}} {}'.format(
+                labels(route=route, method=method, le=bound), cumulative))
+        lines.append('http_request_duration_seconds_sum{{{}}} {!r}'.format(
+            labels(route=route, method=method), float(histogram[-1])))
+        lines.append('http_request_duration_seconds_count{{{}}} {}'.format(
+            labels(route=route, method=method), cumulative))
+    lines += ['# HELP http_requests_in_flight Requests being answered',
+              '# TYPE http_requests_in_flight gauge',
+              'http_requests_in_flight {}'.format(snapshot['in_flight'])]
+    return '\n'.join(lines) + '\n'
+
+
+def labels(**values):
+    """ Formats label values, escaped as the text format requires """
+    return ','.join('{}="{}"'.format(name, value.replace('\\', r'\\').replace('"', r'\"')
+                                     .replace('\n', r'\n'))
+                    for name, value in sorted(values.items()))
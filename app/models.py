@@ -7,6 +7,11 @@ All of the models are stored in this module
 Models
 ------
 Payment - A Payment Method used in the Service for making a payment
+PaymentCounter - The number of Payments of every status and method type
+CustomerShard - The customers that were moved away from their hashed shard
+PaymentSequence - The next Payment id when the Payments are sharded
+PaymentShard - The shard each Payment id was handed out for
+IdempotencyKey - The response to a request sent with an Idempotency-Key
 
 
 Attributes:
@@ -16,10 +21,26 @@ Attributes:
 """
 import os
 import json
+import numbers
+import heapq
 import logging
+import itertools
+from datetime import datetime, timedelta
+from collections import Counter
 from . import db
 from enum import Enum
+from sqlalchemy import and_, bindparam, inspect, not_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.orm.exc import StaleDataError
+from flask import has_request_context
+from werkzeug.exceptions import Conflict, NotFound
+from app.cache import LRUCache
 from app.custom_exceptions import DataValidationError
+from app.routing import current_replica, pinned_to_primary
+from app.sharding import PRIMARY, current_shard, fan_out, jump_hash, on_shard
 
 
 class PaymentStatus(Enum):
@@ -34,6 +55,27 @@ class PaymentMethodType(Enum):
    DEBIT = 2
    PAYPAL = 3
 
+class InsertedIds(Executable, ClauseElement):
+    """ A DB2 multi-row INSERT that returns the generated ids in the order of its rows """
+
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+
+
+@compiles(InsertedIds)
+def _compile_inserted_ids(element, compiler, **kw):
+    """ SELECT id FROM FINAL TABLE (INSERT ... VALUES (...), ...) ORDER BY INPUT SEQUENCE """
+    # ibm_db_sa refuses insert().values(rows), so the VALUES are written here
+    names = sorted(element.rows[0])
+    values = ', '.join('({})'.format(', '.join(
+        compiler.process(bindparam(None, row[name], type_=element.table.c[name].type), **kw)
+        for name in names)) for row in element.rows)
+    return 'SELECT {} FROM FINAL TABLE (INSERT INTO {} ({}) VALUES {}) ORDER BY INPUT SEQUENCE' \
+        .format(compiler.preparer.quote('id'), compiler.preparer.format_table(element.table),
+                ', '.join(compiler.preparer.quote(name) for name in names), values)
+
+
 class Payment(db.Model):
     """
     Class that represents a Payment
@@ -43,30 +85,140 @@ class Payment(db.Model):
     """
     logger = logging.getLogger(__name__)
     app = None
+    # Rows fetched per round trip when streaming query results
+    STREAM_BATCH_SIZE = 1000
+    # Bound parameters SQLite before 3.32 takes in one statement
+    SQLITE_MAX_VARIABLES = 999
+    # Optional read-through cache for find and find_by_customer_id
+    cache = None
+    # Keep the PaymentCounter table up to date on every write
+    counters = False
+    # Databases the Payments are spread over by customer_id, empty when not sharded
+    shards = []
+    # Columns a client writes
+    FIELDS = ('customer_id', 'order_id', 'payment_status', 'payment_method_type',
+              'default_payment_type')
+    # Columns that can be searched on and sorted by
+    FILTERS = ('customer_id', 'order_id', 'payment_status', 'payment_method_type',
+               'default_payment_type')
+    SORTS = ('id', 'customer_id', 'order_id')
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, nullable=False)
     order_id = db.Column(db.Integer, nullable=False)
-    payment_status = db.Column(db.Enum(PaymentStatus))
-    payment_method_type = db.Column(db.Enum(PaymentMethodType), nullable=False)
+    payment_status = db.Column(db.Enum(PaymentStatus), index=True)
+    payment_method_type = db.Column(db.Enum(PaymentMethodType), nullable=False, index=True)
     default_payment_type = db.Column(db.Boolean, default=False)
+    # Bumped by every write, the UPDATE of a flush only matches the version it read
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    # The trailing id columns keep keyset pages in index order when
+    # filtering or sorting on customer_id or order_id
+    __table_args__ = (
+        db.Index('ix_payment_customer_id_payment_status', 'customer_id', 'payment_status'),
+        db.Index('ix_payment_customer_id_id', 'customer_id', 'id'),
+        db.Index('ix_payment_order_id_id', 'order_id', 'id'),
+    )
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return '<Payment %r>' % (self.name)
 
-    def save(self):
+    def save(self, idempotency_key=None):
         """
         Saves a Payment to the data store
+        Args:
+            idempotency_key (IdempotencyKey): a new key to store with a new Payment,
+                IntegrityError is raised if another request stored it first
+
+        StaleDataError is raised if the Payment was changed since it was read.
+        A Payment that becomes the default replaces the old default of its
+        customer in the same transaction, IntegrityError is raised if a
+        concurrent write made another one the default meanwhile
         """
+        shard = self._shard()
+        allocated = None
         if not self.id:
+            if shard is not None:
+                self.id = allocated = Payment.allocate_ids([shard])[0]
             db.session.add(self)
-        db.session.commit()
+        stale = self._cache_tags()
+        with on_shard(shard):
+            if Payment.counters:
+                PaymentCounter.add(self._counter_deltas())
+            try:
+                self._replace_default()
+                if idempotency_key is not None:
+                    # the key is inserted before anything is committed, so the
+                    # primary key stops a concurrent duplicate from creating a Payment
+                    db.session.flush()
+                    idempotency_key.remember(self)
+                    db.session.add(idempotency_key)
+                    db.session.flush()
+                db.session.commit()
+            except StaleDataError:
+                # the version we read is gone, so is any cached copy of it
+                db.session.rollback()
+                Payment.invalidate(*stale)
+                raise
+            except Exception:
+                if allocated is not None:
+                    # nothing was stored under the id, the directory must not point at it
+                    db.session.rollback()
+                    Payment.forget_ids([allocated])
+                raise
+        Payment.invalidate(*stale)
+
+    def _replace_default(self):
+        """ Clears the default of the other Payments of the customer when this one becomes it """
+        if not self.default_payment_type or not inspect(self).attrs.default_payment_type.history.added:
+            return
+        table = Payment.__table__
+        others = table.update() \
+                      .where(table.c.customer_id == self.customer_id) \
+                      .where(table.c.default_payment_type)
+        if self.id:
+            others = others.where(table.c.id != self.id)
+        db.session.execute(others.values(default_payment_type=False, version=table.c.version + 1))
 
     def delete(self):
         """ Removes a Payment from the data store """
-        db.session.delete(self)
-        db.session.commit()
+        shard = self._shard()
+        stale = self._cache_tags()
+        with on_shard(shard):
+            if Payment.counters:
+                PaymentCounter.add(self._counter_deltas(deleted=True))
+            db.session.delete(self)
+            db.session.commit()
+        if shard is not None:
+            Payment.forget_ids([self.id])
+        Payment.invalidate(*stale)
+
+    def _shard(self):
+        """ Returns the shard this Payment is written to, None when not sharded """
+        if not Payment.shards:
+            return None
+        shard = Payment.shard_of(self.customer_id)
+        state = inspect(self)
+        if state.key is not None and state.key[2] not in (None, shard):
+            raise DataValidationError('Invalid Payment Data: customer_id cannot move '
+                                      'a Payment to another shard')
+        return shard
+
+    def _counter_deltas(self, deleted=False):
+        """ Returns how saving (or deleting) this Payment changes the counters """
+        deltas = Counter()
+        if self.id:
+            # the stored values, not the ones we may have changed since
+            with db.session.no_autoflush:
+                stored = db.session.query(Payment.payment_status, Payment.payment_method_type) \
+                                   .filter(Payment.id == self.id).first()
+            if stored is not None:
+                deltas[tuple(stored)] -= 1
+        if not deleted:
+            deltas[PaymentCounter.group(self.payment_status, self.payment_method_type)] += 1
+        return deltas
 
     def set_default(self):
         """ Sets a Payment as the default """
@@ -76,6 +228,70 @@ class Payment(db.Model):
         """ Disables the default status for a Payment """
         self.default_payment_type = False
 
+    @staticmethod
+    def set_default_for_customer(payment_id, retries=3):
+        """ Makes a Payment the only default Payment of its customer
+
+        The rows of the customer are locked with SELECT ... FOR UPDATE, so
+        concurrent calls for the same customer take turns, then the old
+        default is cleared and the new one set with two set-based UPDATEs
+        in the same transaction. Where the unique default index exists it
+        backs this up: if a concurrent call still wins the race our write
+        is rejected and we try again.
+
+        Args:
+            payment_id (int): the id of the Payment to make the default
+            retries (int): how many times to retry after losing a race
+        Returns the updated Payment or None if it was not found, raises
+        IntegrityError or Conflict when every retry lost a race
+        """
+        if Payment._unscoped():
+            shard = Payment._locate(payment_id)
+            if shard is None:
+                return None
+            with on_shard(shard):
+                return Payment.set_default_for_customer(payment_id, retries)
+        table = Payment.__table__
+        for attempt in range(retries + 1):
+            customer_id = db.session.query(Payment.customer_id) \
+                                    .filter(Payment.id == payment_id).scalar()
+            if customer_id is None:
+                db.session.rollback()
+                return None
+            locked = db.session.query(Payment.id) \
+                               .filter(Payment.customer_id == customer_id) \
+                               .order_by(Payment.id).with_for_update().all()
+            if (payment_id,) not in locked:
+                # the Payment moved to another customer or was deleted meanwhile
+                db.session.rollback()
+                continue
+            try:
+                db.session.execute(table.update()
+                                   .where(table.c.customer_id == customer_id)
+                                   .where(table.c.default_payment_type)
+                                   .where(table.c.id != payment_id)
+                                   .values(default_payment_type=False,
+                                           version=table.c.version + 1))
+                db.session.execute(table.update()
+                                   .where(table.c.id == payment_id)
+                                   .values(default_payment_type=True,
+                                           version=table.c.version + 1))
+                db.session.commit()
+                Payment.invalidate(Payment._customer_tag(customer_id))
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == retries:
+                    raise
+                Payment.logger.info('Retrying set default for payment_id %s ...', payment_id)
+                continue
+            return Payment.query.get(payment_id)
+        # the Payment kept moving between customers while we locked them
+        raise Conflict('The default of the customer kept changing, try again')
+
+    def etag(self):
+        """ Returns a strong entity tag for the current version of the Payment """
+        return '{}-{}'.format(self.id, self.version)
+
     def serialize(self):
         """ Serializes a Payment into a dictionary """
         return {"id": self.id,
@@ -109,83 +325,1159 @@ class Payment(db.Model):
         return self
 
 
+    def validate(self):
+        """
+        Validates the values of a deserialized Payment before it is stored
+
+        Enum names are converted to their PaymentStatus and PaymentMethodType
+        members so bad values are caught here instead of by the database
+        """
+        for name in Payment.FIELDS:
+            setattr(self, name, Payment.validate_field(name, getattr(self, name)))
+        return self
+
+    @staticmethod
+    def validate_field(name, value):
+        """ Returns the value to store in one of the FIELDS, see validate() """
+        if name in ('customer_id', 'order_id'):
+            if isinstance(value, bool) or not isinstance(value, numbers.Integral):
+                raise DataValidationError('Invalid Payment Data: {} must be an integer'.format(name))
+        elif name in ('payment_status', 'payment_method_type'):
+            enum = PaymentStatus if name == 'payment_status' else PaymentMethodType
+            if isinstance(value, enum) or (value is None and name == 'payment_status'):
+                return value
+            try:
+                return enum[value]
+            except (KeyError, TypeError):
+                raise DataValidationError('Invalid Payment Data: {} must be one of {}'.format(
+                    name, ', '.join(enum.__members__)))
+        elif name == 'default_payment_type':
+            if not isinstance(value, bool):
+                raise DataValidationError('Invalid Payment Data: default_payment_type must be a boolean')
+        else:
+            raise DataValidationError('Invalid Payment Data: unknown field ' + name)
+        return value
+
+    @staticmethod
+    def validate_changes(data):
+        """ Validates a partial Payment document, returns the column values to update """
+        if not isinstance(data, dict) or not data:
+            raise DataValidationError('Invalid Payment Data: body of request contained '
+                                      'bad or no data')
+        return dict((name, Payment.validate_field(name, value)) for name, value in data.items())
+
+    @staticmethod
+    def patch(payment_id, changes, version=None):
+        """
+        Updates some columns of a Payment without loading it first
+
+        On PostgreSQL this is a single UPDATE ... FROM (SELECT ... FOR UPDATE)
+        ... RETURNING that hands back the old and the new row. Elsewhere the
+        old row is locked and read first, then updated.
+
+        Args:
+            payment_id (int): the id of the Payment to update
+            changes (dict): the validated column values, see validate_changes()
+            version (int): only update this version of the Payment (from If-Match)
+        Returns the updated Payment, detached from the session, or None if
+        there is no such Payment (in that version)
+        """
+        if Payment._unscoped():
+            shard = Payment._locate(payment_id)
+            if shard is None:
+                return None
+            if 'customer_id' in changes and Payment.shard_of(changes['customer_id']) != shard:
+                raise DataValidationError('Invalid Payment Data: customer_id cannot move '
+                                          'a Payment to another shard')
+            with on_shard(shard):
+                return Payment.patch(payment_id, changes, version)
+        table = Payment.__table__
+        matches = [table.c.id == payment_id]
+        if version is not None:
+            matches.append(table.c.version == version)
+        values = dict(changes, version=table.c.version + 1)
+        try:
+            if db.session.get_bind().dialect.name == 'postgresql':
+                old = db.select([table.c.id, table.c.customer_id, table.c.payment_status,
+                                 table.c.payment_method_type]) \
+                        .where(and_(*matches)).with_for_update().alias('old')
+                row = db.session.execute(
+                    table.update().where(table.c.id == old.c.id).values(values)
+                    .returning(*(list(table.c) + [old.c.customer_id.label('old_customer_id'),
+                                                  old.c.payment_status.label('old_payment_status'),
+                                                  old.c.payment_method_type.label('old_payment_method_type')]))
+                ).first()
+                if row is None:
+                    db.session.rollback()
+                    return None
+                before = dict((name, row['old_' + name])
+                              for name in ('customer_id', 'payment_status', 'payment_method_type'))
+                after = dict((column.name, row[column.name]) for column in table.c)
+            else:
+                row = db.session.execute(table.select().where(and_(*matches))
+                                         .with_for_update()).first()
+                if row is None:
+                    db.session.rollback()
+                    return None
+                before = dict(row)
+                db.session.execute(table.update().where(table.c.id == payment_id).values(values))
+                after = dict(before, version=before['version'] + 1, **changes)
+            if Payment.counters:
+                deltas = Counter()
+                deltas[PaymentCounter.group(before['payment_status'], before['payment_method_type'])] -= 1
+                deltas[PaymentCounter.group(after['payment_status'], after['payment_method_type'])] += 1
+                PaymentCounter.add(deltas)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Payment.invalidate(('payment', payment_id), Payment._customer_tag(before['customer_id']),
+                           Payment._customer_tag(after['customer_id']))
+        return Payment(**after)
+
+    @staticmethod
+    def create_many(payments, chunk_size=500):
+        """
+        Inserts many Payments in a single transaction
+
+        Each chunk is sent as one multi-row INSERT that reports the
+        generated ids: RETURNING on PostgreSQL, the last rowid on SQLite
+        and SELECT ... FROM FINAL TABLE on DB2, and falls back to one
+        INSERT per row elsewhere. When sharded, the ids are handed out
+        first and every shard inserts its Payments in its own transaction.
+
+        Args:
+            payments (list): the validated Payments to insert
+            chunk_size (int): the number of rows sent per INSERT, capped on
+                SQLite so a chunk stays within its bound parameter limit
+        Returns the generated ids in the order of the Payments
+        """
+        if Payment._unscoped():
+            shards = [Payment.shard_of(payment.customer_id) for payment in payments]
+            by_shard = {}
+            for payment, shard in zip(payments, shards):
+                by_shard.setdefault(shard, []).append(payment)
+            ids = Payment.allocate_ids(shards)
+            for payment, payment_id in zip(payments, ids):
+                payment.id = payment_id
+
+            def insert():
+                chunk = by_shard[current_shard()]
+                try:
+                    return Payment.create_many(chunk, chunk_size)
+                except Exception:
+                    # the shards that did insert keep their Payments and their ids
+                    Payment.forget_ids([payment.id for payment in chunk])
+                    raise
+            Payment._fan_out(insert, shards=sorted(by_shard))
+            return ids
+        table = Payment.__table__
+        dialect = db.session.get_bind().dialect.name
+        assigned = bool(Payment.shards)
+        columns = [column.name for column in table.columns
+                   if column.name != 'version' and (assigned or column.name != 'id')]
+        if dialect == 'sqlite':
+            # every row also binds the default of the version
+            chunk_size = min(chunk_size, Payment.SQLITE_MAX_VARIABLES // (len(columns) + 1))
+        ids = []
+        try:
+            for start in range(0, len(payments), chunk_size):
+                rows = [dict((name, getattr(payment, name)) for name in columns)
+                        for payment in payments[start:start + chunk_size]]
+                if assigned:
+                    db.session.execute(table.insert().values(rows))
+                    ids.extend(row['id'] for row in rows)
+                elif dialect == 'postgresql':
+                    result = db.session.execute(table.insert().values(rows).returning(table.c.id))
+                    ids.extend(row[0] for row in result)
+                elif dialect == 'sqlite':
+                    # rowids of a single statement are handed out consecutively
+                    result = db.session.execute(table.insert().values(rows))
+                    ids.extend(range(result.lastrowid - len(rows) + 1, result.lastrowid + 1))
+                elif dialect == 'ibm_db_sa':
+                    result = db.session.execute(InsertedIds(table, rows))
+                    ids.extend(row[0] for row in result)
+                else:
+                    for row in rows:
+                        result = db.session.execute(table.insert(), row)
+                        ids.append(result.inserted_primary_key[0])
+            if Payment.counters:
+                PaymentCounter.add(Counter(
+                    PaymentCounter.group(payment.payment_status, payment.payment_method_type)
+                    for payment in payments))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Payment.invalidate(*set(Payment._customer_tag(payment.customer_id) for payment in payments))
+        Payment.logger.info('Inserted %s Payments', len(ids))
+        return ids
+
+    @staticmethod
+    def transition_status(from_status, to_status, ids=None, chunk_size=500, **filters):
+        """
+        Moves Payments from one status to another with set-based UPDATEs
+
+        Only Payments still in from_status are changed. Every chunk of
+        chunk_size Payments is updated in its own short transaction.
+
+        Args:
+            from_status (PaymentStatus): the status the Payments must be in
+            to_status (PaymentStatus): the status to move the Payments to
+            ids (list): the ids of the Payments to move, or None to use filters
+            chunk_size (int): the number of Payments updated per transaction
+            filters (dict): column names and the values the Payments must match
+        Returns the number of Payments changed and the list of skipped ids
+        """
+        if Payment._unscoped():
+            results = Payment._fan_out(lambda: Payment.transition_status(
+                from_status, to_status, ids, chunk_size, **filters), filters)
+            updated = sum(result[0] for result in results)
+            if ids is None:
+                return updated, []
+            # skipped on every shard means it was not there or not in from_status
+            skipped = [set(result[1]) for result in results]
+            return updated, [payment_id for payment_id in ids
+                             if all(payment_id in shard_skipped for shard_skipped in skipped)]
+        updated = 0
+        skipped = []
+        if ids is not None:
+            for start in range(0, len(ids), chunk_size):
+                chunk = ids[start:start + chunk_size]
+                changed = set(Payment._transition_chunk(chunk, from_status, to_status))
+                updated += len(changed)
+                skipped.extend(payment_id for payment_id in chunk if payment_id not in changed)
+            return updated, skipped
+
+        after = None
+        while True:
+            query = Payment.query.with_entities(Payment.id).filter_by(**filters) \
+                                 .filter(Payment.payment_status == from_status)
+            chunk = [row[0] for row in Payment.page(query, chunk_size, after)]
+            if not chunk:
+                break
+            updated += len(Payment._transition_chunk(chunk, from_status, to_status))
+            after = chunk[-1]
+        return updated, skipped
+
+    @staticmethod
+    def _transition_chunk(ids, from_status, to_status):
+        """ Moves one chunk of Payments to a new status, returns the changed ids """
+        table = Payment.__table__
+        update = table.update() \
+                      .where(table.c.id.in_(ids)) \
+                      .where(table.c.payment_status == from_status) \
+                      .values(payment_status=to_status, version=table.c.version + 1)
+        try:
+            if db.session.get_bind().dialect.name == 'postgresql':
+                changed = [row[0] for row in db.session.execute(update.returning(table.c.id))]
+            else:
+                changed = [row[0] for row in db.session.query(Payment.id)
+                           .filter(Payment.id.in_(ids), Payment.payment_status == from_status)
+                           .with_for_update()]
+                if changed:
+                    db.session.execute(update.where(table.c.id.in_(changed)))
+            if Payment.counters and changed:
+                deltas = Counter()
+                for method_type, count in db.session.query(Payment.payment_method_type, db.func.count()) \
+                                                    .filter(Payment.id.in_(changed)) \
+                                                    .group_by(Payment.payment_method_type):
+                    deltas[(from_status, method_type)] -= count
+                    deltas[(to_status, method_type)] += count
+                PaymentCounter.add(deltas)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Payment.invalidate(*[('payment', payment_id) for payment_id in changed])
+        return changed
+
+    @staticmethod
+    def delete_by_id(payment_id, version=None):
+        """
+        Deletes a Payment with a single DELETE, without loading it first
+        Args:
+            payment_id (int): the id of the Payment to delete
+            version (int): only delete this version of the Payment (from If-Match)
+        Returns the number of Payments deleted, 0 or 1
+        """
+        if Payment._unscoped():
+            shard = Payment._locate(payment_id)
+            if shard is None:
+                return 0
+            with on_shard(shard):
+                return Payment.delete_by_id(payment_id, version)
+        table = Payment.__table__
+        criterion = table.c.id == payment_id
+        if version is not None:
+            criterion = and_(criterion, table.c.version == version)
+        return Payment._delete_rows(criterion)
+
+    @staticmethod
+    def delete_many(chunk_size=500, **filters):
+        """
+        Deletes the Payments matching the filters with set-based DELETEs
+
+        The ids of the next chunk_size Payments are found with a keyset page
+        on the primary key and every chunk is deleted in its own short
+        transaction, so only one chunk of rows is ever locked.
+
+        Args:
+            chunk_size (int): the number of Payments deleted per transaction
+            filters (dict): column names and the values the Payments must match
+        Returns the number of Payments deleted
+        """
+        if not filters:
+            raise DataValidationError('Invalid Payment filter: deleting needs at least one filter')
+        if Payment._unscoped():
+            return sum(Payment._fan_out(lambda: Payment.delete_many(chunk_size, **filters),
+                                        filters))
+        table = Payment.__table__
+        query = Payment.filtered(**filters)
+        deleted = 0
+        after = None
+        while True:
+            chunk = [row[0] for row in Payment.page(query.with_entities(Payment.id),
+                                                    chunk_size, after)]
+            if not chunk:
+                break
+            # rows changed since the page was read must still match
+            deleted += Payment._delete_rows(and_(table.c.id.in_(chunk), query.whereclause))
+            after = chunk[-1]
+        Payment.logger.info('Deleted %s Payments matching %s', deleted, filters)
+        return deleted
+
+    @staticmethod
+    def _delete_rows(criterion):
+        """ Deletes the Payments matching a criterion in one transaction, returns how many
+
+        The counters, the cache and the shard directory need the id, status,
+        method type and customer of the deleted rows. PostgreSQL returns them
+        from the DELETE, elsewhere the rows are locked and read first, and
+        only when they are needed.
+        """
+        table = Payment.__table__
+        columns = [table.c.id, table.c.customer_id, table.c.payment_status,
+                   table.c.payment_method_type]
+        rows = None
+        try:
+            if db.session.get_bind().dialect.name == 'postgresql':
+                rows = db.session.execute(table.delete().where(criterion).returning(*columns)) \
+                                 .fetchall()
+            elif Payment.counters or Payment.cache is not None or Payment.shards:
+                rows = db.session.execute(db.select(columns).where(criterion)
+                                          .with_for_update()).fetchall()
+                if rows:
+                    db.session.execute(table.delete().where(
+                        table.c.id.in_([row.id for row in rows])))
+            else:
+                deleted = db.session.execute(table.delete().where(criterion)).rowcount
+            if rows is not None:
+                deleted = len(rows)
+                if Payment.counters and rows:
+                    PaymentCounter.add(dict((group, -count) for group, count in Counter(
+                        PaymentCounter.group(row.payment_status, row.payment_method_type)
+                        for row in rows).items()))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if rows and Payment.shards:
+            Payment.forget_ids([row.id for row in rows])
+        if rows:
+            Payment.invalidate(*set([('payment', row.id) for row in rows] +
+                                    [Payment._customer_tag(row.customer_id) for row in rows]))
+        return deleted
+
     @staticmethod
     def init_db():
         """ Initializes the database session """
         Payment.logger.info('Initializing database')
         db.create_all()  # make our sqlalchemy tables
+        if Payment.shards:
+            for shard in Payment.shards:
+                db.metadata.create_all(db.get_engine(bind=shard), tables=Payment._shard_tables())
+            if PaymentSequence.query.first() is None:
+                highest = Payment._fan_out(lambda: db.session.query(db.func.max(Payment.id)).scalar())
+                db.session.add(PaymentSequence(next_id=max(value or 0 for value in highest) + 1))
+                db.session.commit()
 
     @staticmethod
     def remove_all():
         """ Removes all Payments from the database """
         db.drop_all()    # clean up the last tests
         db.create_all()  # create new tables
+        if Payment.shards:
+            for shard in Payment.shards:
+                engine = db.get_engine(bind=shard)
+                db.metadata.drop_all(engine, tables=Payment._shard_tables())
+                db.metadata.create_all(engine, tables=Payment._shard_tables())
+            Payment.init_db()
+        if Payment.cache is not None:
+            Payment.cache.clear()
+        if Payment.counters:
+            Payment._fan_out(PaymentCounter.rebuild)
+
+    @staticmethod
+    def init_counters():
+        """ Keeps the PaymentCounter table up to date, counting the Payments if it is empty """
+        Payment.logger.info('Maintaining Payment counters')
+        Payment.counters = True
+        def rebuild_if_empty():
+            if PaymentCounter.query.first() is None:
+                PaymentCounter.rebuild()
+        Payment._fan_out(rebuild_if_empty)
 
     @staticmethod
-    def all():
+    def init_shards(shards):
+        """ Spreads the Payments over several databases by customer_id
+        Args:
+            shards (list): the SQLALCHEMY_BINDS of the shards, in a fixed order
+        """
+        Payment.logger.info('Sharding Payments over %s', ', '.join(shards))
+        Payment.shards = list(shards)
+
+    @staticmethod
+    def shard_of(customer_id):
+        """ Returns the shard a customer lives on, None when not sharded """
+        if not Payment.shards:
+            return None
+        try:
+            customer_id = int(customer_id)
+        except (TypeError, ValueError):
+            raise DataValidationError('Invalid Payment Data: customer_id must be an integer')
+        with db.session.no_autoflush:
+            shard = db.session.query(CustomerShard.shard) \
+                              .filter(CustomerShard.customer_id == customer_id).scalar()
+        return shard or Payment.shards[jump_hash(customer_id, len(Payment.shards))]
+
+    @staticmethod
+    def allocate_ids(shards):
+        """ Hands out Payment ids that are unique across the shards
+        Args:
+            shards (list): the shard of each new Payment, recorded in the
+                PaymentShard directory so the id is found without asking every shard
+        Returns one id per shard
+        """
+        table = PaymentSequence.__table__
+        count = len(shards)
+        with db.engine.begin() as connection:
+            connection.execute(table.update().values(next_id=table.c.next_id + count))
+            next_id = connection.execute(db.select([table.c.next_id])).scalar()
+            ids = list(range(next_id - count, next_id))
+            connection.execute(PaymentShard.__table__.insert(),
+                               [dict(payment_id=payment_id, shard=shard)
+                                for payment_id, shard in zip(ids, shards)])
+        return ids
+
+    @staticmethod
+    def forget_ids(ids, chunk_size=500):
+        """ Removes Payment ids from the PaymentShard directory
+        Args:
+            ids (list): the ids of Payments that were deleted or never inserted
+            chunk_size (int): the number of ids removed per DELETE
+        """
+        directory = PaymentShard.__table__
+        with db.engine.begin() as connection:
+            for start in range(0, len(ids), chunk_size):
+                connection.execute(directory.delete().where(
+                    directory.c.payment_id.in_(ids[start:start + chunk_size])))
+
+    @staticmethod
+    def move_customer(customer_id, shard):
+        """
+        Moves the Payments of a customer to another shard
+
+        The Payments are copied to the new shard, the directory is pointed
+        at it, the Payments written in the meantime are copied too and
+        then all of them are deleted from the old shard. Writes that are
+        still in flight on the old shard at that point are lost, so move
+        customers while they are quiet.
+
+        Args:
+            customer_id (int): the customer to move
+            shard (str): the shard to move it to
+        Returns the number of Payments moved
+        """
+        if shard not in Payment.shards:
+            raise DataValidationError('Unknown shard: {}'.format(shard))
+        customer_id = int(customer_id)
+        source = Payment.shard_of(customer_id)
+        if source == shard:
+            return 0
+        Payment.logger.info('Moving customer %s from %s to %s', customer_id, source, shard)
+        Payment._copy_customer(customer_id, source, shard)
+        entry = CustomerShard.query.get(customer_id)
+        if shard == Payment.shards[jump_hash(customer_id, len(Payment.shards))]:
+            if entry is not None:
+                db.session.delete(entry)
+        elif entry is not None:
+            entry.shard = shard
+        else:
+            db.session.add(CustomerShard(customer_id=customer_id, shard=shard))
+        db.session.commit()
+        Payment._copy_customer(customer_id, source, shard)
+        table = Payment.__table__
+        with on_shard(source):
+            rows = db.session.execute(table.select().where(table.c.customer_id == customer_id)).fetchall()
+            db.session.commit()
+        # the ids are looked up on the new shard before they leave the old one
+        directory = PaymentShard.__table__
+        for start in range(0, len(rows), 500):
+            db.session.execute(directory.update()
+                               .where(directory.c.payment_id.in_([row.id for row in rows[start:start + 500]]))
+                               .values(shard=shard))
+        db.session.commit()
+        with on_shard(source):
+            db.session.execute(table.delete().where(table.c.customer_id == customer_id))
+            if Payment.counters:
+                moved = Counter((row.payment_status, row.payment_method_type) for row in rows)
+                PaymentCounter.add(dict((group, -count) for group, count in moved.items()))
+            db.session.commit()
+        Payment.invalidate(Payment._customer_tag(customer_id),
+                           *[('payment', row.id) for row in rows])
+        return len(rows)
+
+    @staticmethod
+    def _copy_customer(customer_id, source, target):
+        """ Copies the Payments of a customer that the target shard does not have yet """
+        table = Payment.__table__
+        with on_shard(source):
+            rows = [dict(row) for row in db.session.execute(
+                table.select().where(table.c.customer_id == customer_id))]
+            db.session.commit()
+        with on_shard(target):
+            present = set(row[0] for row in db.session.execute(
+                db.select([table.c.id]).where(table.c.customer_id == customer_id)))
+            rows = [row for row in rows if row['id'] not in present]
+            if rows:
+                db.session.execute(table.insert().values(rows))
+                if Payment.counters:
+                    PaymentCounter.add(Counter((row['payment_status'], row['payment_method_type'])
+                                               for row in rows))
+            db.session.commit()
+        return len(rows)
+
+    @staticmethod
+    def rebalance(tolerance=0.1, dry_run=False):
+        """
+        Moves customers from the fullest to the emptiest shards
+
+        The largest customer that narrows the gap between the two is moved
+        until no shard holds more than tolerance above the average.
+
+        Args:
+            tolerance (float): the allowed excess over the average, as a fraction
+            dry_run (bool): only plan the moves
+        Returns the (customer_id, from shard, to shard, Payments) moves
+        """
+        counts = Payment._fan_out(lambda: dict(
+            db.session.query(Payment.customer_id, db.func.count()).group_by(Payment.customer_id)))
+        customers = dict(zip(Payment.shards, counts))
+        sizes = dict((shard, sum(customers[shard].values())) for shard in Payment.shards)
+        average = sum(sizes.values()) / float(len(Payment.shards))
+        moves = []
+        while True:
+            fullest = max(Payment.shards, key=sizes.get)
+            emptiest = min(Payment.shards, key=sizes.get)
+            gap = sizes[fullest] - sizes[emptiest]
+            if sizes[fullest] <= average * (1 + tolerance):
+                break
+            fitting = [(count, customer_id) for customer_id, count in customers[fullest].items()
+                       if count < gap]
+            if not fitting:
+                break
+            count, customer_id = max(fitting)
+            moves.append((customer_id, fullest, emptiest, count))
+            customers[emptiest][customer_id] = customers[fullest].pop(customer_id)
+            sizes[fullest] -= count
+            sizes[emptiest] += count
+        if not dry_run:
+            for customer_id, _, shard, _ in moves:
+                Payment.move_customer(customer_id, shard)
+        return moves
+
+    @staticmethod
+    def pin_customers(shards):
+        """
+        Keeps every customer on its shard when the list of shards changes
+
+        Run before adding shards: the customers that the new list hashes
+        elsewhere are recorded in the directory under their current shard,
+        and can then be moved with rebalance() once the new shards are live.
+
+        Args:
+            shards (list): the new list of shards
+        Returns the number of customers pinned
+        """
+        found = Payment._fan_out(lambda: [row[0] for row in
+                                          db.session.query(Payment.customer_id).distinct()])
+        pinned = set(entry.customer_id for entry in CustomerShard.query)
+        count = 0
+        for shard, customer_ids in zip(Payment.shards, found):
+            for customer_id in customer_ids:
+                if customer_id not in pinned and \
+                        shards[jump_hash(customer_id, len(shards))] != shard:
+                    db.session.add(CustomerShard(customer_id=customer_id, shard=shard))
+                    count += 1
+        db.session.commit()
+        return count
+
+    @staticmethod
+    def _shard_tables():
+        """ Returns the tables every shard holds """
+        return [Payment.__table__, PaymentCounter.__table__]
+
+    @staticmethod
+    def _unscoped():
+        """ Returns True when the Payments are sharded and no shard was picked yet """
+        return bool(Payment.shards) and current_shard() is None
+
+    @staticmethod
+    def _fan_out(func, filters=None, shards=None):
+        """ Runs func() on the shards that can hold Payments matching the filters
+
+        Returns the results in shard order, just [func()] when not sharded
+        """
+        if not Payment.shards:
+            return [func()]
+        if shards is None:
+            shards = Payment.shards
+            customers = (filters or {}).get('customer_id')
+            if customers is not None:
+                if not isinstance(customers, (list, tuple, set, frozenset)):
+                    customers = [customers]
+                wanted = set(Payment.shard_of(customer_id) for customer_id in customers)
+                shards = [shard for shard in Payment.shards if shard in wanted]
+        return fan_out(func, shards, db.session)
+
+    @staticmethod
+    def _locate(payment_id):
+        """ Returns the shard holding a Payment, None if there is none """
+        shard = db.session.query(PaymentShard.shard) \
+                          .filter(PaymentShard.payment_id == payment_id).scalar()
+        if shard is not None:
+            return shard
+        # Payments older than the directory are looked for on every shard
+        found = Payment._fan_out(lambda: db.session.query(Payment.id)
+                                 .filter(Payment.id == payment_id).scalar() is not None)
+        for shard, present in zip(Payment.shards, found):
+            if present:
+                return shard
+        return None
+
+    @staticmethod
+    def shards_for_identity(ident):
+        """ Returns the shards to look a Payment up on when no shard was picked """
+        if not Payment.shards:
+            return [PRIMARY]
+        shard = Payment._locate(ident[0])
+        return [shard] if shard is not None else []
+
+    @staticmethod
+    def _merge(pages, limit, sort):
+        """ Merges pages that are each in sort order into one page """
+        descending = sort.startswith('-')
+        def key(payment):
+            cursor = payment.cursor(sort)
+            cursor = cursor if isinstance(cursor, tuple) else (cursor,)
+            return tuple(-value for value in cursor) if descending else cursor
+        # cursors end with the id, so two entries never tie
+        merged = heapq.merge(*[[(key(payment), payment) for payment in page] for page in pages])
+        return [payment for _, payment in itertools.islice(merged, limit)]
+
+    @staticmethod
+    def _stream_shards(limit, after, sort, filters):
+        """ Streams Payments from the shards a keyset page at a time """
+        while limit is None or limit > 0:
+            size = Payment.STREAM_BATCH_SIZE if limit is None else min(limit, Payment.STREAM_BATCH_SIZE)
+            page = Payment.search(size, after, False, sort, **filters)
+            for payment in page:
+                yield payment
+            if len(page) < size:
+                return
+            after = page[-1].cursor(sort)
+            if limit is not None:
+                limit -= len(page)
+
+    @staticmethod
+    def statistics(customer_ids=None):
+        """ Returns the number of Payments per status and method type
+        Args:
+            customer_ids (list): count the Payments of these customers, one group each
+
+        Returns (customer_id, payment_status, payment_method_type, count) rows, the
+        customer_id is None for the totals. The totals are read from the
+        PaymentCounter table when it is maintained, otherwise they are grouped in SQL
+        """
+        if Payment._unscoped():
+            totals = Counter()
+            for rows in Payment._fan_out(lambda: Payment.statistics(customer_ids),
+                                         {'customer_id': customer_ids} if customer_ids else None):
+                for customer_id, payment_status, payment_method_type, count in rows:
+                    totals[(customer_id, payment_status, payment_method_type)] += count
+            return [key + (count,) for key, count in totals.items()]
+        if customer_ids is None and Payment.counters:
+            return [(None, counter.payment_status, counter.payment_method_type, counter.count)
+                    for counter in PaymentCounter.query.filter(PaymentCounter.count > 0)]
+        columns = [Payment.payment_status, Payment.payment_method_type]
+        query = Payment.query
+        if customer_ids is not None:
+            columns.insert(0, Payment.customer_id)
+            query = query.filter(Payment.customer_id.in_(customer_ids))
+        rows = query.with_entities(*(columns + [db.func.count()])).group_by(*columns).all()
+        return [tuple(row) if customer_ids is not None else (None,) + tuple(row) for row in rows]
+
+    @staticmethod
+    def init_cache(maxsize=10000, ttl=30):
+        """ Puts a bounded LRU cache with a time to live in front of the lookups """
+        Payment.logger.info('Caching up to %s lookups for %s seconds', maxsize, ttl)
+        Payment.cache = LRUCache(maxsize, ttl)
+
+    @staticmethod
+    def invalidate(*tags):
+        """ Drops the cached lookups that carry any of the tags """
+        if Payment.cache is not None:
+            Payment.cache.invalidate(*tags)
+
+    @staticmethod
+    def _read_through():
+        """ Returns True when the lookups must skip the cache
+
+        A client reading its own writes is not served a copy cached before them
+        """
+        return Payment.cache is None or (has_request_context() and pinned_to_primary())
+
+    @staticmethod
+    def _fills_cache():
+        """ Returns True when a lookup read from the primary, a replica can be behind the writes """
+        return current_replica() is None
+
+    @staticmethod
+    def _customer_tag(customer_id):
+        """ Returns the cache tag shared by all lookups of a customer """
+        try:
+            return ('customer', int(customer_id))
+        except (TypeError, ValueError):
+            return None
+
+    def _cache_tags(self):
+        """ Returns the cache tags of this Payment and of its current and previous customer """
+        if Payment.cache is None:
+            return []
+        history = inspect(self).attrs.customer_id.history
+        customers = set(history.added or ()) | set(history.unchanged or ()) | set(history.deleted or ())
+        tags = [Payment._customer_tag(customer_id) for customer_id in customers]
+        if self.id:
+            tags.append(('payment', self.id))
+        return tags
+
+    def _snapshot(self):
+        """ Returns the column values of a Payment for the cache """
+        return dict((column.name, getattr(self, column.name))
+                    for column in Payment.__table__.columns)
+
+    @staticmethod
+    def _restore(row):
+        """ Attaches a cached Payment to the session without loading it again """
+        payment = Payment(**row)
+        inspect(payment).identity_token = Payment.shard_of(row['customer_id']) or PRIMARY
+        make_transient_to_detached(payment)
+        return db.session.merge(payment, load=False)
+
+    @staticmethod
+    def filtered(**filters):
+        """ Returns a Payment query matching every filter
+        Args:
+            filters (dict): column names and the value (or list of values) they must match
+        """
+        query = Payment.query
+        for name, value in sorted(filters.items()):
+            if name not in Payment.FILTERS:
+                raise DataValidationError('Invalid Payment filter: ' + name)
+            column = getattr(Payment, name)
+            if isinstance(value, (list, tuple, set, frozenset)):
+                query = query.filter(column.in_(list(value)))
+            elif name == 'default_payment_type':
+                # the bare column matches the predicate of the default index
+                query = query.filter(column if value else not_(column))
+            else:
+                query = query.filter(column == value)
+        return query
+
+    @staticmethod
+    def page(query, limit=None, after=None, sort='id'):
+        """ Applies keyset pagination to a Payment query
+        Args:
+            query (Query): the Payment query to paginate
+            limit (int): the maximum number of Payments to return
+            after (int or tuple): the cursor of the last Payment already returned,
+                its id or (sort value, id) when sorting on another column
+            sort (str): one of SORTS, prefixed with '-' for a descending order
+        """
+        name = sort.lstrip('-')
+        if name not in Payment.SORTS:
+            raise DataValidationError('Invalid Payment sort: ' + sort)
+        descending = sort.startswith('-')
+        keys = [Payment.id] if name == 'id' else [getattr(Payment, name), Payment.id]
+        query = query.order_by(*[key.desc() if descending else key for key in keys])
+        if after is not None:
+            values = after if isinstance(after, tuple) else (after,)
+            beyond = (lambda key, value: key < value) if descending else \
+                     (lambda key, value: key > value)
+            if len(keys) == 1:
+                query = query.filter(beyond(keys[0], values[0]))
+            else:
+                query = query.filter(or_(beyond(keys[0], values[0]),
+                                         and_(keys[0] == values[0], beyond(keys[1], values[1]))))
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    def cursor(self, sort='id'):
+        """ Returns the keyset cursor of this Payment for a sort order """
+        name = sort.lstrip('-')
+        return self.id if name == 'id' else (getattr(self, name), self.id)
+
+    @staticmethod
+    def fetch(query, limit=None, after=None, stream=False, sort='id'):
+        """ Runs a paginated Payment query
+        Args:
+            query (Query): the Payment query to run
+            limit (int): the maximum number of Payments to return
+            after (int or tuple): only return Payments beyond this cursor
+            stream (bool): iterate over a server-side cursor instead of a list
+            sort (str): the order of the Payments, see page()
+        """
+        query = Payment.page(query, limit, after, sort)
+        if stream:
+            return query.yield_per(Payment.STREAM_BATCH_SIZE)
+        return query.all()
+
+    @staticmethod
+    def search(limit=None, after=None, stream=False, sort='id', **filters):
+        """ Returns the Payments matching any combination of filters
+        Args:
+            limit (int): the maximum number of Payments to return
+            after (int or tuple): only return Payments beyond this cursor
+            stream (bool): iterate over a server-side cursor instead of a list
+            sort (str): the order of the Payments, see page()
+            filters (dict): column names and the value (or list of values) they must match
+
+        Lookups filtered on customers only are served from the cache. When
+        sharded, every shard that can hold matching Payments returns a page
+        and the pages are merged in sort order.
+        """
+        if Payment._unscoped():
+            if stream:
+                return Payment._stream_shards(limit, after, sort, filters)
+            pages = Payment._fan_out(lambda: Payment.search(limit, after, False, sort, **filters),
+                                     filters)
+            return Payment._merge(pages, limit, sort)
+        Payment.logger.info('Processing payments search for %s ...', filters)
+        query = Payment.filtered(**filters)
+        if Payment._read_through() or stream or list(filters) != ['customer_id']:
+            return Payment.fetch(query, limit, after, stream, sort)
+        customers = filters['customer_id']
+        if not isinstance(customers, (list, tuple, set, frozenset)):
+            customers = [customers]
+        customer_tags = [Payment._customer_tag(customer_id) for customer_id in customers]
+        if None in customer_tags:
+            return Payment.fetch(query, limit, after, stream, sort)
+        key = ('search', tuple(sorted(customer_tags)), sort, limit, after)
+        rows = Payment.cache.get(key)
+        if rows is not None:
+            return [Payment._restore(row) for row in rows]
+        generation = Payment.cache.generation()
+        payments = Payment.fetch(query, limit, after, sort=sort)
+        if Payment._fills_cache():
+            Payment.cache.set(key, tuple(payment._snapshot() for payment in payments),
+                              customer_tags + [('payment', payment.id) for payment in payments],
+                              generation)
+        return payments
+
+    @staticmethod
+    def estimated_count(**filters):
+        """ Returns the (estimated) number of Payments matching the filters
+        Args:
+            filters (dict): column names and the value (or list of values) they must match
+
+        An unfiltered count on PostgreSQL is answered from the planner
+        statistics instead of scanning the whole table
+        """
+        if Payment._unscoped():
+            return sum(Payment._fan_out(lambda: Payment.estimated_count(**filters), filters))
+        if not filters and db.session.get_bind().dialect.name == 'postgresql':
+            estimate = db.session.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE relname = :table",
+                {'table': Payment.__tablename__}).scalar()
+            if estimate is not None and estimate >= 0:
+                return int(estimate)
+        return Payment.filtered(**filters).order_by(None).count()
+
+    @staticmethod
+    def all(limit=None, after=None, stream=False):
         """ Returns all of the Payments in the database """
         Payment.logger.info('Processing all Payments')
-        return Payment.query.all()
+        return Payment.search(limit, after, stream)
 
 
     @staticmethod
-    def find(id):
-        """ Finds a Payment by its ID """
+    def find(id, cached=True):
+        """ Finds a Payment by its ID
+        Args:
+            id (int): the id of the Payment
+            cached (bool): False reads the row itself, as a conditional write
+                must compare against its current version
+        """
         Payment.logger.info('Processing lookup for payment_id %s ...', id)
-        return Payment.query.get(id)
+        if Payment._unscoped():
+            shard = Payment._locate(id)
+            if shard is None:
+                return None
+            with on_shard(shard):
+                return Payment.find(id, cached)
+        if Payment._read_through() or not cached:
+            return Payment.query.get(id)
+        row = Payment.cache.get(('id', id))
+        if row is not None:
+            return Payment._restore(row)
+        generation = Payment.cache.generation()
+        payment = Payment.query.get(id)
+        if payment is not None and Payment._fills_cache():
+            Payment.cache.set(('id', id), payment._snapshot(),
+                              [('payment', payment.id), Payment._customer_tag(payment.customer_id)],
+                              generation)
+        return payment
 
 
     @staticmethod
     def find_or_404(payment_id):
         """ Find a Payment by its id """
         Payment.logger.info('Processing lookup or 404 for payment_id %s ...', payment_id)
+        if Payment._unscoped():
+            payment = Payment.find(payment_id)
+            if payment is None:
+                raise NotFound()
+            return payment
         return Payment.query.get_or_404(payment_id)
 
 
     @staticmethod
-    def find_by_customer_id(customer_id):
+    def find_by_customer_id(customer_id, limit=None, after=None, stream=False):
         """ Returns all Payments for the given customer_id
         Args:
             customer_id (int): the customer_id of the Customer you want to match
         """
-        Payment.logger.info('Processing payments query for %s ...', customer_id)
-        return Payment.query.filter(Payment.customer_id == customer_id).all()
+        return Payment.search(limit, after, stream, customer_id=customer_id)
 
 
     @staticmethod
-    def find_by_order_id(order_id):
+    def find_by_order_id(order_id, limit=None, after=None, stream=False):
         """ Returns Payments for the given order_id
         Args:
             order_id (int): the number of the order_id you want to match
         """
-        Payment.logger.info('Processing order_id query for %s ...', order_id)
-        return Payment.query.filter(Payment.order_id == order_id)
+        return Payment.search(limit, after, stream, order_id=order_id)
 
 
     @staticmethod
-    def find_by_payment_status(payment_status):
+    def find_by_payment_status(payment_status, limit=None, after=None, stream=False):
         """ Returns all of the Payments with the given payment status
         Args:
             payment_status (enum): the payment_status of Payments you want to match
         """
-        Payment.logger.info('Processing payment_status query for %s ...', payment_status)
-        return Payment.query.filter(Payment.payment_status == payment_status).all()
+        return Payment.search(limit, after, stream, payment_status=payment_status)
 
 
     @staticmethod
-    def find_by_payment_method_type(payment_method_type):
+    def find_by_payment_method_type(payment_method_type, limit=None, after=None, stream=False):
         """ Returns all Payments with the given payment method type
         Args:
             payment_method_type (int): the payment_status of Payments you want to match
         """
-        Payment.logger.info('Processing payment_method_type query for %s ...', payment_method_type)
-        return Payment.query.filter(Payment.payment_method_type == payment_method_type).all()
+        return Payment.search(limit, after, stream, payment_method_type=payment_method_type)
 
 
     @staticmethod
-    def get_default_payment_type():
+    def get_default_payment_type(limit=None, after=None, stream=False):
         """ Returns the default payment method type
         Args:
         default_payment_type(): of all Payments which is set to true
         """
-        return Payment.query.filter(Payment.default_payment_type.is_(True)).all()
+        return Payment.search(limit, after, stream, default_payment_type=True)
+
+
+class PaymentCounter(db.Model):
+    """
+    Class that counts the Payments of every status and method type
+
+    The counts are changed in the same transaction as the Payments, so
+    the dashboard statistics never need to scan the payment table
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    payment_status = db.Column(db.Enum(PaymentStatus))
+    payment_method_type = db.Column(db.Enum(PaymentMethodType), nullable=False)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('payment_status', 'payment_method_type'),
+    )
+
+    @staticmethod
+    def group(payment_status, payment_method_type):
+        """ Returns the counter group of a status and method type given as enums or names """
+        if payment_status is not None and not isinstance(payment_status, PaymentStatus):
+            payment_status = PaymentStatus[payment_status]
+        if not isinstance(payment_method_type, PaymentMethodType):
+            payment_method_type = PaymentMethodType[payment_method_type]
+        return (payment_status, payment_method_type)
+
+    @staticmethod
+    def add(deltas):
+        """ Changes the counters in the current transaction
+        Args:
+            deltas (dict): the change of each (payment_status, payment_method_type) group
+        """
+        table = PaymentCounter.__table__
+        for (payment_status, payment_method_type), delta in deltas.items():
+            if not delta:
+                continue
+            if payment_status is None:
+                status_matches = table.c.payment_status.is_(None)
+            else:
+                status_matches = table.c.payment_status == payment_status
+            db.session.execute(table.update()
+                               .where(status_matches)
+                               .where(table.c.payment_method_type == payment_method_type)
+                               .values(count=table.c.count + delta))
+
+    @staticmethod
+    def rebuild():
+        """ Recounts every group from the payment table """
+        Payment.logger.info('Rebuilding the Payment counters')
+        columns = [Payment.payment_status, Payment.payment_method_type]
+        counts = dict(((payment_status, payment_method_type), count)
+                      for payment_status, payment_method_type, count
+                      in db.session.query(*(columns + [db.func.count()])).group_by(*columns))
+        db.session.query(PaymentCounter).delete()
+        # every group gets a row so writes only ever UPDATE them
+        db.session.add_all([PaymentCounter(payment_status=payment_status,
+                                           payment_method_type=payment_method_type,
+                                           count=counts.get((payment_status, payment_method_type), 0))
+                            for payment_status in [None] + list(PaymentStatus)
+                            for payment_method_type in PaymentMethodType])
+        db.session.commit()
+
+
+class CustomerShard(db.Model):
+    """
+    Class that records the customers living on another shard than the
+    one their customer_id hashes to, because they were moved
+    """
+    __table_args__ = {'info': {'unsharded': True}}
+
+    customer_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shard = db.Column(db.String(63), nullable=False)
+
+
+class PaymentSequence(db.Model):
+    """
+    Class that hands out the Payment ids when the Payments are sharded,
+    so an id is unique across all of the shards and survives a move
+    """
+    __table_args__ = {'info': {'unsharded': True}}
+
+    id = db.Column(db.Integer, primary_key=True)
+    next_id = db.Column(db.BigInteger, nullable=False)
+
+
+class PaymentShard(db.Model):
+    """
+    Class that records the shard each Payment id was handed out for, so
+    a Payment is looked up on its own shard instead of on all of them.
+    A move points the ids of the customer at the new shard
+    """
+    __table_args__ = {'info': {'unsharded': True}}
+
+    payment_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    shard = db.Column(db.String(63), nullable=False)
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that remembers the Payment created by a request sent with an
+    Idempotency-Key, so a retry of the request returns the same response
+
+    The key is the primary key: of two concurrent requests with the same
+    key only one INSERT succeeds, the other replays the stored response
+    """
+    __table_args__ = {'info': {'unsharded': True}}
+    # Seconds a key is remembered
+    ttl = 86400
+    # Expired keys are purged on every PURGE_EVERY-th new key
+    PURGE_EVERY = 100
+    _created = itertools.count(1)
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    payment_id = db.Column(db.Integer)
+    response = db.Column(db.Text)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def remember(self, payment):
+        """ Records the Payment created by the request as its response """
+        self.payment_id = payment.id
+        # enums are written the way the other endpoints marshal them, without
+        # converting them on the Payment: it is flushed and would be updated again
+        response = payment.serialize()
+        for name in ('payment_status', 'payment_method_type'):
+            response[name] = Payment.validate_field(name, response[name])
+        self.response = json.dumps(response, default=str)
+
+    @staticmethod
+    def create(key, fingerprint, status_code=201):
+        """ Returns a new key that expires after ttl seconds
+        Args:
+            key (str): the Idempotency-Key header of the request
+            fingerprint (str): a digest of the request body, a retry must send the same body
+            status_code (int): the status of the response to replay
+        """
+        if next(IdempotencyKey._created) % IdempotencyKey.PURGE_EVERY == 0:
+            IdempotencyKey.purge()
+        return IdempotencyKey(key=key, fingerprint=fingerprint, status_code=status_code,
+                              expires_at=datetime.utcnow() + timedelta(seconds=IdempotencyKey.ttl))
+
+    @staticmethod
+    def find(key):
+        """ Returns the stored key, None if it was never used or has expired """
+        record = IdempotencyKey.query.get(key)
+        if record is not None and record.expires_at <= datetime.utcnow():
+            db.session.delete(record)
+            db.session.commit()
+            return None
+        return record
+
+    @staticmethod
+    def purge():
+        """ Deletes the expired keys, returns how many """
+        table = IdempotencyKey.__table__
+        result = db.session.execute(table.delete().where(table.c.expires_at <= datetime.utcnow()))
+        db.session.commit()
+        Payment.logger.info('Purged %s expired idempotency keys', result.rowcount)
+        return result.rowcount
+
+
+# A customer can only have one default Payment. Partial indexes are not
+# portable (DB2 would build a plain unique index on customer_id), so the
+# index is only created on the backends that support the WHERE clause.
+# The predicate matches how each backend renders the default finder filter
+for _dialect, _predicate in (('postgresql', 'default_payment_type'),
+                             ('sqlite', 'default_payment_type = 1')):
+    db.event.listen(
+        Payment.__table__, 'after_create',
+        db.DDL('CREATE UNIQUE INDEX ix_payment_default_customer_id '
+               'ON %(table)s (customer_id) WHERE ' + _predicate)
+        .execute_if(dialect=_dialect)
+    )
@@ -0,0 +1,83 @@
+"""
+Connection Pool
+
+A QueuePool that also measures how long connections are waited for, so
+the pools of the workers can be sized against the connection limit of
+the database with real numbers.
+
+Attributes:
+-----------
+checkouts - connections handed out by the pool
+waits - checkouts that had to wait for a connection to be returned
+wait_time - seconds spent waiting, in total and at most
+timeouts - checkouts that gave up after pool_timeout seconds
+"""
+import time
+import threading
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that counts checkouts, waits and timeouts """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        # no idle connection and no room to open another one: this checkout waits
+        busy = self.checkedin() == 0 and 0 <= self._max_overflow <= self.overflow()
+        start = time.time()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+                self._waited(time.time() - start)
+            raise
+        elapsed = time.time() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            if busy:
+                self._waited(elapsed)
+        return connection
+
+    def _waited(self, elapsed):
+        """ Records a wait (lock must be held) """
+        self.waits += 1
+        self.wait_time += elapsed
+        self.max_wait_time = max(self.max_wait_time, elapsed)
+
+    def stats(self):
+        """ Returns the live state of the pool and its counters """
+        with self._stats_lock:
+            return {'pool': type(self).__name__,
+                    'size': self.size(),
+                    'checked_in': self.checkedin(),
+                    'checked_out': self.checkedout(),
+                    'overflow': max(self.overflow(), 0),
+                    'max_overflow': self._max_overflow,
+                    'timeout': self._timeout,
+                    'recycle': self._recycle,
+                    'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'timeouts': self.timeouts,
+                    'wait_time': round(self.wait_time, 6),
+                    'max_wait_time': round(self.max_wait_time, 6)}
+
+
+def pool_stats(pool):
+    """ Returns the stats of any pool, only its class for pools that do not keep any """
+    if isinstance(pool, TimedQueuePool):
+        return pool.stats()
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_in=pool.checkedin(),
+                     checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0))
+    return stats
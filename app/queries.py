@@ -0,0 +1,136 @@
+"""
+Query Instrumentation
+
+Watches the statements that every engine sends to its database. During
+a request it counts them and adds up the time they take, and when the
+request is over it logs the statements that ran several times in it,
+which usually is a query in a loop (N+1). Statements slower than
+SLOW_QUERY_SECONDS are logged whenever they run, with the types of
+their parameters but never their values.
+
+In debug mode every response carries the totals of its request in the
+X-Query-Count and X-Query-Time (milliseconds) headers.
+
+Statements run by fan_out() on the threads of its pool are not counted
+in the request that started them.
+"""
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from timeit import default_timer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+QUERY_COUNT = 'X-Query-Count'
+QUERY_TIME = 'X-Query-Time'
+
+
+class QueryLog(object):
+    """ The statements run while it records """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def add(self, statement, seconds):
+        """ Counts one statement and the seconds it took """
+        self.count += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        """ Returns the statements run at least threshold times, most often first """
+        return [(statement, count) for statement, count in self.statements.most_common()
+                if count >= threshold]
+
+
+class QueryInstrumentation(object):
+    """ Counts, times and logs the statements of every request """
+
+    def __init__(self, slow_seconds=0.5, repeat_threshold=3, logger=None):
+        self.slow_seconds = slow_seconds
+        self.repeat_threshold = repeat_threshold
+        self.logger = logger or logging.getLogger(__name__)
+        self._local = threading.local()
+
+    def init_app(self, app):
+        """ Listens to every engine and records each request of a Flask app """
+        from flask import g
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        event.listen(Engine, 'handle_error', self._execute_failed)
+
+        def start():
+            g.query_log = QueryLog()
+            self._logs().append(g.query_log)
+
+        def add_headers(response):
+            log = g.get('query_log')
+            if app.debug and log is not None:
+                response.headers[QUERY_COUNT] = str(log.count)
+                response.headers[QUERY_TIME] = '{:.3f}'.format(log.seconds * 1000)
+            return response
+
+        def finish(exception=None):
+            log = g.pop('query_log', None)
+            if log is None:
+                return
+            self._stop(log)
+            for statement, count in log.repeated(self.repeat_threshold):
+                self.logger.warning('Statement run %s times in one request (N+1?): %s',
+                                    count, statement)
+        app.before_request(start)
+        app.after_request(add_headers)
+        app.teardown_request(finish)
+
+    @contextmanager
+    def record(self):
+        """ Records the statements run by the current thread in the block in a QueryLog """
+        log = QueryLog()
+        self._logs().append(log)
+        try:
+            yield log
+        finally:
+            self._stop(log)
+
+    def _logs(self):
+        """ Returns the QueryLogs recording on the current thread """
+        logs = getattr(self._local, 'logs', None)
+        if logs is None:
+            logs = self._local.logs = []
+        return logs
+
+    def _stop(self, log):
+        """ Stops a QueryLog from recording """
+        logs = self._logs()
+        if log in logs:
+            logs.remove(log)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(default_timer())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = default_timer() - conn.info['query_start'].pop()
+        for log in self._logs():
+            log.add(statement, seconds)
+        if seconds >= self.slow_seconds:
+            self.logger.warning('Slow statement (%.3f s) with parameters %s: %s', seconds,
+                                parameter_shape(parameters, executemany), statement)
+
+    def _execute_failed(self, context):
+        # a failed statement has no after_cursor_execute, so its start would stay on the connection
+        starts = context.connection.info.get('query_start') if context.connection else None
+        if starts:
+            starts.pop()
+
+
+def parameter_shape(parameters, executemany=False):
+    """ Describes bound parameters by their types, so that no values are logged """
+    if executemany:
+        return '{} x {}'.format(len(parameters), parameter_shape(parameters[0]) if parameters else '()')
+    if isinstance(parameters, dict):
+        return '{{{}}}'.format(', '.join('{}: {}'.format(name, type(value).__name__)
+                                         for name, value in sorted(parameters.items())))
+    return '({})'.format(', '.join(type(value).__name__ for value in parameters or ()))
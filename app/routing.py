@@ -0,0 +1,81 @@
+"""
+Read Replica Routing
+
+Sends the queries of read-only requests to one of the READ_REPLICAS
+(SQLALCHEMY_BINDS named replica0, replica1 ...). Flushes, write
+requests and everything outside of a request use the primary.
+
+A client that has just written gets a PRIMARY_UNTIL header and cookie
+holding the time until which its reads stay on the primary, so it
+reads its own writes while the replicas catch up.
+"""
+import time
+import itertools
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from app.sharding import PRIMARY, id_chooser, query_chooser, shard_chooser
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PRIMARY_UNTIL = 'X-Primary-Until'
+PRIMARY_UNTIL_COOKIE = 'primary_until'
+
+# Spreads the read requests over the replicas in turn
+_next_replica = itertools.count()
+
+
+class RoutingSession(ShardedSession, SignallingSession):
+    """ A session that reads from a replica during read-only requests
+    and works on the shard of the current thread or of each Payment """
+
+    def __init__(self, db, **options):
+        self._db = db
+        super(RoutingSession, self).__init__(shard_chooser, id_chooser, query_chooser,
+                                             db=db, **options)
+
+    def get_bind(self, mapper=None, clause=None, shard_id=None, instance=None, **kwargs):
+        if shard_id is None:
+            shard_id = self.shard_chooser(mapper, instance, clause=clause)
+        if shard_id != PRIMARY:
+            return self._db.get_engine(self.app, bind=shard_id)
+        if not self._flushing:
+            replica = current_replica()
+            if replica is not None:
+                return self._db.get_engine(self.app, bind=replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def current_replica():
+    """ Returns the bind of the replica this request reads from, or None for the primary """
+    if not has_request_context():
+        return None
+    if 'replica' not in g:
+        replicas = current_app.config['READ_REPLICAS']
+        if replicas and request.method in READ_METHODS and not pinned_to_primary():
+            g.replica = replicas[next(_next_replica) % len(replicas)]
+        else:
+            g.replica = None
+    return g.replica
+
+
+def pinned_to_primary():
+    """ Returns True while the client is reading its own writes """
+    token = request.headers.get(PRIMARY_UNTIL) or request.cookies.get(PRIMARY_UNTIL_COOKIE)
+    if not token:
+        return False
+    try:
+        until = float(token)
+    except ValueError:
+        return False
+    now = time.time()
+    # a token further out than one window was not issued by us
+    return now < until <= now + current_app.config['READ_YOUR_WRITES_SECONDS']
+
+
+def pin_to_primary(response):
+    """ Tells the client to read from the primary for the next READ_YOUR_WRITES_SECONDS """
+    seconds = current_app.config['READ_YOUR_WRITES_SECONDS']
+    token = '{:.3f}'.format(time.time() + seconds)
+    response.headers[PRIMARY_UNTIL] = token
+    response.set_cookie(PRIMARY_UNTIL_COOKIE, token, max_age=seconds, httponly=True)
+    return response
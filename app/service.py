@@ -3,33 +3,74 @@ Payments Microservice API
 
 URLs:
 ------
-GET /payments - Returns a list of all Payments of all customers
+GET /payments - Returns a page of Payments matching the filters (?limit=&after=&sort=)
 GET /payments/{id} - Returns the Payment with a given id number
 POST /payments - creates a new Payment record in database
 PUT /payments/{order_id} - updates a Payment record in database
+PATCH /payments/{id} - updates some fields of a Payment record in database
 DELETE /payments/{id} - deletes a Payment record in database
+DELETE /payments?customer_id= - deletes the Payment records matching the filters
 PUT /payments/{id}/default - sets a Payment as default for the customer
+POST /payments/batch - creates many Payment records in one transaction
+PUT /payments/status - moves many Payments from one status to another
+GET /payments/stats - Returns the number of Payments per status and method type
+GET /metrics - Returns the request counts and latencies of every route (Prometheus text)
 """
 
 
 import os
 import sys
+import json
+import hashlib
 import logging
+import numbers
 import make_enum_json_serializable  # ADDED
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, \
+    stream_with_context
 from flask_api import status    # HTTP Status Codes
 from flask_restplus import Api, Resource, fields
-from werkzeug.exceptions import NotFound, BadRequest
+from werkzeug.exceptions import NotFound, BadRequest, Conflict, PreconditionFailed, \
+    UnprocessableEntity
+from werkzeug.http import quote_etag
 
 # We use SQLAlchemy that supports SQLite, MySQL and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from models import Payment, PaymentMethodType, PaymentStatus, db
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from models import IdempotencyKey, Payment, PaymentMethodType, PaymentStatus, db
+from custom_exceptions import DataValidationError
+from serializers import JSONSerializer
+from pool import pool_stats
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, RequestMetrics
+from queries import QueryInstrumentation
+from log_handlers import PayloadLogger, make_handler
+from routing import READ_METHODS, pin_to_primary
 # Import Flask application
 from . import app
 # Error handlers reuire app to be initialized so we must import
 # then only after we have initialized the Flask app instance
 from . import error_handlers
 
+if app.config['PAYMENT_CACHE_ENABLED']:
+    Payment.init_cache(app.config['PAYMENT_CACHE_SIZE'], app.config['PAYMENT_CACHE_TTL'])
+
+if app.config['SHARDS']:
+    Payment.init_shards(app.config['SHARDS'])
+
+IdempotencyKey.ttl = app.config['IDEMPOTENCY_KEY_TTL']
+
+request_metrics = RequestMetrics(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_SECONDS'])
+request_metrics.init_app(app)
+
+query_stats = QueryInstrumentation(app.config['SLOW_QUERY_SECONDS'],
+                                   app.config['QUERY_REPEAT_THRESHOLD'], app.logger)
+query_stats.init_app(app)
+
+payload_log = PayloadLogger(app.logger, app.config['LOG_PAYLOAD_SAMPLE_RATE'],
+                            app.config['LOG_REDACT_FIELDS'])
+# the handler installed by initialize_logging
+log_handler = None
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -52,6 +93,17 @@ api = Api(app,
           # prefix='/api'
          )
 
+# Media type of the streaming (one Payment per line) listings
+NDJSON = 'application/x-ndjson'
+
+# Header that makes POST /payments safe to retry, and the one marking a replayed response
+IDEMPOTENCY_KEY = 'Idempotency-Key'
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENT_REPLAYED = 'Idempotent-Replayed'
+
+# Times a PUT without If-Match reads the Payment again after losing a race
+UPDATE_RETRIES = 3
+
 # This namespace is the start of the path i.e., /payments
 ns = api.namespace('payments', description='Payment operations')
 
@@ -73,17 +125,89 @@ payment_model = api.model('Payment', {
 
 })
 
+# Writes Payments straight to JSON for the read endpoints
+payment_json = JSONSerializer(payment_model, [PaymentStatus, PaymentMethodType])
+
+batch_result_model = api.model('BatchResult', {
+    'index': fields.Integer(description='The position of the Payment in the batch'),
+    'status': fields.Integer(description='201 if the Payment was created, 400 if it was not valid'),
+    'id': fields.Integer(description='The id assigned to the created Payment'),
+    'message': fields.String(description='Why the Payment was not valid')
+})
+
+transition_model = api.model('StatusTransition', {
+    'from_status': fields.String(required=True,
+                            description='The status the Payments must be in', enum=["UNPAID","PROCESSING","PAID"]),
+    'to_status': fields.String(required=True,
+                            description='The status to move the Payments to', enum=["UNPAID","PROCESSING","PAID"]),
+    'ids': fields.List(fields.Integer,
+                       description='The ids of the Payments to move (instead of the filters)'),
+    'customer_id': fields.Integer(description='Only move the Payments of this Customer'),
+    'order_id': fields.Integer(description='Only move the Payments of this order'),
+    'payment_method_type': fields.String(description='Only move the Payments of this method type',
+                            enum=["CREDIT","DEBIT","PAYPAL"])
+})
+
+# the only fields a status transition may have
+TRANSITION_FIELDS = frozenset(transition_model)
+
+transition_result_model = api.model('StatusTransitionResult', {
+    'updated': fields.Integer(description='The number of Payments moved to the new status'),
+    'skipped': fields.List(fields.Integer,
+                           description='The requested ids that were not in from_status')
+})
+
+delete_result_model = api.model('DeleteResult', {
+    'deleted': fields.Integer(description='The number of Payments deleted')
+})
+
+stats_model = api.model('PaymentStats', {
+    'total': fields.Integer(description='The number of Payments'),
+    'payment_status': fields.Raw(description='The number of Payments per status'),
+    'payment_method_type': fields.Raw(description='The number of Payments per method type')
+})
+
+customer_stats_model = api.inherit('CustomerPaymentStats', stats_model, {
+    'customer_id': fields.Integer(description='The id of the Customer')
+})
+
+stats_result_model = api.inherit('PaymentStatsResult', stats_model, {
+    'customers': fields.List(fields.Nested(customer_stats_model),
+                             description='The counts of each requested Customer')
+})
+
 ######################################################################
 # GET HEALTH
 ######################################################################
 @app.route('/health', methods=['GET'])
 def health():
     """ Return service health """
+    cache = Payment.cache.stats() if Payment.cache is not None else None
     return jsonify(name='Payments REST API Service - Health',
                    status='OK',
+                   cache=cache,
                    url=url_for('health', _external=True)),status.HTTP_200_OK
 
 
+######################################################################
+# GET CONNECTION POOL STATS (internal)
+######################################################################
+@app.route('/internal/pool', methods=['GET'])
+def connection_pool():
+    """ Return the live state of this worker's database connection pool """
+    return jsonify(pool_stats(db.engine.pool)), status.HTTP_200_OK
+
+
+######################################################################
+# GET REQUEST METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """ Return the requests of every route answered by all of the workers """
+    return Response(request_metrics.render(), status=status.HTTP_200_OK,
+                    content_type=METRICS_CONTENT_TYPE)
+
+
 ######################################################################
 #  PATH: /payments/{id}
 ######################################################################
@@ -96,6 +220,7 @@ class PaymentResource(Resource):
     Allows the manipulation of a single Payment
     GET /payment{id} - Returns a payment with the id
     PUT /payment{id} - Update a payment with the id
+    PATCH /payment{id} - Update some fields of a payment with the id
     DELETE /payment{id} -  Deletes a payment with the id
     """
 
@@ -104,7 +229,8 @@ class PaymentResource(Resource):
     #------------------------------------------------------------------
     @ns.doc('get_payments')
     @ns.response(404, 'Payment not found')
-    @ns.marshal_with(payment_model)
+    @ns.response(304, 'The Payment matches the If-None-Match ETag')
+    @ns.response(200, 'Success', payment_model)
     def get(self, payment_id):
         """
         Retrieves a single Payment for the customer
@@ -114,51 +240,115 @@ class PaymentResource(Resource):
         payment = Payment.find(payment_id)
         if not payment:
             raise NotFound("Payment with id '{}' was not found.".format(payment_id))
-        return payment.serialize(), status.HTTP_200_OK
+        etag = payment.etag()
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        return json_response(payment_json.dumps(payment), status.HTTP_200_OK,
+                             {'ETag': quote_etag(etag)})
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING PAYMENT
     #------------------------------------------------------------------
     @ns.doc('update_payments')
+    @ns.header('If-Match', 'Only update the Payment while it still has this ETag')
     @ns.response(404, 'Payment not found')
     @ns.response(400, 'The posted Payment data was not valid')
+    @ns.response(409, 'The default of the customer kept changing')
+    @ns.response(412, 'The Payment no longer matches the If-Match ETag')
     @ns.expect(payment_model)
     @ns.marshal_with(payment_model)
     def put(self, payment_id):
         """
         Update a Payment
         This endpoint will update a Payment resource based on the Payment Info in the body that is posted
+        The UPDATE only matches the version of the Payment that was read, so
+        concurrent writers never overwrite each other without a lock
         """
         app.logger.info('Request to Update a payment with id [%s]', payment_id)
         check_content_type('application/json')
-        payment = Payment.find(payment_id)
-        if not payment:
-            raise NotFound('Payment with id [{}] was not found.'.format(payment_id))
         #data = request.get_json()
         data = api.payload
-        app.logger.info(data)
-        payment.deserialize(data)
-        payment.id = payment_id
+        payload_log.log('Payload', data)
+        for attempt in range(UPDATE_RETRIES + 1):
+            # If-Match is checked against the row, a cached copy may be older
+            payment = Payment.find(payment_id, cached=not request.if_match)
+            if not payment:
+                raise NotFound('Payment with id [{}] was not found.'.format(payment_id))
+            if request.if_match and not request.if_match.contains(payment.etag()):
+                raise PreconditionFailed('Payment with id [{}] was changed, its ETag is now "{}"'
+                                         .format(payment_id, payment.etag()))
+            payment.deserialize(data)
+            payment.id = payment_id
+            try:
+                payment.save()
+            except StaleDataError:
+                # another writer got there between our read and our UPDATE
+                if request.if_match:
+                    raise PreconditionFailed('Payment with id [{}] was changed'.format(payment_id))
+                app.logger.info('Retrying the update of payment with id [%s]', payment_id)
+                continue
+            except IntegrityError:
+                # a concurrent write made another Payment the default
+                db.session.rollback()
+                raise Conflict('The default of the customer kept changing, try again')
+            except:
+                raise BadRequest('The posted data was not valid')
+            return payment.serialize(), status.HTTP_200_OK, {'ETag': quote_etag(payment.etag())}
+        raise Conflict('Payment with id [{}] keeps changing, try again'.format(payment_id))
+
+    #------------------------------------------------------------------
+    # UPDATE SOME FIELDS OF A PAYMENT
+    #------------------------------------------------------------------
+    @ns.doc('patch_payments')
+    @ns.header('If-Match', 'Only update the Payment while it still has this ETag')
+    @ns.response(404, 'Payment not found')
+    @ns.response(400, 'The posted Payment data was not valid')
+    @ns.response(409, 'The customer already has a default Payment')
+    @ns.response(412, 'The Payment no longer matches the If-Match ETag')
+    @ns.response(200, 'Success', payment_model)
+    @ns.expect(payment_model)
+    def patch(self, payment_id):
+        """
+        Update some fields of a Payment
+        This endpoint takes any of the Payment fields and changes only those
+        with a single UPDATE, without reading the Payment first
+        """
+        app.logger.info('Request to Patch a payment with id [%s]', payment_id)
+        check_content_type('application/json')
+        version = if_match_version(payment_id)
         try:
-            payment.save()
-        except:
-            raise BadRequest('The posted data was not valid')
-        return payment.serialize(), status.HTTP_200_OK
+            changes = Payment.validate_changes(api.payload)
+            payment = Payment.patch(payment_id, changes, version)
+        except DataValidationError as error:
+            raise BadRequest(str(error))
+        except IntegrityError:
+            raise Conflict('The customer already has a default Payment, '
+                           'use PUT /payments/{id}/default to replace it')
+        if payment is None:
+            if version is not None and Payment.find(payment_id) is not None:
+                raise PreconditionFailed('Payment with id [{}] was changed'.format(payment_id))
+            raise NotFound('Payment with id [{}] was not found.'.format(payment_id))
+        return json_response(payment_json.dumps(payment), status.HTTP_200_OK,
+                             {'ETag': quote_etag(payment.etag())})
 
     #------------------------------------------------------------------
     # DELETE A PAYMENT
     #------------------------------------------------------------------
     @ns.doc('delete_payments')
+    @ns.header('If-Match', 'Only delete the Payment while it still has this ETag')
     @ns.response(204, 'Payment deleted')
+    @ns.response(412, 'The Payment no longer matches the If-Match ETag')
     def delete(self, payment_id):
         """
         Delete a Payment
         This endpoint will delete a Payment based the id specified in the path
+        with a single DELETE statement
         """
         app.logger.info('Request to Delete a payment with id [%s]', payment_id)
-        payment = Payment.find(payment_id)
-        if payment:
-            payment.delete()
+        version = if_match_version(payment_id)
+        deleted = Payment.delete_by_id(payment_id, version)
+        if not deleted and version is not None and Payment.find(payment_id) is not None:
+            raise PreconditionFailed('Payment with id [{}] was changed'.format(payment_id))
         return '', status.HTTP_204_NO_CONTENT
 
 
@@ -174,37 +364,95 @@ class PaymentCollection(Resource):
     #------------------------------------------------------------------
     @ns.doc('list_payments')
     @ns.param('category', 'List Payments by category')
-    @ns.marshal_list_with(payment_model)
+    @ns.param('customer_id', 'Only list the Payments of these Customers (comma separated)')
+    @ns.param('order_id', 'Only list the Payments of these orders (comma separated)')
+    @ns.param('payment_status', 'Only list the Payments in these statuses (comma separated)')
+    @ns.param('payment_method_type', 'Only list the Payments of these method types (comma separated)')
+    @ns.param('default_payment_type', 'Only list the default (true) or other (false) Payments')
+    @ns.param('sort', 'Order by id, customer_id or order_id, prefix with - to reverse')
+    @ns.param('limit', 'The maximum number of Payments to return (capped by the server)')
+    @ns.param('after', 'Only return Payments beyond this cursor (from X-Next-Cursor)')
+    @ns.param('count', 'Set to true to return the estimated total in X-Total-Count')
+    @ns.response(200, 'Payments (or one Payment per line with Accept: application/x-ndjson)',
+                 [payment_model])
     def get(self):
         """ Returns all of the Payments """
         app.logger.info('Request to list Payments...')
-        payments = []
-        customer_id = request.args.get('customer_id')
-        order_id = request.args.get('order_id')
-        payment_method_type = request.args.get('payment_method_type')
-        payment_status = request.args.get('payment_status')
-        if customer_id:
-            payments = Payment.find_by_customer_id(customer_id)
-        elif order_id:
-            payments = Payment.find_by_order_id(order_id)
-        elif payment_method_type:
-            payments = Payment.find_by_payment_method_type(payment_method_type)
-        elif payment_status:
-            payments = Payment.find_by_payment_status(payment_status)
+        filters = get_filters()
+        sort = request.args.get('sort', 'id')
+        if sort.lstrip('-') not in Payment.SORTS:
+            raise BadRequest('sort must be one of {} (prefixed with - to reverse)'.format(
+                ', '.join(Payment.SORTS)))
+        limit, after = get_page_args(sort)
+        stream = request.accept_mimetypes.best == NDJSON
+        if stream:
+            # streams are unbounded unless the client asks for a limit
+            size = limit if 'limit' in request.args else None
         else:
-            payments = Payment.all()
+            # ask for one extra row to find out if there is a next page
+            size = limit + 1
+        payments = Payment.search(size, after, stream, sort, **filters)
+
+        if stream:
+            return stream_payments(payments)
+
+        total = None
+        if request.args.get('count', '').lower() in ('true', '1'):
+            total = Payment.estimated_count(**filters)
+        etag = collection_etag(payments, total)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
+        headers = {'ETag': quote_etag(etag)}
+        if len(payments) > limit:
+            payments = payments[:limit]
+            cursor = format_cursor(payments[-1].cursor(sort))
+            args = request.args.to_dict()
+            args.update(after=cursor, limit=limit)
+            next_url = api.url_for(PaymentCollection, _external=True, **args)
+            headers['X-Next-Cursor'] = cursor
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        if total is not None:
+            headers['X-Total-Count'] = str(total)
 
         # app.logger.info('[%s] Payments returned', len(payments))
-        results = [payment.serialize() for payment in payments]
-        return results, status.HTTP_200_OK
+        return json_response(payment_json.dumps_list(payments), status.HTTP_200_OK, headers)
+
 
+    #------------------------------------------------------------------
+    # DELETE THE PAYMENTS MATCHING FILTERS
+    #------------------------------------------------------------------
+    @ns.doc('delete_payments_by_filter')
+    @ns.param('customer_id', 'Delete the Payments of these Customers (comma separated)')
+    @ns.param('order_id', 'Delete the Payments of these orders (comma separated)')
+    @ns.param('payment_status', 'Delete the Payments in these statuses (comma separated)')
+    @ns.param('payment_method_type', 'Delete the Payments of these method types (comma separated)')
+    @ns.param('default_payment_type', 'Delete the default (true) or other (false) Payments')
+    @ns.response(400, 'No filter was given')
+    @ns.marshal_with(delete_result_model)
+    def delete(self):
+        """
+        Delete the Payments matching the filters
+        This endpoint deletes every Payment matching all of the filters in
+        chunked set-based DELETEs, one short transaction per chunk
+        """
+        app.logger.info('Request to Delete Payments')
+        filters = get_filters()
+        if not filters:
+            raise BadRequest('Give at least one filter, use DELETE /payments/{id} '
+                             'to delete a single Payment')
+        deleted = Payment.delete_many(app.config['BATCH_CHUNK_SIZE'], **filters)
+        return {'deleted': deleted}, status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # ADD A NEW PAYMENT
     #------------------------------------------------------------------
     @ns.doc('create_payments')
     @ns.expect(payment_model)
+    @ns.header('Idempotency-Key', 'Retries with the same key get the first response back')
     @ns.response(400, 'The posted data was not valid')
+    @ns.response(409, 'The default of the customer kept changing')
+    @ns.response(422, 'The Idempotency-Key was used with another body')
     @ns.response(201, 'Payment created successfully')
     @ns.marshal_with(payment_model, code=201)
     def post(self):
@@ -214,18 +462,173 @@ class PaymentCollection(Resource):
         """
         app.logger.info('Request to Create a Payment')
         check_content_type('application/json')
+        key = request.headers.get(IDEMPOTENCY_KEY)
+        idempotency_key = None
+        if key is not None:
+            fingerprint = payload_fingerprint(api.payload)
+            record = get_idempotency_record(key, fingerprint)
+            if record is not None:
+                return replay(record)
+            idempotency_key = IdempotencyKey.create(key, fingerprint)
         payment = Payment()
-        app.logger.info('Payload = %s', api.payload)
+        payload_log.log('Payload', api.payload)
         payment.deserialize(api.payload)
         try:
-            payment.save()
+            payment.save(idempotency_key)
+        except IntegrityError:
+            db.session.rollback()
+            # a concurrent request with the same key got there first
+            record = key and get_idempotency_record(key, fingerprint)
+            if record is None:
+                # or a concurrent write made another Payment the default
+                raise Conflict('The default of the customer kept changing, try again')
+            return replay(record)
         except:
             raise BadRequest('The posted data was not valid')
         app.logger.info('Payment with new id [%s] saved!', payment.id)
+        if idempotency_key is not None:
+            # answer with the stored response so a replay is identical
+            return json.loads(idempotency_key.response), idempotency_key.status_code, \
+                {'Location': payment_location(payment.id)}
         location_url = api.url_for(PaymentResource, payment_id=payment.id, _external=True)
         return payment.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
 
+######################################################################
+#  PATH: /payments/batch
+######################################################################
+@ns.route('/batch')
+class PaymentBatch(Resource):
+    """ Handles the creation of many Payments at once """
+    #------------------------------------------------------------------
+    # ADD MANY NEW PAYMENTS
+    #------------------------------------------------------------------
+    @ns.doc('create_payments_batch')
+    @ns.expect([payment_model])
+    @ns.response(400, 'Some of the posted Payments were not valid', [batch_result_model])
+    @ns.response(413, 'Too many Payments in one batch')
+    @ns.marshal_list_with(batch_result_model, code=201)
+    def post(self):
+        """
+        Creates many Payments
+        This endpoint takes a JSON array (or application/x-ndjson stream) of
+        Payments, validates all of them and inserts them in one transaction.
+        Nothing is created unless every Payment is valid.
+        """
+        app.logger.info('Request to Create a batch of Payments')
+        items = get_batch_payload()
+        payments = []
+        results = []
+        for index, data in enumerate(items):
+            try:
+                payments.append(Payment().deserialize(data).validate())
+                results.append({'index': index, 'status': status.HTTP_201_CREATED})
+            except DataValidationError as error:
+                results.append({'index': index, 'status': status.HTTP_400_BAD_REQUEST,
+                                'message': str(error)})
+        if len(payments) < len(results):
+            return results, status.HTTP_400_BAD_REQUEST
+        try:
+            ids = Payment.create_many(payments, app.config['BATCH_CHUNK_SIZE'])
+        except Exception:
+            raise BadRequest('The posted data was not valid')
+        for result, payment_id in zip(results, ids):
+            result['id'] = payment_id
+        app.logger.info('Batch of [%s] Payments saved!', len(ids))
+        return results, status.HTTP_201_CREATED
+
+
+######################################################################
+#  PATH: /payments/status
+######################################################################
+@ns.route('/status')
+class PaymentStatusTransition(Resource):
+    """ Moves many Payments from one status to another """
+    @ns.doc('transition_payment_status')
+    @ns.expect(transition_model)
+    @ns.response(400, 'The posted transition was not valid')
+    @ns.marshal_with(transition_result_model)
+    def put(self):
+        """
+        Change the status of many Payments
+        This endpoint moves the Payments given by id (or matching the filters)
+        from one status to another, in chunked set-based UPDATEs. Payments that
+        are no longer in from_status are left alone.
+        """
+        app.logger.info('Request to change the status of Payments')
+        check_content_type('application/json')
+        data = api.payload
+        if not isinstance(data, dict):
+            raise BadRequest('The posted data must be a JSON object')
+        try:
+            from_status = PaymentStatus[data['from_status']]
+            to_status = PaymentStatus[data['to_status']]
+        except (KeyError, TypeError):
+            raise BadRequest('from_status and to_status must be one of {}'.format(
+                ', '.join(PaymentStatus.__members__)))
+        unknown = set(data) - TRANSITION_FIELDS
+        if unknown:
+            raise BadRequest('Unknown fields: {}'.format(', '.join(sorted(unknown))))
+        ids = data.get('ids')
+        if ids is not None and not (isinstance(ids, list) and all(map(is_integer, ids))):
+            raise BadRequest('ids must be a list of integers')
+        filters = dict((name, data[name]) for name in
+                       ('customer_id', 'order_id', 'payment_method_type') if name in data)
+        for name in ('customer_id', 'order_id'):
+            if name in filters and not is_integer(filters[name]):
+                raise BadRequest('{} must be an integer'.format(name))
+        if ids is None and not filters:
+            raise BadRequest('Give ids or at least one filter, '
+                             'a transition never moves every Payment')
+        if 'payment_method_type' in filters:
+            try:
+                filters['payment_method_type'] = PaymentMethodType[filters['payment_method_type']]
+            except (KeyError, TypeError):
+                raise BadRequest('payment_method_type must be one of {}'.format(
+                    ', '.join(PaymentMethodType.__members__)))
+        updated, skipped = Payment.transition_status(from_status, to_status, ids,
+                                                     app.config['BATCH_CHUNK_SIZE'], **filters)
+        app.logger.info('[%s] Payments moved from %s to %s', updated,
+                        from_status.name, to_status.name)
+        return {'updated': updated, 'skipped': skipped}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /payments/stats
+######################################################################
+@ns.route('/stats')
+class PaymentStats(Resource):
+    """ Counts the Payments per status and method type """
+    @ns.doc('get_payment_stats')
+    @ns.param('customer_id', 'Also count the Payments of these Customers (comma separated)')
+    @ns.response(400, 'The customer_id was not valid')
+    @ns.response(200, 'The number of Payments per status and method type', stats_result_model)
+    def get(self):
+        """
+        Returns the number of Payments per status and method type
+        The totals are counted in the database, with a GROUP BY or from the
+        counter table when PAYMENT_STATS_COUNTERS is on. Adding customer_id
+        also returns the counts of each of those Customers.
+        """
+        app.logger.info('Request for Payment statistics')
+        customer_ids = None
+        if request.args.get('customer_id'):
+            try:
+                customer_ids = [int(value) for value in request.args['customer_id'].split(',')]
+            except ValueError:
+                raise BadRequest("Invalid value '{}' for customer_id".format(
+                    request.args['customer_id']))
+        result = summarize_stats(row[1:] for row in Payment.statistics())
+        if customer_ids is not None:
+            rows = Payment.statistics(customer_ids)
+            result['customers'] = []
+            for customer_id in customer_ids:
+                customer = summarize_stats(row[1:] for row in rows if row[0] == customer_id)
+                customer['customer_id'] = customer_id
+                result['customers'].append(customer)
+        return json_response(json.dumps(result), status.HTTP_200_OK)
+
+
 ######################################################################
 #  PATH: /payments/{id}/default
 ######################################################################
@@ -235,24 +638,19 @@ class PaymentsAction(Resource):
     """ Performs actions on a Payment Resource"""
     @ns.doc('set_default_payment')
     @ns.response(404, 'Payment not found')
-    @ns.response(409, 'The Payment resource does not exist')
+    @ns.response(409, 'Concurrent requests changed the default of the customer')
     def put(self, payment_id):
         """
         Set default payment source
         This endpoint will set a Payment source as the default
         """
         app.logger.info('Request to set a Payment as default')
-        payment = Payment.find(payment_id)
+        try:
+            payment = Payment.set_default_for_customer(payment_id)
+        except IntegrityError:
+            raise Conflict('The default of the customer kept changing, try again')
         if not payment:
             raise NotFound("Payment with id '{}' was not found.".format(payment_id))
-
-        allpayments = Payment.find_by_customer_id(payment.customer_id)
-        for p in allpayments:
-            p.unset_default()
-            p.save()
-
-        payment.set_default()
-        payment.save()
         app.logger.info('Payment with id [%s] has been set as default!', payment.id)
         return payment.serialize(), status.HTTP_200_OK
 
@@ -291,11 +689,20 @@ def payments_reset():
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
-@app.before_first_request
 def init_db():
-    """ Initialies the SQLAlchemy app """
-    # global app
+    """ Creates the tables at startup (run.py and the gunicorn master), not in a request """
     Payment.init_db()
+    if app.config['PAYMENT_STATS_COUNTERS']:
+        Payment.init_counters()
+
+
+@app.after_request
+def read_your_writes(response):
+    """ Keeps a client that has written on the primary while the replicas catch up """
+    if app.config['READ_REPLICAS'] and request.method not in READ_METHODS \
+            and response.status_code < 400:
+        pin_to_primary(response)
+    return response
 
 
 def data_reset():
@@ -303,6 +710,190 @@ def data_reset():
     Payment.remove_all()
 
 
+def parse_bool(value):
+    """ Parses a true/false query string value """
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValueError(value)
+
+
+# How the values of each filter of a listing are parsed
+FILTER_PARSERS = {
+    'customer_id': int,
+    'order_id': int,
+    'payment_status': lambda value: PaymentStatus[value],
+    'payment_method_type': lambda value: PaymentMethodType[value],
+    'default_payment_type': parse_bool
+}
+
+
+def get_filters():
+    """ Returns the filters of a listing request, comma separated values become lists """
+    filters = {}
+    for name, parse in FILTER_PARSERS.items():
+        value = request.args.get(name)
+        if not value:
+            continue
+        try:
+            values = [parse(item) for item in value.split(',')]
+        except (KeyError, ValueError):
+            raise BadRequest("Invalid value '{}' for {}".format(value, name))
+        filters[name] = values[0] if len(values) == 1 else values
+    return filters
+
+
+def summarize_stats(rows):
+    """ Adds up (payment_status, payment_method_type, count) rows per status and method type """
+    result = {'total': 0, 'payment_status': {}, 'payment_method_type': {}}
+    for payment_status, payment_method_type, count in rows:
+        status_name = payment_status.name if payment_status is not None else 'NONE'
+        result['total'] += count
+        result['payment_status'][status_name] = \
+            result['payment_status'].get(status_name, 0) + count
+        result['payment_method_type'][payment_method_type.name] = \
+            result['payment_method_type'].get(payment_method_type.name, 0) + count
+    return result
+
+
+def format_cursor(cursor):
+    """ Returns the text of a keyset cursor: the id or 'sort value,id' """
+    if isinstance(cursor, tuple):
+        return ','.join(str(value) for value in cursor)
+    return str(cursor)
+
+
+def get_page_args(sort='id'):
+    """ Returns the bounded limit and the after cursor of a listing request """
+    try:
+        limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+        after = request.args.get('after')
+        if after:
+            values = tuple(int(value) for value in after.split(','))
+            if len(values) != (1 if sort.lstrip('-') == 'id' else 2):
+                raise ValueError(after)
+            after = values[0] if len(values) == 1 else values
+        else:
+            after = None
+    except ValueError:
+        raise BadRequest('limit and after must be integers')
+    if limit < 1:
+        raise BadRequest('limit must be a positive integer')
+    return min(limit, app.config['MAX_PAGE_SIZE']), after
+
+
+def stream_payments(payments):
+    """ Streams Payments to the client as newline delimited JSON """
+    def generate():
+        for payment in payments:
+            yield payment_json.dumps(payment) + '\n'
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+
+def get_batch_payload():
+    """ Returns the Payments posted as a JSON array or as NDJSON """
+    content_type = request.headers.get('Content-Type')
+    if content_type == 'application/json':
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise BadRequest('The posted data must be a JSON array of Payments')
+    elif content_type == NDJSON:
+        items = []
+        for line in request.stream:
+            if not line.strip():
+                continue
+            # stop reading as soon as the batch is too large
+            if len(items) == app.config['MAX_BATCH_SIZE']:
+                abort_batch_too_large()
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                raise BadRequest('The posted data must contain one JSON Payment per line')
+    else:
+        app.logger.error('Invalid Content-Type: %s', content_type)
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+              'Content-Type must be application/json or {}'.format(NDJSON))
+    if len(items) > app.config['MAX_BATCH_SIZE']:
+        abort_batch_too_large()
+    return items
+
+
+def abort_batch_too_large():
+    """ Answers 413 to a batch of more than MAX_BATCH_SIZE Payments """
+    abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+          'A batch holds at most {} Payments'.format(app.config['MAX_BATCH_SIZE']))
+
+
+def if_match_version(payment_id):
+    """ Returns the version of the Payment that If-Match asks for, None for any version """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    # the ETag of a Payment is its id and version, see Payment.etag()
+    prefix = '{}-'.format(payment_id)
+    for etag in request.if_match.as_set():
+        if etag.startswith(prefix) and etag[len(prefix):].isdigit():
+            return int(etag[len(prefix):])
+    raise PreconditionFailed('If-Match does not hold an ETag of Payment with id [{}]'
+                             .format(payment_id))
+
+
+def is_integer(value):
+    """ Returns True for a JSON integer, which true and false are not """
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
+def payload_fingerprint(payload):
+    """ Returns a digest of a JSON body that does not depend on the order of its keys """
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_idempotency_record(key, fingerprint):
+    """ Returns the stored response of an Idempotency-Key, None for a new key """
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise BadRequest('{} must be 1 to {} characters'.format(IDEMPOTENCY_KEY,
+                                                                IDEMPOTENCY_KEY_MAX_LENGTH))
+    record = IdempotencyKey.find(key)
+    if record is not None and record.fingerprint != fingerprint:
+        raise UnprocessableEntity('{} {} was already used with another request body'.format(
+            IDEMPOTENCY_KEY, key))
+    return record
+
+
+def replay(record):
+    """ Returns the stored response of an Idempotency-Key again """
+    app.logger.info('Replaying the response for %s %s', IDEMPOTENCY_KEY, record.key)
+    return json.loads(record.response), record.status_code, \
+        {'Location': payment_location(record.payment_id), IDEMPOTENT_REPLAYED: 'true'}
+
+
+def payment_location(payment_id):
+    """ Returns the URL of a Payment """
+    return api.url_for(PaymentResource, payment_id=payment_id, _external=True)
+
+
+def json_response(body, code, headers=None):
+    """ Makes a response from a body that is already JSON text """
+    return app.response_class(body + '\n', status=code, headers=headers,
+                              mimetype='application/json')
+
+
+def collection_etag(payments, *extra):
+    """ Returns a strong entity tag over the versions of many Payments """
+    digest = hashlib.sha1()
+    for payment in payments:
+        digest.update('{};'.format(payment.etag()).encode('utf-8'))
+    digest.update(repr(extra).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def not_modified(etag):
+    """ Answers a conditional GET whose ETag still matches without a body """
+    response = make_response('', status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers['Content-Type'] == content_type:
@@ -313,20 +904,24 @@ def check_content_type(content_type):
 
 def initialize_logging(log_level=logging.INFO):
     """ Initialized the default logging to STDOUT """
+    global log_handler
     if not app.debug:
         print 'Setting up logging...'
-        # Set up default logging for submodules to use STDOUT
-        # datefmt='%m/%d/%Y %I:%M:%S %p'
-        fmt = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
-        logging.basicConfig(stream=sys.stdout, level=log_level, format=fmt)
-        # Make a new log handler that uses STDOUT
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setFormatter(logging.Formatter(fmt))
+        # One handler on the root logger writes the records of the app and of the
+        # submodules to STDOUT, as text or JSON, from a thread of its own with LOG_QUEUE
+        handler = make_handler(sys.stdout, app.config['LOG_FORMAT'] == 'json',
+                               app.config['LOG_QUEUE'], app.config['LOG_QUEUE_SIZE'])
         handler.setLevel(log_level)
-        # Remove the Flask default handlers and use our own
+        root = logging.getLogger()
+        if log_handler is not None:
+            root.removeHandler(log_handler)
+            log_handler.close()
+        root.addHandler(handler)
+        root.setLevel(log_level)
+        log_handler = handler
+        # Remove the Flask default handlers, the app logs through the root logger
         handler_list = list(app.logger.handlers)
-        for log_handler in handler_list:
-            app.logger.removeHandler(log_handler)
-        app.logger.addHandler(handler)
+        for flask_handler in handler_list:
+            app.logger.removeHandler(flask_handler)
         app.logger.setLevel(log_level)
         app.logger.info('Logging handler established')
@@ -0,0 +1,137 @@
+"""
+Customer Sharding
+
+Spreads the Payments over several databases by customer_id. Every
+customer lives on one shard: the one its id hashes to with a jump
+consistent hash, unless the customer_shard directory says otherwise
+because it was moved.
+
+The session is a SQLAlchemy ShardedSession whose shard_chooser,
+id_chooser and query_chooser below pick the shard. Work on one shard runs
+inside on_shard(). The session then sends its statements there, and the
+Payments it loads remember their shard in their identity, so refreshing
+them later goes back to the same database. Everything else, including the
+Payments when they are not sharded, is on the PRIMARY shard id. A model
+can say where one of its rows lives with a shards_for_identity(ident)
+staticmethod, used to look it up outside of on_shard(). fan_out() runs a
+function on several shards at once, each in a thread with a session of
+its own.
+
+Tables marked with info={'unsharded': True} always stay on the primary.
+
+Attributes:
+-----------
+PRIMARY - the shard id of the primary database (or of its read replicas)
+"""
+import os
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import inspect
+from sqlalchemy.ext.horizontal_shard import ShardedQuery
+
+PRIMARY = 'primary'
+
+_local = threading.local()
+_pools = {}
+
+
+def current_shard():
+    """ Returns the shard the current thread works on, or None """
+    return getattr(_local, 'shard', None)
+
+
+@contextmanager
+def on_shard(shard):
+    """ Sends the statements of the current thread to a shard (None for the primary) """
+    previous = current_shard()
+    _local.shard = shard
+    try:
+        yield
+    finally:
+        _local.shard = previous
+
+
+def is_sharded(mapper):
+    """ Returns False for the models that always stay on the primary """
+    return mapper is None or not mapper.mapped_table.info.get('unsharded')
+
+
+def jump_hash(key, buckets):
+    """ Maps a key to one of the buckets, moving only 1/n of the keys when a bucket is added
+
+    Lamping and Veach, A Fast, Minimal Memory, Consistent Hash Algorithm
+    """
+    key &= 0xffffffffffffffff
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def fan_out(func, shards, session):
+    """ Runs func() on every shard in parallel and returns the results in shard order
+    Args:
+        func (callable): the work to do on one shard, called without arguments
+        shards (list): the shards to run it on
+        session (scoped_session): removed after each run so no connection is kept
+    """
+    def run(shard):
+        with on_shard(shard):
+            try:
+                return func()
+            finally:
+                session.remove()
+    if len(shards) == 1:
+        with on_shard(shards[0]):
+            return [func()]
+    # pools do not survive a fork, so every process makes its own
+    key = (os.getpid(), len(shards))
+    if key not in _pools:
+        _pools[key] = ThreadPool(len(shards))
+    return _pools[key].map(run, shards)
+
+
+def shard_chooser(mapper, instance, clause=None):
+    """ Returns the shard to write a new instance to or to run a statement on """
+    if not is_sharded(mapper):
+        return PRIMARY
+    return current_shard() or PRIMARY
+
+
+def query_chooser(query):
+    """ Returns the shards a query runs on: the current one """
+    return [shard_chooser(query_mapper(query), None)]
+
+
+def id_chooser(query, ident):
+    """ Returns the shards to look a primary key up on, asking its model when no shard was picked """
+    mapper = query_mapper(query)
+    shard = shard_chooser(mapper, None)
+    locate = getattr(mapper.class_, 'shards_for_identity', None) if mapper is not None else None
+    if shard != PRIMARY or not is_sharded(mapper) or locate is None:
+        return [shard]
+    return locate(ident)
+
+
+def query_mapper(query):
+    """ Returns the mapper of the first entity of a query, None for plain SQL expressions """
+    descriptions = query.column_descriptions
+    entity = descriptions[0]['entity'] if descriptions else None
+    return inspect(entity).mapper if entity is not None else None
+
+
+class ShardQuery(BaseQuery, ShardedQuery):
+    """ A Flask-SQLAlchemy query that runs on the shards the session chooses """
+
+    def __iter__(self):
+        # ShardedQuery collects the rows of every shard in a list, a query on a
+        # single shard is bound to it instead so that yield_per() still streams
+        if self._shard_id is None:
+            shards = self.query_chooser(self)
+            if len(shards) == 1:
+                return super(ShardQuery, self.set_shard(shards[0])).__iter__()
+        return super(ShardQuery, self).__iter__()
@@ -0,0 +1,84 @@
+"""
+Concurrency Benchmark
+
+Serves the same app with sync workers (app:app) and with gevent workers
+(gevent_app:app) and keeps the same number of requests in flight
+against each, reading random Payments with GET /payments/{id}.
+
+The gevent workers only pull ahead when requests wait on the database,
+so point DATABASE_URI at PostgreSQL: SQLite calls block the whole worker.
+
+Usage:
+------
+    python -m benchmarks.concurrency [concurrency] [seconds] [workers]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import time
+import random
+import httplib
+import gevent
+from benchmarks.scaling import PAYMENTS, free_port, seed, start_server
+
+PROFILES = (
+    ('sync', 'app:app', ()),
+    ('gevent', 'gevent_app:app', ('--worker-class=gevent',)),
+)
+
+
+def percentile(latencies, fraction):
+    """ Returns a percentile of sorted latencies """
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def client(port, deadline, latencies, errors):
+    """ Reads random Payments until the deadline, one request at a time """
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+            connection.request('GET', '/payments/{}'.format(random.randint(1, PAYMENTS)))
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise httplib.HTTPException(response.status)
+            latencies.append(time.time() - start)
+        except Exception:   # pylint: disable=broad-except
+            errors.append(time.time() - start)
+
+
+def measure(app, options, concurrency, seconds, workers):
+    """ Returns the throughput and latencies of one serving profile """
+    port = free_port()
+    server = start_server(workers, port, app, options)
+    latencies = []
+    errors = []
+    try:
+        deadline = time.time() + seconds
+        gevent.joinall([gevent.spawn(client, port, deadline, latencies, errors)
+                        for _ in range(concurrency)])
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    return {'requests_per_second': int(len(latencies) / float(seconds)),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+            'errors': len(errors)}
+
+
+def main(concurrency=200, seconds=10, workers=1):
+    """ Prints the throughput and latency of the sync and gevent workers """
+    seed()
+    results = {}
+    for name, app, options in PROFILES:
+        results[name] = measure(app, options, concurrency, seconds, workers)
+        print('{:>6}: {requests_per_second:>8,} requests/s  p50 {p50_ms} ms  '
+              'p99 {p99_ms} ms  {errors} errors'.format(name, **results[name]))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,333 @@
+"""
+Load Test
+
+Seeds the database with a reproducible set of Payments, starts the
+production profile and drives every route of the service in turn with
+concurrent client processes. Prints the throughput and the p50, p95 and
+p99 latency of each route as JSON, to keep and compare across commits:
+
+    python -m benchmarks.load --payments 1000000 --customers 100000 > before.json
+    python -m benchmarks.load --payments 1000000 --customers 100000 > after.json
+    python -m benchmarks.load compare before.json after.json
+
+compare exits with 1 when a route lost more than --tolerance of its
+throughput or its p95 grew by more than that. The data is seeded again
+on every run, as the write routes change the status, method type and
+default flag of the seeded Payments; --reuse keeps the data of an earlier
+run with the same volumes, writes and all, to start at once. Only the
+Payments the clients created themselves are deleted. DELETE /payments/reset is
+not driven.
+
+DATABASE_URI selects the database (a SQLite file in /tmp by default).
+"""
+import sys
+import json
+import time
+import random
+import socket
+import httplib
+import argparse
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+from benchmarks.scaling import DATABASE_URI, free_port, start_server
+
+STATUSES = ('UNPAID', 'PROCESSING', 'PAID')
+METHOD_TYPES = ('CREDIT', 'DEBIT', 'PAYPAL')
+SEED_CHUNK = 10000
+
+# set by run() before the clients are forked
+volumes = {'first_id': 1, 'payments': 1000, 'customers': 100, 'port': None}
+
+
+######################################################################
+# SEEDING
+######################################################################
+def seed_payment(index, customers, rng):
+    """ Returns the fields of the seeded Payment with an index """
+    return dict(customer_id=1 + index % customers, order_id=index + 1,
+                payment_status=rng.choice(STATUSES), payment_method_type=rng.choice(METHOD_TYPES),
+                default_payment_type=False)
+
+
+def seed(payments, customers, seed_value=0, reuse=False):
+    """ Fills the database with payments Payments spread over customers, returns the first id
+
+    With reuse, the Payments of an earlier run with the same volumes are kept as
+    its writes left them
+    """
+    from app.models import Payment, PaymentMethodType, PaymentStatus, db
+    Payment.init_db()
+    seeded = Payment.query.filter(Payment.customer_id <= customers)
+    if reuse and seeded.count() == payments and \
+            seeded.filter(Payment.order_id > payments).count() == 0:
+        first_id = db.session.query(db.func.min(Payment.id)).scalar()
+        db.session.remove()
+        return first_id
+    Payment.remove_all()
+    rng = random.Random(seed_value)
+    ids = []
+    start = time.time()
+    for offset in range(0, payments, SEED_CHUNK):
+        chunk = []
+        for index in range(offset, min(offset + SEED_CHUNK, payments)):
+            fields = seed_payment(index, customers, rng)
+            fields['payment_status'] = PaymentStatus[fields['payment_status']]
+            fields['payment_method_type'] = PaymentMethodType[fields['payment_method_type']]
+            chunk.append(Payment(**fields))
+        ids.extend(Payment.create_many(chunk))
+        log('seeded {:,} of {:,} Payments'.format(len(ids), payments))
+    if ids != list(range(ids[0], ids[0] + payments)):
+        raise RuntimeError('the seeded Payment ids are not contiguous')
+    log('seeded in {:.1f} s'.format(time.time() - start))
+    db.session.remove()
+    return ids[0]
+
+
+######################################################################
+# ROUTES
+######################################################################
+def seeded_id(rng):
+    """ Returns the id and index of a random seeded Payment """
+    index = rng.randrange(volumes['payments'])
+    return volumes['first_id'] + index, index
+
+
+def own_customer(rng):
+    """ Returns a customer id beyond the seeded ones, for Payments the clients create """
+    return volumes['customers'] + 1 + rng.randrange(1000000)
+
+
+def new_payment(rng, customer_id=None):
+    """ Returns the JSON of a Payment for a customer that was not seeded """
+    return dict(customer_id=customer_id or own_customer(rng), order_id=rng.randrange(1 << 30),
+                payment_status=rng.choice(STATUSES), payment_method_type=rng.choice(METHOD_TYPES),
+                default_payment_type=False)
+
+
+def create_own(rng):
+    """ Creates a Payment of a customer that was not seeded, returns its id and customer """
+    payment = new_payment(rng)
+    code, body = call('POST', '/payments', payment)
+    if code != 201:
+        raise httplib.HTTPException('POST /payments returned {}'.format(code))
+    return json.loads(body)['id'], payment['customer_id']
+
+
+def update_payment(rng):
+    """ PUT /payments/{id} with the customer of the seeded Payment """
+    payment_id, index = seeded_id(rng)
+    payment = seed_payment(index, volumes['customers'], rng)
+    return 'PUT', '/payments/{}'.format(payment_id), payment
+
+
+def delete_payment(rng):
+    """ DELETE /payments/{id} of a Payment created for it """
+    payment_id, _ = create_own(rng)
+    return 'DELETE', '/payments/{}'.format(payment_id), None
+
+
+def delete_filtered(rng):
+    """ DELETE /payments?customer_id= of a customer created for it """
+    _, customer_id = create_own(rng)
+    return 'DELETE', '/payments?customer_id={}'.format(customer_id), None
+
+
+def transition_status(rng):
+    """ PUT /payments/status of ten seeded Payments """
+    ids = [seeded_id(rng)[0] for _ in range(10)]
+    return 'PUT', '/payments/status', dict(ids=ids, from_status=rng.choice(STATUSES),
+                                           to_status=rng.choice(STATUSES))
+
+
+def create_batch(rng):
+    """ POST /payments/batch of 100 Payments of one new customer """
+    customer_id = own_customer(rng)
+    return 'POST', '/payments/batch', [new_payment(rng, customer_id) for _ in range(100)]
+
+
+# name -> returns (method, path, body) of a request, reads first so the writes do not skew them
+ROUTES = OrderedDict([
+    ('index', lambda rng: ('GET', '/', None)),
+    ('health', lambda rng: ('GET', '/health', None)),
+    ('metrics', lambda rng: ('GET', '/metrics', None)),
+    ('internal_pool', lambda rng: ('GET', '/internal/pool', None)),
+    ('get_payment', lambda rng: ('GET', '/payments/{}'.format(seeded_id(rng)[0]), None)),
+    ('list_payments', lambda rng: ('GET', '/payments?after={}'.format(seeded_id(rng)[0]), None)),
+    ('list_by_customer', lambda rng: ('GET', '/payments?customer_id={}'.format(
+        1 + rng.randrange(volumes['customers'])), None)),
+    ('stats', lambda rng: ('GET', '/payments/stats', None)),
+    ('create_payment', lambda rng: ('POST', '/payments', new_payment(rng))),
+    ('update_payment', update_payment),
+    ('patch_payment', lambda rng: ('PATCH', '/payments/{}'.format(seeded_id(rng)[0]),
+                                   dict(payment_status=rng.choice(STATUSES)))),
+    ('set_default', lambda rng: ('PUT', '/payments/{}/default'.format(seeded_id(rng)[0]), None)),
+    ('transition_status', transition_status),
+    ('create_batch', create_batch),
+    ('delete_payment', delete_payment),
+    ('delete_filtered', delete_filtered),
+])
+
+
+######################################################################
+# CLIENTS
+######################################################################
+def log(message):
+    """ Reports progress on stderr, stdout is kept for the JSON """
+    sys.stderr.write(message + '\n')
+
+
+def call(method, path, body=None):
+    """ Makes one request, returns the status code and the body """
+    connection = httplib.HTTPConnection('127.0.0.1', volumes['port'], timeout=60)
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return response.status, data
+
+
+def client(args):
+    """ Drives one route until the time is up, returns the latencies, errors and 4xx answers """
+    route, seconds, seed_value = args
+    rng = random.Random(seed_value)
+    latencies, errors, rejected = [], 0, 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            method, path, body = ROUTES[route](rng)
+            start = time.time()
+            code, _ = call(method, path, body)
+            elapsed = time.time() - start
+        except (socket.error, httplib.HTTPException):
+            errors += 1
+            continue
+        if code >= 500:
+            errors += 1
+            continue
+        if code >= 400:
+            rejected += 1
+        latencies.append(elapsed)
+    return latencies, errors, rejected
+
+
+def percentile(latencies, fraction):
+    """ Returns a percentile of sorted latencies in milliseconds """
+    if not latencies:
+        return None
+    return round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000, 2)
+
+
+def drive(pool, route, concurrency, seconds, seed_value):
+    """ Returns the throughput and latencies of one route under concurrent clients """
+    results = pool.map(client, [(route, seconds, '{}-{}-{}'.format(seed_value, route, number))
+                                for number in range(concurrency)])
+    latencies = sorted(latency for result in results for latency in result[0])
+    return OrderedDict([('requests', len(latencies)),
+                        ('errors', sum(result[1] for result in results)),
+                        ('rejected', sum(result[2] for result in results)),
+                        ('requests_per_second', round(len(latencies) / float(seconds), 1)),
+                        ('p50_ms', percentile(latencies, 0.50)),
+                        ('p95_ms', percentile(latencies, 0.95)),
+                        ('p99_ms', percentile(latencies, 0.99))])
+
+
+def commit():
+    """ Returns the git commit under test, or None outside of a checkout """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    """ Seeds, serves and drives the routes, returns the report """
+    volumes['payments'] = options.payments
+    volumes['customers'] = options.customers
+    volumes['first_id'] = seed(options.payments, options.customers, options.seed, options.reuse)
+    routes = options.routes.split(',') if options.routes else list(ROUTES)
+    for route in routes:
+        if route not in ROUTES:
+            raise SystemExit('unknown route {}, choose from {}'.format(route, ', '.join(ROUTES)))
+    volumes['port'] = free_port()
+    server = start_server(options.workers, volumes['port'])
+    report = OrderedDict([('commit', commit()),
+                          ('database', DATABASE_URI.split(':')[0]),
+                          ('payments', options.payments),
+                          ('customers', options.customers),
+                          ('workers', options.workers),
+                          ('concurrency', options.concurrency),
+                          ('seconds', options.seconds),
+                          ('seed', options.seed),
+                          ('routes', OrderedDict())])
+    try:
+        pool = multiprocessing.Pool(options.concurrency)
+        for route in routes:
+            report['routes'][route] = result = drive(pool, route, options.concurrency,
+                                                     options.seconds, options.seed)
+            log('{:>18}: {requests_per_second:>9,.1f} requests/s  p50 {p50_ms} ms  '
+                'p95 {p95_ms} ms  p99 {p99_ms} ms  {errors} errors  {rejected} 4xx'.format(route, **result))
+        pool.close()
+        pool.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return report
+
+
+def compare(before, after, tolerance):
+    """ Prints the change of every route, returns the routes that got slower """
+    regressions = []
+    for route, new in after['routes'].items():
+        old = before['routes'].get(route)
+        if old is None or not old['requests'] or not new['requests']:
+            continue
+        throughput = new['requests_per_second'] / old['requests_per_second'] - 1
+        p95 = new['p95_ms'] / old['p95_ms'] - 1 if old['p95_ms'] else 0.0
+        slower = throughput < -tolerance or p95 > tolerance
+        if slower:
+            regressions.append(route)
+        print('{:>18}: throughput {:+6.1%}  p95 {:+6.1%}{}'.format(
+            route, throughput, p95, '  REGRESSION' if slower else ''))
+    return regressions
+
+
+def main(argv=None):
+    """ Runs the load test, or compares two of its reports """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['compare']:
+        parser = argparse.ArgumentParser(prog='benchmarks.load compare')
+        parser.add_argument('before')
+        parser.add_argument('after')
+        parser.add_argument('--tolerance', type=float, default=0.1,
+                            help='the slowdown allowed before a route fails (0.1)')
+        options = parser.parse_args(argv[1:])
+        with open(options.before) as before, open(options.after) as after:
+            regressions = compare(json.load(before), json.load(after), options.tolerance)
+        return 1 if regressions else 0
+    parser = argparse.ArgumentParser(prog='benchmarks.load')
+    parser.add_argument('--payments', type=int, default=10000, help='Payments to seed (10000)')
+    parser.add_argument('--customers', type=int, default=1000,
+                        help='customers the Payments are spread over (1000)')
+    parser.add_argument('--concurrency', type=int, default=8, help='client processes (8)')
+    parser.add_argument('--seconds', type=int, default=5, help='seconds per route (5)')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='gunicorn workers (one per core)')
+    parser.add_argument('--routes', help='comma separated routes to drive (all of them)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the data and requests (0)')
+    parser.add_argument('--reuse', action='store_true',
+                        help='keep the data of an earlier run with the same volumes')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    options = parser.parse_args(argv)
+    report = json.dumps(run(options), indent=2)
+    print(report)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(report + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""
+Logging Latency Benchmark
+
+Compares the latency of POST /payments and GET /payments/{id} with
+logging disabled, logging straight to STDOUT, and logging through the
+queue of LOG_QUEUE. STDOUT is replaced by a stream that takes a while for
+every write, like a log pipe that is not read fast enough.
+
+Usage:
+------
+    python -m benchmarks.log_latency [requests] [write_delay_ms]
+
+DATABASE_URI selects the database (a SQLite file in /tmp by default).
+"""
+import sys
+import json
+import time
+import logging
+from benchmarks.scaling import DATABASE_URI  # pylint: disable=unused-import
+
+MODES = (
+    ('disabled', logging.CRITICAL, 'text', False),
+    ('text', logging.INFO, 'text', False),
+    ('json', logging.INFO, 'json', False),
+    ('queued_json', logging.INFO, 'json', True),
+)
+
+
+class SlowStream(object):
+    """ A stream that blocks for a while on every write """
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+
+def percentile(latencies, fraction):
+    """ Returns a percentile of sorted latencies in milliseconds """
+    return round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000, 2)
+
+
+def measure(client, count):
+    """ Returns the sorted latencies of count POSTs, each followed by a GET """
+    latencies = []
+    for number in range(count):
+        payment = dict(customer_id=1 + number % 100, order_id=number,
+                       payment_method_type='CREDIT', payment_status='PAID',
+                       default_payment_type=False)
+        start = time.time()
+        resp = client.post('/payments', data=json.dumps(payment), content_type='application/json')
+        latencies.append(time.time() - start)
+        start = time.time()
+        client.get('/payments/{}'.format(json.loads(resp.data)['id']))
+        latencies.append(time.time() - start)
+    return sorted(latencies)
+
+
+def main(count=500, delay_ms=1.0):
+    """ Prints the request latency of every logging mode """
+    from app import app, service
+    service.init_db()
+    client = app.test_client()
+    stdout = sys.stdout
+    results = {}
+    for name, level, log_format, queued in MODES:
+        app.config['LOG_FORMAT'] = log_format
+        app.config['LOG_QUEUE'] = queued
+        service.data_reset()
+        sys.stdout = SlowStream(delay_ms / 1000.0)
+        try:
+            service.initialize_logging(level)
+            latencies = measure(client, count)
+            # let the queue drain before the next mode
+            service.initialize_logging(logging.CRITICAL)
+        finally:
+            sys.stdout = stdout
+        results[name] = {'p50_ms': percentile(latencies, 0.50),
+                         'p99_ms': percentile(latencies, 0.99)}
+        print('{:>12}: p50 {p50_ms:6.2f} ms  p99 {p99_ms:6.2f} ms'.format(name, **results[name]))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[float(arg) if index else int(arg) for index, arg in enumerate(sys.argv[1:3])])
@@ -0,0 +1,46 @@
+"""
+Request Metrics Benchmark
+
+Measures what the request metrics add to every request, by calling a
+WSGI app that does nothing with and without RequestMetrics around it.
+
+Usage:
+------
+    python -m benchmarks.metrics [requests] [repeat]
+"""
+import sys
+import timeit
+from app.metrics import ROUTE, RequestMetrics
+
+ENVIRON = {'REQUEST_METHOD': 'GET', ROUTE: '/payments/<int:payment_id>'}
+
+
+def empty_app(environ, start_response):
+    """ Answers every request with an empty 200 """
+    start_response('200 OK', [])
+    return []
+
+
+def start_response(status, headers, exc_info=None):
+    """ Throws the status and headers away """
+
+
+def measure(wsgi_app, count, repeat):
+    """ Returns the best time in seconds of making count requests """
+    return min(timeit.repeat(lambda: wsgi_app(ENVIRON, start_response),
+                             number=count, repeat=repeat))
+
+
+def main(count=100000, repeat=5):
+    """ Prints the microseconds each request spends in the metrics """
+    bare = measure(empty_app, count, repeat)
+    instrumented = measure(RequestMetrics().wrap(empty_app), count, repeat)
+    overhead = round((instrumented - bare) / count * 1e6, 3)
+    print('bare: {:.3f} us/request'.format(bare / count * 1e6))
+    print('instrumented: {:.3f} us/request'.format(instrumented / count * 1e6))
+    print('overhead: {} us/request'.format(overhead))
+    return {'us_per_request': overhead}
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,120 @@
+"""
+Worker Scaling Benchmark
+
+Starts the production profile (gunicorn.conf.py) with 1, 2, 4 ... workers
+up to the number of cores and measures the throughput of
+GET /payments/{id} from concurrent client processes.
+
+The clients run on the same host and take CPU away from the workers, so
+run it on a host with spare cores or point a remote load generator at
+the same setup for absolute numbers.
+
+Usage:
+------
+    python -m benchmarks.scaling [max_workers] [seconds] [clients]
+
+DATABASE_URI selects the database (a SQLite file in /tmp by default).
+"""
+import os
+import sys
+import time
+import random
+import socket
+import httplib
+import subprocess
+import multiprocessing
+
+DATABASE_URI = os.environ.setdefault('DATABASE_URI', 'sqlite:////tmp/payments-benchmark.db')
+PAYMENTS = 1000
+
+
+def seed(count=PAYMENTS):
+    """ Fills the database with Payments to read """
+    from app.models import Payment, PaymentMethodType, PaymentStatus
+    Payment.remove_all()
+    Payment.create_many([Payment(customer_id=10000 + i % 97, order_id=20000 + i,
+                                 payment_status=PaymentStatus.PAID,
+                                 payment_method_type=PaymentMethodType.CREDIT,
+                                 default_payment_type=False)
+                         for i in range(count)])
+
+
+def free_port():
+    """ Returns a port nothing is listening on """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(workers, port, app='app:app', options=()):
+    """ Starts gunicorn with the production profile and waits until it answers """
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), PORT=str(port))
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn.app.wsgiapp',
+                               '--config=gunicorn.conf.py', '--access-logfile=/dev/null',
+                               '--error-logfile=/dev/null'] + list(options) + [app], env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return server
+        except (socket.error, httplib.HTTPException):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start on port {}'.format(port))
+
+
+def client(args):
+    """ Reads random Payments until the time is up, returns the request count """
+    port, seconds = args
+    requests = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        connection = httplib.HTTPConnection('127.0.0.1', port)
+        connection.request('GET', '/payments/{}'.format(random.randint(1, PAYMENTS)))
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError('GET returned {}'.format(response.status))
+        requests += 1
+    return requests
+
+
+def measure(workers, seconds, clients):
+    """ Returns the requests per second served by a number of workers """
+    port = free_port()
+    server = start_server(workers, port)
+    try:
+        pool = multiprocessing.Pool(clients)
+        client((port, 1))   # warm up the workers
+        requests = sum(pool.map(client, [(port, seconds)] * clients))
+        pool.close()
+        pool.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return requests / float(seconds)
+
+
+def main(max_workers=None, seconds=10, clients=None):
+    """ Prints the throughput and speedup for each number of workers """
+    max_workers = max_workers or multiprocessing.cpu_count()
+    seed()
+    results = []
+    workers = 1
+    while workers <= max_workers:
+        throughput = measure(workers, seconds, clients or max(workers * 4, 4))
+        results.append({'workers': workers, 'requests_per_second': int(throughput),
+                        'speedup': round(throughput / (results[0]['requests_per_second'] or 1), 2)
+                                   if results else 1.0})
+        print('{workers:>3} workers: {requests_per_second:>8,} requests/s {speedup:5.2f}x'
+              .format(**results[-1]))
+        workers *= 2
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,63 @@
+"""
+Serialization Benchmark
+
+Compares the cost of turning Payments into a JSON response body with
+    old - Payment.serialize() + marshal(payment_model) + json.dumps()
+    new - the precompiled JSONSerializer used by the read endpoints
+
+Usage:
+------
+    python -m benchmarks.serialization [payments] [repeat]
+"""
+import sys
+import json
+import timeit
+from flask_restplus import marshal
+from app.models import Payment, PaymentMethodType, PaymentStatus
+from app.service import payment_model, payment_json
+
+
+def make_payments(count):
+    """ Builds transient Payments that cycle through every enum value """
+    statuses = list(PaymentStatus)
+    types = list(PaymentMethodType)
+    return [Payment(id=i, customer_id=10000 + i % 997, order_id=20000 + i,
+                    payment_status=statuses[i % len(statuses)],
+                    payment_method_type=types[i % len(types)],
+                    default_payment_type=(i % 10 == 0))
+            for i in range(1, count + 1)]
+
+
+def old_path(payments):
+    """ The response body as built by marshal_list_with """
+    return json.dumps(marshal([payment.serialize() for payment in payments], payment_model))
+
+
+def new_path(payments):
+    """ The response body as built by the JSONSerializer """
+    return payment_json.dumps_list(payments)
+
+
+def measure(func, payments, repeat):
+    """ Returns the best time in seconds of serializing all of the Payments """
+    return min(timeit.repeat(lambda: func(payments), number=1, repeat=repeat))
+
+
+def main(count=10000, repeat=5):
+    """ Runs both paths and prints microseconds per Payment and Payments per second """
+    payments = make_payments(count)
+    assert json.loads(old_path(payments)) == json.loads(new_path(payments))
+    results = {}
+    for name, func in (('old', old_path), ('new', new_path)):
+        seconds = measure(func, payments, repeat)
+        results[name] = {'us_per_payment': round(seconds / count * 1e6, 3),
+                         'payments_per_second': int(count / seconds)}
+        print('{:>4}: {:8.3f} us/payment {:>10,} payments/s'.format(
+            name, results[name]['us_per_payment'], results[name]['payments_per_second']))
+    print('speedup: {:.1f}x'.format(
+        results['new']['payments_per_second'] / float(results['old']['payments_per_second'])))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,97 @@
+"""
+Startup Benchmark
+
+Measures how long a new instance of the service takes to become useful:
+    import - importing the app package in a fresh interpreter
+    first_response - starting gunicorn until GET /payments/{id} answers 200
+    first_request / next_request - the first request a worker serves and
+    the one after it, to show what is still left for the first request
+
+Each number is the median of several cold starts.
+
+Usage:
+------
+    python -m benchmarks.startup [runs]
+
+DATABASE_URI selects the database (a SQLite file in /tmp by default).
+"""
+import os
+import sys
+import time
+import socket
+import httplib
+import subprocess
+from benchmarks.scaling import free_port, seed
+
+
+def median(values):
+    """ Returns the middle of some measurements """
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def time_import():
+    """ Returns the seconds a new interpreter takes to import the app """
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', 'import app'])
+    return time.time() - start
+
+
+def get(port, path):
+    """ Returns the status of a GET, or None while nothing listens on the port """
+    try:
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except socket.error:
+        return None
+
+
+def time_first_response():
+    """ Returns the seconds to the first 200 and the latency of the first two requests """
+    port = free_port()
+    env = dict(os.environ, WEB_CONCURRENCY='1', PORT=str(port))
+    start = time.time()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn.app.wsgiapp',
+                               '--config=gunicorn.conf.py', '--access-logfile=/dev/null',
+                               '--error-logfile=/dev/null', 'app:app'], env=env)
+    try:
+        while True:
+            request_start = time.time()
+            code = get(port, '/payments/1')
+            if code is not None:
+                break
+            if time.time() - start > 30:
+                raise RuntimeError('gunicorn did not start on port {}'.format(port))
+            time.sleep(0.005)
+        if code != 200:
+            raise RuntimeError('GET /payments/1 returned {}'.format(code))
+        first_response = time.time() - start
+        first_request = time.time() - request_start
+        request_start = time.time()
+        get(port, '/payments/1')
+        next_request = time.time() - request_start
+    finally:
+        server.terminate()
+        server.wait()
+    return first_response, first_request, next_request
+
+
+def main(runs=5):
+    """ Prints the median startup times in milliseconds """
+    seed(10)
+    imports = [time_import() for _ in range(runs)]
+    starts = [time_first_response() for _ in range(runs)]
+    results = {'import_ms': round(median(imports) * 1000, 1),
+               'first_response_ms': round(median(start[0] for start in starts) * 1000, 1),
+               'first_request_ms': round(median(start[1] for start in starts) * 1000, 1),
+               'next_request_ms': round(median(start[2] for start in starts) * 1000, 1)}
+    for name in ('import_ms', 'first_response_ms', 'first_request_ms', 'next_request_ms'):
+        print('{:>18}: {:8.1f}'.format(name, results[name]))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
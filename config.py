@@ -1,6 +1,7 @@
 import os
 import logging
-from app.vcap_services import get_database_uri
+from app.vcap_services import get_database_uri, get_pool_size, get_replica_binds, \
+    get_shard_binds
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -13,5 +14,63 @@ SQLALCHEMY_DATABASE_URI = get_database_uri()
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 PRESERVE_CONTEXT_ON_EXCEPTION = False
 
+# Read replicas for the read-only requests, a client that writes reads
+# from the primary for READ_YOUR_WRITES_SECONDS afterwards
+SQLALCHEMY_BINDS = get_replica_binds()
+READ_REPLICAS = sorted(SQLALCHEMY_BINDS)
+READ_YOUR_WRITES_SECONDS = int(os.getenv('READ_YOUR_WRITES_SECONDS', '5'))
+
+# Databases the Payments are spread over by customer_id, the primary keeps
+# the directory of moved customers and the Payment id sequence
+SHARD_BINDS = get_shard_binds()
+SHARDS = list(SHARD_BINDS)
+SQLALCHEMY_BINDS.update(SHARD_BINDS)
+
+# Connection pool of each worker process (SQLite databases are not pooled)
+SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW = get_pool_size()
+SQLALCHEMY_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '10'))
+SQLALCHEMY_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+SQLALCHEMY_POOL_PRE_PING = (os.getenv('DB_POOL_PRE_PING', 'True') == 'True')
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))
+
 SECRET_KEY = 'secret-for-dev-only'
 LOGGING_LEVEL = logging.DEBUG
+
+# Keyset pagination for the Payment listings
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '1000'))
+
+# Bulk operations on Payments
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '10000'))
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', '500'))
+
+# Read-through cache in front of Payment.find and find_by_customer_id
+PAYMENT_CACHE_ENABLED = (os.getenv('PAYMENT_CACHE_ENABLED', 'False') == 'True')
+PAYMENT_CACHE_SIZE = int(os.getenv('PAYMENT_CACHE_SIZE', '10000'))
+PAYMENT_CACHE_TTL = int(os.getenv('PAYMENT_CACHE_TTL', '30'))
+
+# Keep a table of Payment counts per status and method type for /payments/stats
+PAYMENT_STATS_COUNTERS = (os.getenv('PAYMENT_STATS_COUNTERS', 'False') == 'True')
+
+# Seconds the response to a POST /payments with an Idempotency-Key is replayed
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', '86400'))
+
+# Request metrics: every worker writes its counts to METRICS_DIR every
+# METRICS_FLUSH_SECONDS for /metrics to add up (gunicorn.conf.py makes one)
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '1'))
+
+# Log the statements slower than SLOW_QUERY_SECONDS, and those run at least
+# QUERY_REPEAT_THRESHOLD times in one request (a query in a loop)
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_SECONDS', '0.5'))
+QUERY_REPEAT_THRESHOLD = int(os.getenv('QUERY_REPEAT_THRESHOLD', '3'))
+
+# Logging: text or json records, written by a background thread with LOG_QUEUE
+# (dropped while LOG_QUEUE_SIZE records wait), and the payloads of
+# LOG_PAYLOAD_SAMPLE_RATE of the writes with the LOG_REDACT_FIELDS masked
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_QUEUE = (os.getenv('LOG_QUEUE', 'True') == 'True')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '1.0'))
+LOG_REDACT_FIELDS = [field.strip() for field in os.getenv(
+    'LOG_REDACT_FIELDS', 'card_number,cvv,account_number,password,token').split(',') if field.strip()]
@@ -0,0 +1,25 @@
+"""
+Cooperative Payment Service
+
+Entry point for serving the Payment Service on gevent workers, where each
+request runs in a greenlet and waits on the database without holding a
+thread. One worker can keep thousands of requests in flight:
+
+    gunicorn --config=gunicorn.conf.py --worker-class=gevent gevent_app:app
+
+The standard library is patched before the app is imported, and the
+PostgreSQL driver is made cooperative with psycogreen. The routes, the
+JSON and the models are those of the app package. The DB2 driver cannot
+yield to other greenlets, so this only helps with PostgreSQL.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:     # no PostgreSQL driver installed
+    patch_psycopg = None
+if patch_psycopg is not None:
+    patch_psycopg()
+
+from app import app  # pylint: disable=wrong-import-position
@@ -0,0 +1,92 @@
+"""
+Gunicorn Configuration
+
+Production serving profile for the Payment Service:
+
+    gunicorn --config=gunicorn.conf.py app:app
+
+The app is loaded once in the master and forked into the workers, so the
+code and the data built at import time are shared copy-on-write. The
+master creates the tables before the first fork, so a new worker only
+opens a connection of its own before it takes requests.
+
+Environment:
+------------
+PORT - the port to listen on (5000)
+WEB_CONCURRENCY - worker processes (2 x cores + 1)
+GUNICORN_THREADS - threads per worker, more than 1 uses the gthread worker (1)
+GUNICORN_WORKER_CONNECTIONS - requests in flight per gevent worker (1000)
+GUNICORN_TIMEOUT - seconds before a silent worker is restarted (30)
+METRICS_DIR - where the workers write their request metrics (a new temporary directory)
+"""
+import gc
+import os
+import tempfile
+import multiprocessing
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# the app sizes the connection pool of each worker by WEB_CONCURRENCY when it
+# is preloaded, so it has to know the number of workers gunicorn starts
+os.environ.setdefault('WEB_CONCURRENCY', str(workers))
+threads = int(os.getenv('GUNICORN_THREADS', '1'))
+# only used with --worker-class=gevent and the gevent_app entry point
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+preload_app = True
+accesslog = '-'
+errorlog = '-'
+
+# set before the app is loaded, so that every worker writes its metrics there
+if not os.getenv('METRICS_DIR'):
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='payments-metrics-')
+
+# Objects that survive until the fork are never collected in the workers:
+# collecting them would write to their pages and unshare them (Python 3.7+)
+FREEZE = hasattr(gc, 'freeze')
+if FREEZE:
+    gc.disable()
+
+
+def dispose_engines():
+    """ Closes the connections of every engine so that no process shares a socket """
+    from app import app, db
+    for bind in [None] + list(app.config['SQLALCHEMY_BINDS']):
+        db.get_engine(app, bind).dispose()
+
+
+def pre_fork(server, worker):
+    """ Moves everything loaded so far out of reach of the collector """
+    if FREEZE:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    """ Gives the worker its connections and logging and turns the collector back on """
+    from sqlalchemy.exc import SQLAlchemyError
+    from app import db, service
+    dispose_engines()
+    # the log writer thread of a worker has to start after the fork
+    service.initialize_logging()
+    if FREEZE:
+        gc.enable()
+    # connect now rather than in the first request of the worker
+    try:
+        db.engine.connect().close()
+    except SQLAlchemyError as error:
+        server.log.warning('Worker %s could not connect yet: %s', worker.pid, error)
+    server.log.info('Worker %s ready', worker.pid)
+
+
+def on_starting(server):
+    """ Creates the tables once for all of the workers and starts the metrics from zero """
+    from app.service import init_db, request_metrics
+    init_db()
+    dispose_engines()
+    request_metrics.clear()
+
+
+def child_exit(server, worker):
+    """ Keeps the request counts of a worker that exited """
+    from app.service import request_metrics
+    request_metrics.retire(worker.pid)
@@ -0,0 +1,52 @@
+#!usr//bin/python
+"""
+Shard Maintenance Script
+
+This Python script shows how the Payments are spread over the shards
+in DATABASE_SHARD_URIS and moves customers between them.
+
+Commands:
+---------
+    - status : the number of Payments and customers on every shard
+    - move CUSTOMER SHARD : move the Payments of a customer to a shard
+    - rebalance [--dry-run] : move customers until the shards are even
+    - pin COUNT : keep every customer in place before COUNT shards are
+      added to the end of DATABASE_SHARD_URIS
+"""
+import sys
+from app import app, db
+from app.models import Payment
+
+
+def status():
+    """ Prints the Payments and customers of every shard """
+    counts = Payment._fan_out(lambda: db.session.query(
+        db.func.count(Payment.id), db.func.count(Payment.customer_id.distinct())).one())
+    for shard, (payments, customers) in zip(Payment.shards, counts):
+        print('{}: {} Payments, {} customers'.format(shard, payments, customers))
+
+
+if __name__ == '__main__':
+    if not Payment.shards:
+        print('DATABASE_SHARD_URIS not set, the Payments are not sharded.')
+        sys.exit(1)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    with app.app_context():
+        if command == 'status':
+            status()
+        elif command == 'move' and len(sys.argv) == 4:
+            moved = Payment.move_customer(int(sys.argv[2]), sys.argv[3])
+            print('Moved {} Payments of customer {} to {}'.format(moved, sys.argv[2], sys.argv[3]))
+        elif command == 'rebalance':
+            dry_run = '--dry-run' in sys.argv
+            for customer_id, source, target, count in Payment.rebalance(dry_run=dry_run):
+                print('{} customer {} ({} Payments) from {} to {}'.format(
+                    'Would move' if dry_run else 'Moved', customer_id, count, source, target))
+            status()
+        elif command == 'pin' and len(sys.argv) == 3:
+            total = len(Payment.shards) + int(sys.argv[2])
+            shards = ['shard{}'.format(number) for number in range(total)]
+            print('Pinned {} customers'.format(Payment.pin_customers(shards)))
+        else:
+            print(__doc__)
+            sys.exit(1)
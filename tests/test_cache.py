@@ -0,0 +1,82 @@
+import unittest
+from app.cache import LRUCache
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the in-process cache """
+
+    def setUp(self):
+        self.now = 0
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_hit_and_miss(self):
+        """ Count hits and misses """
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+
+    def test_evict_least_recently_used(self):
+        """ Evict the least recently used entry when full """
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_expire_after_ttl(self):
+        """ Expire entries after their time to live """
+        self.cache.set('a', 1)
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_invalidate_by_tag(self):
+        """ Drop every entry carrying a tag """
+        self.cache.set('a', 1, tags=['x', 'y'])
+        self.cache.set('b', 2, tags=['y'])
+        self.cache.invalidate('x')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+        self.cache.invalidate('y', 'z')
+        self.assertIsNone(self.cache.get('b'))
+        self.cache.set('c', 3, tags=['y'])
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_refuse_values_read_before_an_invalidation(self):
+        """ Do not store a value whose tag was invalidated while it was read """
+        generation = self.cache.generation()
+        self.cache.invalidate('x')
+        self.cache.set('a', 1, tags=['x'], generation=generation)
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('b', 2, tags=['y'], generation=generation)
+        self.assertEqual(self.cache.get('b'), 2)
+        generation = self.cache.generation()
+        self.cache.set('a', 1, tags=['x'], generation=generation)
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_refuse_values_older_than_forgotten_invalidations(self):
+        """ Refuse the values read before invalidations that are no longer remembered """
+        generation = self.cache.generation()
+        self.cache.invalidate('x', 'y', 'z')
+        self.cache.set('a', 1, tags=['x'], generation=generation)
+        self.assertIsNone(self.cache.get('a'))
+        generation = self.cache.generation()
+        self.cache.clear()
+        self.cache.set('b', 2, tags=['w'], generation=generation)
+        self.assertIsNone(self.cache.get('b'))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+Test cases for the structured and queued log handlers
+"""
+import json
+import logging
+import threading
+import unittest
+from StringIO import StringIO
+from mock import patch
+from app.log_handlers import PayloadLogger, QueueHandler, REDACTED, make_handler, redact
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogHandlers(unittest.TestCase):
+    """ Test Cases for the log handlers """
+
+    def setUp(self):
+        self.stream = StringIO()
+        self.logger = logging.getLogger('test_log_handlers')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def test_json_records(self):
+        """ Write one JSON object per record with the extra fields """
+        self.logger.addHandler(make_handler(self.stream, json_format=True))
+        self.logger.info('Payment %s saved', 7, extra={'payload': {'order_id': 1}})
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            self.logger.exception('Failed')
+        first, second = [json.loads(line) for line in self.stream.getvalue().splitlines()]
+        self.assertEqual(first['message'], 'Payment 7 saved')
+        self.assertEqual((first['level'], first['logger']), ('INFO', 'test_log_handlers'))
+        self.assertEqual(first['payload'], {'order_id': 1})
+        self.assertIn('ValueError: bad', second['exception'])
+
+    def test_queued(self):
+        """ Write the records from the thread of the handler """
+        handler = make_handler(self.stream, queued=True)
+        self.logger.addHandler(handler)
+        payload = {'order_id': 1}
+        self.logger.info('Payload %s', payload)
+        payload['order_id'] = 2
+        self.logger.removeHandler(handler)
+        handler.close()
+        self.assertIn("Payload {'order_id': 1}", self.stream.getvalue())
+
+    @patch('app.log_handlers.greenlets', return_value=True)
+    def test_queued_under_gevent(self, _):
+        """ Write the records from an OS thread through an unpatched queue """
+        handler = QueueHandler(logging.StreamHandler(self.stream), size=2)
+        self.assertFalse(isinstance(handler._thread, threading.Thread))
+        self.logger.addHandler(handler)
+        self.logger.info('Record %s', 1)
+        self.logger.removeHandler(handler)
+        handler.close()
+        self.assertFalse(handler._thread.is_alive())
+        self.assertIn('Record 1', self.stream.getvalue())
+
+    def test_queue_full(self):
+        """ Drop records instead of waiting while the writer is stuck """
+        release = threading.Event()
+
+        class StuckStream(object):
+            """ A log pipe nobody reads """
+            def write(self, text):
+                release.wait()
+
+            def flush(self):
+                pass
+        handler = QueueHandler(logging.StreamHandler(StuckStream()), size=2)
+        self.logger.addHandler(handler)
+        for number in range(10):
+            self.logger.info('Record %s', number)
+        self.assertGreaterEqual(handler.dropped, 7)
+        release.set()
+
+    def test_payload_sampling(self):
+        """ Log a sample of the payloads with the sensitive fields masked """
+        self.logger.addHandler(make_handler(self.stream, json_format=True))
+        draws = iter([0.05, 0.5])
+        payloads = PayloadLogger(self.logger, 0.1, ['card_number'], rand=lambda: next(draws))
+        payloads.log('Payload', {'order_id': 1, 'Card_Number': '4111'})
+        payloads.log('Payload', {'order_id': 2})
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record['payload'], {'order_id': 1, 'Card_Number': REDACTED})
+        self.assertEqual(record['module'], 'test_log_handlers')
+        PayloadLogger(self.logger, 0).log('Payload', {'order_id': 3})
+        self.assertEqual(len(self.stream.getvalue().splitlines()), 1)
+
+    def test_redact_nested(self):
+        """ Mask the sensitive fields at any depth """
+        self.assertEqual(redact([{'cvv': 123, 'cards': [{'cvv': 456}]}, 5], {'cvv'}),
+                         [{'cvv': REDACTED, 'cards': [{'cvv': REDACTED}]}, 5])
+
+    def test_text_format(self):
+        """ Keep the text format, followed by the payload """
+        self.logger.addHandler(make_handler(self.stream, fmt='%(levelname)s %(message)s'))
+        self.logger.info('Payload', extra={'payload': {'order_id': 1}})
+        self.assertEqual(self.stream.getvalue(), 'INFO Payload {"order_id": 1}\n')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+Test cases for the request metrics
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from app.metrics import RequestMetrics, write_snapshot
+from app import app
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRequestMetrics(unittest.TestCase):
+    """ Test Cases for the per route request metrics """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.metrics = RequestMetrics(self.directory, buckets=(0.01, 0.1))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_histogram(self):
+        """ Count the requests in cumulative buckets """
+        for seconds in (0.005, 0.01, 0.05, 3):
+            self.metrics.observe('/payments', 'GET', '200', seconds)
+        self.metrics.observe('/payments', 'GET', '404', 0.001)
+        text = self.metrics.render()
+        self.assertIn('http_requests_total{method="GET",route="/payments",status="200"} 4', text)
+        self.assertIn('http_requests_total{method="GET",route="/payments",status="404"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{le="0.01",method="GET",route="/payments"} 3',
+                      text)
+        self.assertIn('http_request_duration_seconds_bucket{le="0.1",method="GET",route="/payments"} 4',
+                      text)
+        self.assertIn('http_request_duration_seconds_bucket{le="+Inf",method="GET",route="/payments"} 5',
+                      text)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/payments"} 5', text)
+
+    def test_threads(self):
+        """ Add up the counters of every thread """
+        def serve():
+            for _ in range(100):
+                self.metrics.observe('/health', 'GET', '200', 0.001)
+        threads = [threading.Thread(target=serve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.metrics.snapshot()['requests'], [['/health', 'GET', '200', 400]])
+        # the counts of the finished threads are kept, their counters are not
+        self.assertEqual(len(self.metrics._threads), 0)
+        thread = threading.Thread(target=serve)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(self.metrics._threads), 1)
+        self.assertEqual(self.metrics.snapshot()['requests'], [['/health', 'GET', '200', 500]])
+
+    def test_workers(self):
+        """ Add up the files of every worker and keep those of the workers that exited """
+        self.metrics.observe('/payments', 'POST', '201', 0.02)
+        other = RequestMetrics(self.directory, buckets=(0.01, 0.1))
+        other.observe('/payments', 'POST', '201', 0.2)
+        write_snapshot(os.path.join(self.directory, '12345.json'), other.snapshot())
+        snapshot = self.metrics.collect()
+        self.assertEqual(snapshot['requests'], [['/payments', 'POST', '201', 2]])
+        self.metrics.retire(12345)
+        self.assertEqual(set(os.listdir(self.directory)),
+                         {'dead.json', '{}.json'.format(os.getpid())})
+        [[_, _, histogram]] = self.metrics.collect()['latency']
+        self.assertEqual(histogram[:3], [0, 1, 1])
+        self.assertAlmostEqual(histogram[3], 0.22)
+        self.metrics.clear()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_wsgi(self):
+        """ Record the route, status and requests in flight of the service """
+        client = app.test_client()
+        # a buffered response is closed once read, as a server does
+        client.get('/health', buffered=True)
+        client.get('/no/such/route', buffered=True)
+        resp = client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain; version=0.0.4'))
+        text = resp.get_data(as_text=True)
+        self.assertIn('route="/health",status="200"', text)
+        self.assertIn('route="<unmatched>",status="404"', text)
+        self.assertIn('http_requests_in_flight 1', text)
+
+    def test_streamed_response(self):
+        """ Keep a streamed response in flight until its body is closed """
+        def stream(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/x-ndjson')])
+            for line in ('{}\n', '{}\n'):
+                yield line
+        wsgi = self.metrics.wrap(stream)
+        body = wsgi({'REQUEST_METHOD': 'GET'}, lambda status, headers, exc_info=None: None)
+        self.assertEqual(next(iter(body)), '{}\n')
+        snapshot = self.metrics.snapshot()
+        self.assertEqual((snapshot['requests'], snapshot['in_flight']), ([], 1))
+        body.close()
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['requests'], [['<unmatched>', 'GET', '200', 1]])
+        self.assertEqual(snapshot['in_flight'], 0)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,20 @@
 import unittest
 import os
-from app.models import Payment, PaymentMethodType, PaymentStatus, db
+import re
+import time
+from mock import patch
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import Conflict
+from app.models import InsertedIds, Payment, PaymentMethodType, PaymentStatus, db
 from app.custom_exceptions import DataValidationError
+from app.sharding import ShardQuery
 from app import app
 
 DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+# Seq Scan on PostgreSQL, SCAN [TABLE] payment without an index on SQLite
+SEQUENTIAL_SCAN = re.compile(r'Seq Scan|SCAN (TABLE )?payment(?! USING)')
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
@@ -99,6 +109,58 @@ class TestPayments(unittest.TestCase):
         self.assertEqual(len(payments), 1)
         self.assertEqual(payments[0].payment_method_type, PaymentMethodType.DEBIT)
 
+    def test_update_stale_payment(self):
+        """ Refuse to overwrite a Payment changed since it was read """
+        payment = Payment(customer_id=12310, order_id=13151, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=False)
+        payment.save()
+        self.assertEqual(payment.version, 1)
+        self.assertEqual(payment.etag(), '1-1')
+        # another writer updates the row after we read it
+        db.engine.execute('UPDATE payment SET order_id = 1, version = version + 1')
+        payment.payment_method_type = PaymentMethodType.DEBIT
+        self.assertRaises(StaleDataError, payment.save)
+        payment = Payment.find(1)
+        self.assertEqual((payment.order_id, payment.version), (1, 2))
+        payment.payment_method_type = PaymentMethodType.DEBIT
+        payment.save()
+        self.assertEqual(payment.version, 3)
+        Payment.transition_status(PaymentStatus.PAID, PaymentStatus.UNPAID)
+        self.assertEqual(Payment.find(1).version, 4)
+
+
+    def test_patch_payment(self):
+        """ Update some columns of a Payment without loading it """
+        Payment(customer_id=1, order_id=1, payment_method_type="CREDIT", payment_status="UNPAID", default_payment_type=False).save()
+        Payment.init_counters()
+        try:
+            payment = Payment.patch(1, Payment.validate_changes(dict(payment_status='PAID', order_id=9)))
+            self.assertEqual((payment.order_id, payment.payment_status, payment.version), (9, PaymentStatus.PAID, 2))
+            self.assertIsNone(Payment.patch(1, {'order_id': 3}, version=1))
+            self.assertIsNone(Payment.patch(2, {'order_id': 3}))
+            self.assertEqual(set(Payment.statistics()), {(None, PaymentStatus.PAID, PaymentMethodType.CREDIT, 1)})
+        finally:
+            Payment.counters = False
+        payment = Payment.find(1)
+        self.assertEqual((payment.order_id, payment.payment_status, payment.version), (9, PaymentStatus.PAID, 2))
+        self.assertRaises(DataValidationError, Payment.validate_changes, dict(default_payment_type='yes'))
+
+
+    def test_delete_many(self):
+        """ Delete the Payments matching filters and keep the counters right """
+        Payment.create_many([Payment(customer_id=customer_id, order_id=order_id, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=False)
+                             for customer_id in (1, 2) for order_id in range(5)])
+        Payment.init_counters()
+        try:
+            self.assertEqual(Payment.delete_many(chunk_size=2, customer_id=1), 5)
+            self.assertEqual(Payment.delete_by_id(6, version=2), 0)
+            self.assertEqual(Payment.delete_by_id(6), 1)
+            self.assertEqual(Payment.delete_by_id(6), 0)
+            self.assertEqual(set(Payment.statistics()), {(None, PaymentStatus.PAID, PaymentMethodType.CREDIT, 4)})
+        finally:
+            Payment.counters = False
+        self.assertEqual([payment.customer_id for payment in Payment.all()], [2] * 4)
+        self.assertRaises(DataValidationError, Payment.delete_many)
+
 
     def test_set_payment_default(self):
         """ Set a payment as default """
@@ -132,6 +194,29 @@ class TestPayments(unittest.TestCase):
         self.assertEqual(payment3.default_payment_type, False)
 
 
+    def test_set_default_for_customer(self):
+        """ Set a payment as the only default of its customer """
+        old = Payment(customer_id=12310, order_id=13151, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=True)
+        old.save()
+        new = Payment(customer_id=12310, order_id=13152, payment_method_type=PaymentMethodType.DEBIT, payment_status=PaymentStatus.PAID, default_payment_type=False)
+        new.save()
+        other = Payment(customer_id=12311, order_id=13153, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=True)
+        other.save()
+        payment = Payment.set_default_for_customer(new.id)
+        self.assertEqual(payment.id, new.id)
+        self.assertEqual(payment.default_payment_type, True)
+        self.assertEqual(Payment.find(old.id).default_payment_type, False)
+        self.assertEqual(Payment.find(other.id).default_payment_type, True)
+        self.assertIsNone(Payment.set_default_for_customer(0))
+
+    def test_set_default_for_customer_keeps_moving(self):
+        """ Give up when the Payment is never among the locked Payments of its customer """
+        payment = Payment(customer_id=12310, order_id=13151, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=False)
+        payment.save()
+        # every lock finds the Payment gone to another customer
+        with patch.object(ShardQuery, 'all', return_value=[]):
+            self.assertRaises(Conflict, Payment.set_default_for_customer, payment.id)
+
     def test_delete_a_payment(self):
         """ Delete a Payment """
         payment = Payment(customer_id=12310, order_id = 13159, payment_method_type = PaymentMethodType.CREDIT, payment_status = PaymentStatus.PAID,  default_payment_type = False)
@@ -183,11 +268,268 @@ class TestPayments(unittest.TestCase):
     def test_get_deault_payment_type(self):
         payment1 = Payment(customer_id=12310, order_id = 13159, payment_method_type = PaymentMethodType.CREDIT, payment_status = PaymentStatus.PAID,  default_payment_type = True)
         payment1.save()
-        payment2 = Payment(customer_id=12310, order_id = 13159, payment_method_type = PaymentMethodType.CREDIT, payment_status = PaymentStatus.PAID,  default_payment_type = True)
+        payment2 = Payment(customer_id=12311, order_id = 13159, payment_method_type = PaymentMethodType.CREDIT, payment_status = PaymentStatus.PAID,  default_payment_type = True)
         payment2.save()
         payments = Payment.get_default_payment_type();
         self.assertEqual(len(payments), 2)
         
+    def test_all_with_keyset_pagination(self):
+        """ Page through Payments with limit and after """
+        for order_id in range(5):
+            Payment(customer_id=12310, order_id=order_id, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=False).save()
+        page = Payment.all(limit=2)
+        self.assertEqual([p.id for p in page], [1, 2])
+        page = Payment.all(limit=2, after=page[-1].id)
+        self.assertEqual([p.id for p in page], [3, 4])
+        page = Payment.find_by_customer_id(12310, limit=2, after=4)
+        self.assertEqual([p.id for p in page], [5])
+        self.assertEqual(Payment.estimated_count(), 5)
+        self.assertEqual(Payment.estimated_count(customer_id=99999), 0)
+
+    def test_one_default_per_customer(self):
+        """ Only one default Payment is allowed per customer """
+        old = Payment(customer_id=12310, order_id=13159, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=True)
+        old.save()
+        # a new default replaces the old one
+        payment = Payment(customer_id=12310, order_id=13160, payment_method_type=PaymentMethodType.DEBIT, payment_status=PaymentStatus.PAID, default_payment_type=True)
+        payment.save()
+        old_id, payment_id = old.id, payment.id
+        db.session.remove()
+        self.assertEqual(Payment.find(old_id).default_payment_type, False)
+        self.assertEqual(Payment.find(payment_id).default_payment_type, True)
+        # the unique index rejects a second default written behind its back
+        self.assertRaises(IntegrityError, db.session.execute, Payment.__table__.insert(), dict(
+            customer_id=12310, order_id=13161, payment_method_type=PaymentMethodType.PAYPAL,
+            payment_status=PaymentStatus.PAID, default_payment_type=True))
+        db.session.rollback()
+
+    def test_finders_use_indexes(self):
+        """ Every finder is answered from an index, never a full table scan """
+        # give the planner a realistic table: many customers, few defaults
+        db.session.execute(Payment.__table__.insert(), [
+            dict(customer_id=i, order_id=i, payment_method_type=PaymentMethodType.CREDIT,
+                 payment_status=PaymentStatus.PAID, default_payment_type=(i % 20 == 0))
+            for i in range(200)])
+        db.session.commit()
+        db.session.execute('ANALYZE')
+        db.session.commit()
+        self.assert_index_scan(Payment.find_by_customer_id, 12310)
+        self.assert_index_scan(Payment.find_by_customer_id, 12310, 10, 5)
+        self.assert_index_scan(Payment.find_by_order_id, 13151)
+        self.assert_index_scan(Payment.find_by_payment_status, PaymentStatus.PAID)
+        self.assert_index_scan(Payment.find_by_payment_method_type, PaymentMethodType.CREDIT)
+        self.assert_index_scan(Payment.get_default_payment_type)
+        self.assert_index_scan(Payment.search, customer_id=[12310, 12311], payment_status=PaymentStatus.PAID)
+        self.assert_index_scan(Payment.search, 10, (13151, 5), sort='-order_id')
+
+    def assert_index_scan(self, finder, *args, **kwargs):
+        """ Runs EXPLAIN on the statement issued by a finder """
+        statements = []
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            finder(*args, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        statement, parameters = statements[-1]
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if db.engine.dialect.name == 'postgresql':
+                # tiny test tables would always be scanned sequentially; SET LOCAL
+                # ends with the transaction, which is rolled back when the
+                # connection goes back to the pool
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + statement, parameters)
+            else:
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan = '\n'.join(str(row[-1]) for row in cursor.fetchall())
+        finally:
+            connection.close()
+        self.assertIsNone(SEQUENTIAL_SCAN.search(plan),
+                          '{} falls back to a table scan:\n{}'.format(finder.__name__, plan))
+
+    def test_validate_a_payment(self):
+        """ Validate and normalize a deserialized Payment """
+        data = {"customer_id": 12311, "order_id": 11158, "payment_method_type": "CREDIT", "payment_status": "PAID", "default_payment_type": False}
+        payment = Payment().deserialize(data).validate()
+        self.assertEqual(payment.payment_method_type, PaymentMethodType.CREDIT)
+        self.assertEqual(payment.payment_status, PaymentStatus.PAID)
+        for field, value in (('customer_id', '12311'), ('order_id', None),
+                             ('payment_method_type', 'CASH'), ('payment_status', ''),
+                             ('default_payment_type', 'yes')):
+            bad = dict(data)
+            bad[field] = value
+            payment = Payment().deserialize(bad)
+            self.assertRaises(DataValidationError, payment.validate)
+
+    def test_create_many_payments(self):
+        """ Insert many Payments in chunks and return their ids """
+        Payment(customer_id=12310, order_id=1, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=False).save()
+        payments = [Payment(customer_id=12311, order_id=order_id, payment_method_type=PaymentMethodType.DEBIT, payment_status=PaymentStatus.UNPAID, default_payment_type=False)
+                    for order_id in range(7)]
+        ids = Payment.create_many(payments, chunk_size=3)
+        self.assertEqual(ids, list(range(2, 9)))
+        self.assertEqual([p.order_id for p in Payment.find_by_customer_id(12311)], list(range(7)))
+        self.assertEqual(Payment.find(ids[-1]).order_id, 6)
+
+    def test_create_many_within_sqlite_limit(self):
+        """ Keep a chunk within the bound parameters an older SQLite allows """
+        if db.engine.dialect.name != 'sqlite':
+            self.skipTest('only SQLite limits the bound parameters')
+        inserts = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT INTO payment '):
+                inserts.append(len(parameters))
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            payments = [Payment(customer_id=12311, order_id=order_id, payment_method_type=PaymentMethodType.DEBIT, payment_status=PaymentStatus.UNPAID, default_payment_type=False)
+                        for order_id in range(300)]
+            ids = Payment.create_many(payments)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(ids, list(range(1, 301)))
+        self.assertEqual(inserts, [996, 804])
+
+    def test_inserted_ids_on_db2(self):
+        """ Insert the rows of a chunk on DB2 with one statement that returns their ids """
+        from ibm_db_sa.base import DB2Dialect
+        rows = [dict(customer_id=12311, order_id=order_id, payment_status=PaymentStatus.PAID)
+                for order_id in range(2)]
+        compiled = InsertedIds(Payment.__table__, rows).compile(dialect=DB2Dialect())
+        self.assertEqual(str(compiled), 'SELECT id FROM FINAL TABLE (INSERT INTO payment '
+                         '(customer_id, order_id, payment_status) VALUES (?, ?, ?), (?, ?, ?)) '
+                         'ORDER BY INPUT SEQUENCE')
+        self.assertEqual([compiled.params[name] for name in compiled.positiontup],
+                         [12311, 0, PaymentStatus.PAID, 12311, 1, PaymentStatus.PAID])
+
+    def test_transition_status(self):
+        """ Move Payments from one status to another """
+        for order_id, payment_status in enumerate([PaymentStatus.PROCESSING, PaymentStatus.PROCESSING,
+                                                   PaymentStatus.UNPAID, PaymentStatus.PROCESSING]):
+            Payment(customer_id=12310 + order_id % 2, order_id=order_id, payment_method_type=PaymentMethodType.CREDIT, payment_status=payment_status, default_payment_type=False).save()
+        updated, skipped = Payment.transition_status(PaymentStatus.PROCESSING, PaymentStatus.PAID, [1, 3, 99], chunk_size=2)
+        self.assertEqual(updated, 1)
+        self.assertEqual(skipped, [3, 99])
+        self.assertEqual(Payment.find(1).payment_status, PaymentStatus.PAID)
+        self.assertEqual(Payment.find(3).payment_status, PaymentStatus.UNPAID)
+        updated, skipped = Payment.transition_status(PaymentStatus.PROCESSING, PaymentStatus.PAID, chunk_size=1, customer_id=12311)
+        self.assertEqual((updated, skipped), (2, []))
+        self.assertEqual(len(Payment.find_by_payment_status(PaymentStatus.PAID)), 3)
+
+    def test_cached_lookups(self):
+        """ Serve lookups from the cache and drop them after writes """
+        Payment.init_cache(maxsize=100, ttl=60)
+        try:
+            payment = Payment(customer_id=12310, order_id=13151, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=False)
+            payment.save()
+            other = Payment(customer_id=12310, order_id=13152, payment_method_type=PaymentMethodType.DEBIT, payment_status=PaymentStatus.PAID, default_payment_type=False)
+            other.save()
+            self.assertEqual(Payment.find(payment.id).order_id, 13151)
+            self.assertEqual(len(Payment.find_by_customer_id(12310)), 2)
+            self.assertEqual(Payment.cache.misses, 2)
+            db.session.remove()
+            cached = Payment.find(payment.id)
+            self.assertEqual(cached.order_id, 13151)
+            self.assertEqual(len(Payment.find_by_customer_id('12310')), 2)
+            self.assertEqual(Payment.cache.hits, 2)
+            # a cached Payment can still be updated
+            cached.payment_status = PaymentStatus.UNPAID
+            cached.save()
+            self.assertEqual(Payment.find(payment.id).payment_status, PaymentStatus.UNPAID)
+            self.assertEqual(Payment.find_by_customer_id(12310)[0].payment_status, PaymentStatus.UNPAID)
+            # set based writes drop the Payments they touched
+            Payment.set_default_for_customer(other.id)
+            self.assertEqual(Payment.find(other.id).default_payment_type, True)
+            Payment.transition_status(PaymentStatus.UNPAID, PaymentStatus.PAID, [payment.id])
+            self.assertEqual(Payment.find(payment.id).payment_status, PaymentStatus.PAID)
+            Payment.create_many([Payment(customer_id=12310, order_id=13153, payment_method_type=PaymentMethodType.DEBIT, payment_status=PaymentStatus.PAID, default_payment_type=False)])
+            self.assertEqual(len(Payment.find_by_customer_id(12310)), 3)
+            Payment.find(other.id).delete()
+            self.assertIsNone(Payment.find(other.id))
+            self.assertEqual(len(Payment.find_by_customer_id(12310)), 2)
+        finally:
+            Payment.cache = None
+
+    def test_cached_lookups_skip_stale_reads(self):
+        """ Do not cache a lookup that raced a write """
+        Payment.init_cache(maxsize=100, ttl=60)
+        try:
+            payment = Payment(customer_id=12310, order_id=13151, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=False)
+            payment.save()
+            payment_id = payment.id
+            db.session.remove()
+            get = ShardQuery.get
+            def racing_get(query, id):
+                """ Reads the row, then another request writes it before the cache is filled """
+                found = get(query, id)
+                Payment.invalidate(('payment', id))
+                return found
+            with patch.object(ShardQuery, 'get', racing_get):
+                Payment.find(payment_id)
+            self.assertEqual(len(Payment.cache), 0)
+            # a client reading its own writes goes to the database
+            Payment.find(payment_id)
+            with app.test_request_context(headers={'X-Primary-Until': '%.3f' % (time.time() + 1)}):
+                Payment.find(payment_id)
+                Payment.find_by_customer_id(12310)
+            self.assertEqual((Payment.cache.hits, len(Payment.cache)), (0, 1))
+        finally:
+            Payment.cache = None
+
+    def test_search_with_filters_and_sort(self):
+        """ Search Payments with combined filters and a sort order """
+        for order_id, customer_id, payment_status in ((3, 1, PaymentStatus.PAID), (1, 2, PaymentStatus.PAID),
+                                                      (2, 2, PaymentStatus.UNPAID), (4, 3, PaymentStatus.PAID)):
+            Payment(customer_id=customer_id, order_id=order_id, payment_method_type=PaymentMethodType.CREDIT, payment_status=payment_status, default_payment_type=False).save()
+        payments = Payment.search(customer_id=[1, 2], payment_status=PaymentStatus.PAID, sort='order_id')
+        self.assertEqual([p.order_id for p in payments], [1, 3])
+        payments = Payment.search(limit=2, sort='-order_id')
+        self.assertEqual([p.order_id for p in payments], [4, 3])
+        payments = Payment.search(limit=2, after=payments[-1].cursor('-order_id'), sort='-order_id')
+        self.assertEqual([p.order_id for p in payments], [2, 1])
+        self.assertEqual(Payment.estimated_count(customer_id=[2, 3]), 3)
+        self.assertRaises(DataValidationError, Payment.search, name='x')
+        self.assertRaises(DataValidationError, Payment.search, sort='payment_status')
+
+    def test_statistics(self):
+        """ Count Payments per status and method type, per customer too """
+        for customer_id, payment_method_type, payment_status in ((1, PaymentMethodType.CREDIT, PaymentStatus.PAID),
+                                                                 (1, PaymentMethodType.DEBIT, PaymentStatus.PAID),
+                                                                 (2, PaymentMethodType.CREDIT, PaymentStatus.PAID),
+                                                                 (2, PaymentMethodType.CREDIT, PaymentStatus.UNPAID)):
+            Payment(customer_id=customer_id, order_id=1, payment_method_type=payment_method_type, payment_status=payment_status, default_payment_type=False).save()
+        self.assertEqual(set(Payment.statistics()),
+                         {(None, PaymentStatus.UNPAID, PaymentMethodType.CREDIT, 1),
+                          (None, PaymentStatus.PAID, PaymentMethodType.CREDIT, 2),
+                          (None, PaymentStatus.PAID, PaymentMethodType.DEBIT, 1)})
+        self.assertEqual(set(Payment.statistics([2, 3])),
+                         {(2, PaymentStatus.UNPAID, PaymentMethodType.CREDIT, 1),
+                          (2, PaymentStatus.PAID, PaymentMethodType.CREDIT, 1)})
+
+    def test_statistics_from_counters(self):
+        """ Keep the counters in step with every kind of write """
+        Payment(customer_id=1, order_id=1, payment_method_type="CREDIT", payment_status="PAID", default_payment_type=False).save()
+        Payment.init_counters()
+        try:
+            payment = Payment(customer_id=1, order_id=2, payment_method_type="DEBIT", payment_status="PROCESSING", default_payment_type=False)
+            payment.save()
+            payment.payment_method_type = PaymentMethodType.PAYPAL
+            payment.save()
+            Payment.create_many([Payment(customer_id=2, order_id=order_id, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PROCESSING, default_payment_type=False)
+                                 for order_id in range(3)])
+            Payment.transition_status(PaymentStatus.PROCESSING, PaymentStatus.PAID, customer_id=2)
+            Payment.find(1).delete()
+            Payment.counters = False
+            counted = set(Payment.statistics())
+            Payment.counters = True
+            self.assertEqual(set(Payment.statistics()), counted)
+            self.assertEqual(counted, {(None, PaymentStatus.PROCESSING, PaymentMethodType.PAYPAL, 1),
+                                       (None, PaymentStatus.PAID, PaymentMethodType.CREDIT, 3)})
+        finally:
+            Payment.counters = False
+
     def test_deserialize_bad_data(self):
         """ Test deserialization of bad data """
         data = "this is not a dictionary"
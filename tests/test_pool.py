@@ -0,0 +1,64 @@
+import os
+import sqlite3
+import unittest
+from mock import patch
+from sqlalchemy.exc import TimeoutError
+from app.pool import TimedQueuePool, pool_stats
+from app.vcap_services import get_pool_size
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestTimedQueuePool(unittest.TestCase):
+    """ Test Cases for the measured connection pool """
+
+    def setUp(self):
+        self.pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'),
+                                   pool_size=1, max_overflow=1, timeout=0.05)
+
+    def tearDown(self):
+        self.pool.dispose()
+
+    def test_count_checkouts(self):
+        """ Count checkouts and report the connections in use """
+        first = self.pool.connect()
+        second = self.pool.connect()
+        stats = self.pool.stats()
+        self.assertEqual((stats['checkouts'], stats['checked_out'], stats['overflow']), (2, 2, 1))
+        self.assertEqual((stats['waits'], stats['timeouts']), (0, 0))
+        first.close()
+        second.close()
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+
+    def test_count_waits_and_timeouts(self):
+        """ Count the checkouts that wait for a full pool and time out """
+        connections = [self.pool.connect(), self.pool.connect()]
+        self.assertRaises(TimeoutError, self.pool.connect)
+        stats = self.pool.stats()
+        self.assertEqual((stats['waits'], stats['timeouts']), (1, 1))
+        self.assertGreaterEqual(stats['max_wait_time'], 0.05)
+        for connection in connections:
+            connection.close()
+
+    def test_stats_of_other_pools(self):
+        """ Report the class of pools without counters """
+        self.assertEqual(pool_stats(object()), {'pool': 'object'})
+
+
+class TestPoolSize(unittest.TestCase):
+    """ Test Cases for the pool size of each worker """
+
+    @patch.dict(os.environ, {}, clear=True)
+    def test_default_pool_size(self):
+        """ Keep 5 connections and 5 overflow by default """
+        self.assertEqual(get_pool_size(), (5, 5))
+
+    @patch.dict(os.environ, {'DB_CONNECTION_LIMIT': '100', 'WEB_CONCURRENCY': '4'}, clear=True)
+    def test_pool_size_from_connection_limit(self):
+        """ Share the connection limit between the workers """
+        self.assertEqual(get_pool_size(), (12, 13))
+
+    @patch.dict(os.environ, {'DB_CONNECTION_LIMIT': '100', 'DB_POOL_SIZE': '3'}, clear=True)
+    def test_explicit_pool_size(self):
+        """ Prefer DB_POOL_SIZE over the connection limit """
+        self.assertEqual(get_pool_size(), (3, 50))
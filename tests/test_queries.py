@@ -0,0 +1,97 @@
+"""
+Test cases for the query instrumentation
+"""
+import unittest
+from flask import Flask
+from mock import MagicMock
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from app.queries import QueryInstrumentation, QueryLog, parameter_shape
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestQueryInstrumentation(unittest.TestCase):
+    """ Test Cases for counting and logging statements """
+
+    def setUp(self):
+        self.logger = MagicMock()
+        self.queries = QueryInstrumentation(slow_seconds=0, repeat_threshold=2, logger=self.logger)
+        self.connection = MagicMock(info={})
+
+    def execute(self, statement, parameters=(), executemany=False):
+        """ Fires the engine events of one statement """
+        self.queries._before_execute(self.connection, None, statement, parameters, None, executemany)
+        self.queries._after_execute(self.connection, None, statement, parameters, None, executemany)
+
+    def test_record(self):
+        """ Count the statements of the current thread only while recording """
+        self.execute('SELECT 1')
+        with self.queries.record() as log:
+            self.execute('SELECT 1')
+            self.execute('SELECT 2')
+            self.execute('SELECT 1')
+        self.execute('SELECT 2')
+        self.assertEqual(log.count, 3)
+        self.assertGreaterEqual(log.seconds, 0)
+        self.assertEqual(log.repeated(2), [('SELECT 1', 2)])
+
+    def test_slow_statements(self):
+        """ Log slow statements with the types of their parameters """
+        self.execute('UPDATE payment SET payment_status=? WHERE id=?', ('PAID', 7))
+        args = self.logger.warning.call_args[0]
+        self.assertEqual(args[2], '(str, int)')
+        self.assertNotIn(('PAID', 7), args)
+        self.queries.slow_seconds = 10
+        self.logger.reset_mock()
+        self.execute('SELECT 1')
+        self.assertFalse(self.logger.warning.called)
+
+    def test_parameter_shape(self):
+        """ Describe parameters without their values """
+        self.assertEqual(parameter_shape({'id_1': 7, 'status': u'PAID'}), '{id_1: int, status: unicode}')
+        self.assertEqual(parameter_shape([(1, 'a'), (2, 'b')], executemany=True), '2 x (int, str)')
+        self.assertEqual(parameter_shape(None), '()')
+
+    def test_repeated_in_request(self):
+        """ Warn about a statement run over and over in one request """
+        app = Flask(__name__)
+        self.queries.init_app(app)
+        try:
+            with app.test_request_context('/payments'):
+                app.preprocess_request()
+                self.execute('SELECT * FROM payment WHERE id = ?', (1,))
+                self.execute('SELECT * FROM payment WHERE id = ?', (2,))
+                self.logger.reset_mock()
+                app.do_teardown_request()
+        finally:
+            self.remove_listeners()
+        self.logger.warning.assert_called_once_with(
+            'Statement run %s times in one request (N+1?): %s', 2, 'SELECT * FROM payment WHERE id = ?')
+
+    def test_failed_statement(self):
+        """ Forget the start of a statement that failed """
+        self.queries.init_app(Flask(__name__))
+        try:
+            connection = create_engine('sqlite://').connect()
+            self.assertRaises(OperationalError, connection.execute, 'SELECT * FROM missing')
+            self.assertEqual(connection.info['query_start'], [])
+            connection.execute('SELECT 1')
+            self.assertEqual(connection.info['query_start'], [])
+            connection.close()
+        finally:
+            self.remove_listeners()
+
+    def remove_listeners(self):
+        """ Stops listening to the statements of every engine """
+        event.remove(Engine, 'before_cursor_execute', self.queries._before_execute)
+        event.remove(Engine, 'after_cursor_execute', self.queries._after_execute)
+        event.remove(Engine, 'handle_error', self.queries._execute_failed)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import json
+import unittest
+from flask_restplus import marshal
+from app.models import Payment, PaymentMethodType, PaymentStatus
+from app.serializers import JSONSerializer
+from app.service import payment_model
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestJSONSerializer(unittest.TestCase):
+    """ Test Cases for the JSON serializers """
+
+    def setUp(self):
+        self.serializer = JSONSerializer(payment_model, [PaymentStatus, PaymentMethodType])
+        self.payments = [
+            Payment(id=1, customer_id=12310, order_id=13151, payment_method_type=PaymentMethodType.CREDIT, payment_status=PaymentStatus.PAID, default_payment_type=True),
+            Payment(id=2, customer_id=12311, order_id=13152, payment_method_type=PaymentMethodType.PAYPAL, payment_status=None, default_payment_type=False),
+            Payment(customer_id=12312, order_id=13153, payment_method_type="DEBIT", payment_status="UNPAID")
+        ]
+
+    def test_dumps_matches_marshal(self):
+        """ Serialize a Payment like marshal and json.dumps """
+        for payment in self.payments:
+            expected = marshal(payment.serialize(), payment_model)
+            self.assertEqual(json.loads(self.serializer.dumps(payment)), expected)
+
+    def test_dumps_list(self):
+        """ Serialize a list of Payments """
+        data = json.loads(self.serializer.dumps_list(self.payments))
+        self.assertEqual([item['id'] for item in data], [1, 2, None])
+        self.assertEqual(data[0]['payment_status'], 'PaymentStatus.PAID')
+        self.assertEqual(data[1]['payment_method_type'], 'PaymentMethodType.PAYPAL')
+        self.assertEqual(json.loads(self.serializer.dumps_list([])), [])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,11 @@ import unittest
 import os
 import json
 import logging
+import threading
 from flask_api import status    # HTTP Status Codes
 from mock import MagicMock, patch
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 
 from app.models import Payment, PaymentMethodType, PaymentStatus, db
 import app.service as service
@@ -67,6 +70,55 @@ class TestPaymentServer(unittest.TestCase):
         self.assertEqual(len(data), 4)
 
 
+    def test_get_payments_page(self):
+        """ Get a page of Payments with a next cursor """
+        resp = self.app.get('/payments', query_string='limit=3&count=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 3)
+        self.assertEqual(resp.headers['X-Total-Count'], '4')
+        cursor = resp.headers.get('X-Next-Cursor')
+        self.assertEqual(cursor, str(data[-1]['id']))
+        self.assertIn('rel="next"', resp.headers['Link'])
+        resp = self.app.get('/payments', query_string='limit=3&after=' + cursor)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+
+
+    def test_get_payments_page_size_is_capped(self):
+        """ Get Payments with a limit above the maximum page size """
+        service.app.config['MAX_PAGE_SIZE'] = 2
+        try:
+            resp = self.app.get('/payments', query_string='limit=1000')
+        finally:
+            service.app.config['MAX_PAGE_SIZE'] = 1000
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 2)
+        self.assertIn('X-Next-Cursor', resp.headers)
+
+
+    def test_get_payments_bad_page_args(self):
+        """ Get Payments with an invalid limit """
+        resp = self.app.get('/payments', query_string='limit=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/payments', query_string='limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_get_payments_ndjson_stream(self):
+        """ Stream Payments as newline delimited JSON """
+        resp = self.app.get('/payments', query_string='payment_status=PAID',
+                            headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 3)
+        data = [json.loads(line) for line in lines]
+        self.assertEqual(data[0]['payment_status'], 'PaymentStatus.PAID')
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+
+
     def test_get_payment_by_order_id(self):
         """ Get Payment by Order Id """
         # get the id of a payment
@@ -102,6 +154,140 @@ class TestPaymentServer(unittest.TestCase):
         self.assertEqual(len(data), all_payments_count + 1)
         self.assertIn(new_json, data)
 
+    def test_create_payment_idempotent(self):
+        """ Replay the first response to a retried POST with an Idempotency-Key """
+        all_payments_count = self.get_all_payments_count()
+        new_payment = dict(customer_id=53121, order_id=15190, payment_method_type="DEBIT", payment_status="PAID", default_payment_type=False)
+        headers = {'Idempotency-Key': 'order-15190'}
+        first = self.app.post('/payments', data=json.dumps(new_payment),
+                              content_type='application/json', headers=headers)
+        self.assertEqual(first.status_code, HTTP_201_CREATED)
+        # storing the response did not write the new Payment a second time
+        payment_id = json.loads(first.data)['id']
+        self.assertEqual(self.app.get(first.headers['Location']).headers['ETag'],
+                         '"{}-1"'.format(payment_id))
+        # the same body with its keys in another order is the same request
+        retry = self.app.post('/payments', data=json.dumps(new_payment, sort_keys=True),
+                              content_type='application/json', headers=headers)
+        self.assertEqual(retry.status_code, HTTP_201_CREATED)
+        self.assertEqual(json.loads(retry.data), json.loads(first.data))
+        self.assertEqual(retry.headers['Location'], first.headers['Location'])
+        self.assertEqual(retry.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(json.loads(retry.data), json.loads(self.app.get(first.headers['Location']).data))
+        self.assertEqual(self.get_all_payments_count(), all_payments_count + 1)
+        # reusing the key for another Payment is refused
+        new_payment['order_id'] = 15191
+        resp = self.app.post('/payments', data=json.dumps(new_payment),
+                             content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, 422)
+        resp = self.app.post('/payments', data=json.dumps(new_payment),
+                             content_type='application/json', headers={'Idempotency-Key': 'x' * 256})
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_all_payments_count(), all_payments_count + 1)
+
+    def test_create_payment_idempotent_race(self):
+        """ Collapse concurrent POSTs with the same Idempotency-Key """
+        new_payment = dict(customer_id=53121, order_id=15190, payment_method_type="DEBIT", payment_status="PAID", default_payment_type=False)
+        headers = {'Idempotency-Key': 'order-15190'}
+        first = self.app.post('/payments', data=json.dumps(new_payment),
+                              content_type='application/json', headers=headers)
+        count = self.get_all_payments_count()
+        # the second request looks the key up before the first one stored it
+        find = service.IdempotencyKey.find
+        lookups = []
+        def late_find(key):
+            lookups.append(key)
+            return None if len(lookups) == 1 else find(key)
+        with patch.object(service.IdempotencyKey, 'find', side_effect=late_find):
+            retry = self.app.post('/payments', data=json.dumps(new_payment),
+                                  content_type='application/json', headers=headers)
+        self.assertEqual(retry.status_code, HTTP_201_CREATED)
+        self.assertEqual(json.loads(retry.data)['id'], json.loads(first.data)['id'])
+        self.assertEqual(self.get_all_payments_count(), count)
+
+    def test_idempotency_key_expires(self):
+        """ Create a new Payment once the Idempotency-Key expired """
+        new_payment = dict(customer_id=53121, order_id=15190, payment_method_type="DEBIT", payment_status="PAID", default_payment_type=False)
+        headers = {'Idempotency-Key': 'order-15190'}
+        ttl = service.IdempotencyKey.ttl
+        service.IdempotencyKey.ttl = 0
+        try:
+            first = self.app.post('/payments', data=json.dumps(new_payment),
+                                  content_type='application/json', headers=headers)
+            retry = self.app.post('/payments', data=json.dumps(new_payment),
+                                  content_type='application/json', headers=headers)
+            self.assertNotEqual(json.loads(retry.data)['id'], json.loads(first.data)['id'])
+            # the retry stored the key again, already expired
+            self.assertEqual(service.IdempotencyKey.purge(), 1)
+        finally:
+            service.IdempotencyKey.ttl = ttl
+
+
+    def test_create_payment_batch(self):
+        """ Creates a batch of Payments """
+        batch = [dict(customer_id=53121, order_id=order_id, payment_method_type="DEBIT", payment_status="PAID", default_payment_type=False)
+                 for order_id in range(3)]
+        resp = self.app.post('/payments/batch',
+                             data=json.dumps(batch),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = json.loads(resp.data)
+        self.assertEqual([item['index'] for item in data], [0, 1, 2])
+        self.assertEqual([item['status'] for item in data], [201] * 3)
+        self.assertEqual(Payment.find(data[2]['id']).order_id, 2)
+        self.assertEqual(self.get_all_payments_count(), 7)
+
+
+    def test_create_payment_batch_ndjson(self):
+        """ Creates a batch of Payments from an NDJSON stream """
+        lines = [json.dumps(dict(customer_id=53121, order_id=order_id, payment_method_type="CREDIT", payment_status="UNPAID", default_payment_type=False))
+                 for order_id in range(2)]
+        resp = self.app.post('/payments/batch',
+                             data='\n'.join(lines) + '\n',
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+        self.assertEqual(len(Payment.find_by_customer_id(53121)), 2)
+
+
+    def test_create_payment_batch_ndjson_too_large(self):
+        """ Stop reading an NDJSON stream once it holds too many Payments """
+        line = json.dumps(dict(customer_id=53121, order_id=1, payment_method_type="CREDIT", payment_status="UNPAID", default_payment_type=False))
+        max_batch_size = service.app.config['MAX_BATCH_SIZE']
+        service.app.config['MAX_BATCH_SIZE'] = 2
+        try:
+            # the line past the limit is never parsed
+            resp = self.app.post('/payments/batch', data='\n'.join([line, line, '{not json']),
+                                 content_type='application/x-ndjson')
+        finally:
+            service.app.config['MAX_BATCH_SIZE'] = max_batch_size
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(len(Payment.find_by_customer_id(53121)), 0)
+
+
+    def test_create_payment_batch_with_bad_item(self):
+        """ A batch with one bad Payment creates nothing """
+        batch = [dict(customer_id=53121, order_id=1, payment_method_type="DEBIT", payment_status="PAID", default_payment_type=False),
+                 dict(customer_id=53121, order_id=2, payment_method_type="CASH", payment_status="PAID", default_payment_type=False),
+                 dict(customer_id=53121, payment_method_type="DEBIT", payment_status="PAID", default_payment_type=False)]
+        resp = self.app.post('/payments/batch',
+                             data=json.dumps(batch),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        data = json.loads(resp.data)
+        self.assertEqual([item['status'] for item in data], [201, 400, 400])
+        self.assertIn('payment_method_type', data[1]['message'])
+        self.assertIn('order_id', data[2]['message'])
+        self.assertEqual(self.get_all_payments_count(), 4)
+
+
+    def test_create_payment_batch_bad_content(self):
+        """ Creates a batch of Payments with a bad body """
+        resp = self.app.post('/payments/batch', data='{}', content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/payments/batch', data='[]', content_type='text/plain')
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
 
     def test_query_payment_list_by_customer_id(self):
         """ Query Payments by customer_id """
@@ -151,6 +337,40 @@ class TestPaymentServer(unittest.TestCase):
         self.assertEqual(query_item['payment_method_type'], 'PaymentMethodType.CREDIT')
 
 
+    def test_query_payment_list_with_combined_filters(self):
+        """ Query Payments by customer_id and payment_status together """
+        resp = self.app.get('/payments', query_string='customer_id=14121&payment_status=PAID')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([item['order_id'] for item in data], [11122])
+        resp = self.app.get('/payments', query_string='customer_id=12302,14121&payment_method_type=CREDIT,PAYPAL')
+        data = json.loads(resp.data)
+        self.assertEqual(sorted(item['order_id'] for item in data), [11122, 11150, 15189])
+        resp = self.app.get('/payments', query_string='default_payment_type=false&order_id=12143')
+        self.assertEqual(len(json.loads(resp.data)), 1)
+
+
+    def test_query_payment_list_sorted(self):
+        """ Query Payments sorted by order_id across pages """
+        resp = self.app.get('/payments', query_string='sort=-order_id&limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([item['order_id'] for item in data], [15189, 12143])
+        cursor = resp.headers['X-Next-Cursor']
+        self.assertEqual(cursor, '12143,{}'.format(data[-1]['id']))
+        resp = self.app.get('/payments', query_string={'sort': '-order_id', 'limit': 2, 'after': cursor})
+        data = json.loads(resp.data)
+        self.assertEqual([item['order_id'] for item in data], [11150, 11122])
+
+
+    def test_query_payment_list_bad_filters(self):
+        """ Query Payments with invalid filters """
+        for query in ('payment_status=DONE', 'order_id=1,x', 'default_payment_type=maybe',
+                      'sort=payment_status', 'sort=order_id&after=5'):
+            resp = self.app.get('/payments', query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+
     def test_get_payment(self):
         """ Get a single Payment """
         # get id of the payment
@@ -166,6 +386,39 @@ class TestPaymentServer(unittest.TestCase):
         self.assertEqual(data['customer_id'], payment.customer_id)
 
 
+    def test_get_payment_not_modified(self):
+        """ Get a Payment again with its ETag """
+        resp = self.app.get('/payments/1')
+        etag = resp.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        resp = self.app.get('/payments/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(len(resp.data), 0)
+        # the ETag changes with the Payment
+        resp = self.app.put('/payments/1/default')
+        resp = self.app.get('/payments/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+
+    def test_get_payments_list_not_modified(self):
+        """ Get a filtered list of Payments again with its ETag """
+        resp = self.app.get('/payments', query_string='customer_id=12302')
+        etag = resp.headers.get('ETag')
+        resp = self.app.get('/payments', query_string='customer_id=12302',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get('/payments', query_string='customer_id=14121',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        Payment(customer_id=12302, order_id=1, payment_method_type="CREDIT", payment_status="UNPAID", default_payment_type=False).save()
+        resp = self.app.get('/payments', query_string='customer_id=12302',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 3)
+
+
     def test_get_payment_not_found(self):
         """ Get a Payment thats not found """
         resp = self.app.get('/payments/0')
@@ -214,11 +467,64 @@ class TestPaymentServer(unittest.TestCase):
         self.assertEqual(temp4.default_payment_type, True)
 
 
+    def test_set_default_concurrently(self):
+        """ Parallel set default requests leave exactly one default """
+        ids = [payment.id for payment in Payment.find_by_customer_id(12302)]
+        for order_id in range(20):
+            payment = Payment(customer_id=12302, order_id=order_id, payment_method_type="CREDIT", payment_status="PAID", default_payment_type=False)
+            payment.save()
+            ids.append(payment.id)
+        db.session.remove()
+        codes = []
+        def set_default(payment_id):
+            client = service.app.test_client()
+            codes.append(client.put('/payments/{}/default'.format(payment_id)).status_code)
+        threads = [threading.Thread(target=set_default, args=(payment_id,)) for payment_id in ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(codes, [status.HTTP_200_OK] * len(ids))
+        defaults = [p for p in Payment.find_by_customer_id(12302) if p.default_payment_type]
+        self.assertEqual(len(defaults), 1)
+
+
     def test_set_default_not_found(self):
         """ Sets a default payment with an invalid ID """
         resp = self.app.put('/payments/0/default')
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    @patch('app.service.Payment.set_default_for_customer')
+    def test_set_default_conflict(self, set_default_mock):
+        """ Answer 409 when the retries of set default run out """
+        set_default_mock.side_effect = IntegrityError('UPDATE payment', {}, Exception())
+        resp = self.app.put('/payments/1/default')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+    def test_create_and_update_default(self):
+        """ Replace the default of the customer when a Payment is posted or put as the default """
+        new_payment = dict(customer_id=12302, order_id=1, payment_method_type="CREDIT", payment_status="PAID", default_payment_type=True)
+        resp = self.app.post('/payments', data=json.dumps(new_payment), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        created = json.loads(resp.data)['id']
+        old = Payment.find_by_order_id(11150)[0].id
+        changed = dict(customer_id=12302, order_id=11150, payment_method_type="CREDIT", payment_status="PAID", default_payment_type=True)
+        resp = self.app.put('/payments/{}'.format(old), data=json.dumps(changed), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        defaults = [p.id for p in Payment.find_by_customer_id(12302) if p.default_payment_type]
+        self.assertEqual(defaults, [old])
+        self.assertEqual(Payment.find(created).version, 2)
+
+    @patch('app.service.Payment.save')
+    def test_create_and_update_default_conflict(self, save_mock):
+        """ Answer 409 when a concurrent write made another Payment the default """
+        save_mock.side_effect = IntegrityError('INSERT INTO payment', {}, Exception())
+        new_payment = dict(customer_id=12302, order_id=1, payment_method_type="CREDIT", payment_status="PAID", default_payment_type=True)
+        resp = self.app.post('/payments', data=json.dumps(new_payment), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.put('/payments/1', data=json.dumps(new_payment), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
 
     def test_update_payment(self):
         """ Update an existing Payment Resource """
@@ -237,6 +543,150 @@ class TestPaymentServer(unittest.TestCase):
         self.assertEqual(new_json['payment_method_type'], 'PaymentMethodType.PAYPAL')
 
 
+    def test_update_payment_if_match(self):
+        """ Update a Payment only while it matches the If-Match ETag """
+        payment = Payment.find_by_order_id('15189')[0]
+        etag = self.app.get('/payments/{}'.format(payment.id)).headers['ETag']
+        test_payment = dict(customer_id=14121, order_id=15189, payment_method_type="PAYPAL", payment_status="PAID", default_payment_type=False)
+        resp = self.app.put('/payments/{}'.format(payment.id), data=json.dumps(test_payment),
+                            content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_etag = resp.headers['ETag']
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(self.app.get('/payments/{}'.format(payment.id)).headers['ETag'], new_etag)
+        # a writer holding the old ETag is refused
+        test_payment['payment_status'] = 'UNPAID'
+        resp = self.app.put('/payments/{}'.format(payment.id), data=json.dumps(test_payment),
+                            content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(Payment.find(payment.id).payment_status, PaymentStatus.PAID)
+
+    def test_update_payment_if_match_cached(self):
+        """ Check If-Match against the row, not a cached copy of the Payment """
+        payment_id = Payment.find_by_order_id('15189')[0].id
+        test_payment = dict(customer_id=14121, order_id=15189, payment_method_type="PAYPAL", payment_status="PAID", default_payment_type=False)
+        Payment.init_cache(maxsize=100, ttl=60)
+        try:
+            self.app.get('/payments/{}'.format(payment_id))
+            # another worker writes the Payment, this one still has the old version cached
+            db.engine.execute(db.text('UPDATE payment SET version = version + 1 WHERE id = :id'),
+                              id=payment_id)
+            etag = '"{}-2"'.format(payment_id)
+            resp = self.app.put('/payments/{}'.format(payment_id), data=json.dumps(test_payment),
+                                content_type='application/json', headers={'If-Match': etag})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.headers['ETag'], '"{}-3"'.format(payment_id))
+        finally:
+            Payment.cache = None
+
+    def test_update_payment_lost_race(self):
+        """ Refuse or retry an update that lost the race with another writer """
+        payment = Payment.find_by_order_id('15189')[0]
+        etag = self.app.get('/payments/{}'.format(payment.id)).headers['ETag']
+        test_payment = dict(customer_id=14121, order_id=15189, payment_method_type="PAYPAL", payment_status="PAID", default_payment_type=False)
+        save = Payment.save
+        def racing_save(self, *args):
+            # another writer commits between our read and our UPDATE
+            if not racing_save.raced:
+                racing_save.raced = True
+                db.engine.execute(db.text('UPDATE payment SET version = version + 1 WHERE id = :id'),
+                                  id=self.id)
+            return save(self, *args)
+        for headers, code in (({'If-Match': etag}, status.HTTP_412_PRECONDITION_FAILED),
+                              ({}, status.HTTP_200_OK)):
+            racing_save.raced = False
+            with patch.object(Payment, 'save', racing_save):
+                resp = self.app.put('/payments/{}'.format(payment.id), data=json.dumps(test_payment),
+                                    content_type='application/json', headers=headers)
+            self.assertEqual(resp.status_code, code)
+        self.assertEqual(Payment.find(payment.id).payment_method_type, PaymentMethodType.PAYPAL)
+
+
+    def test_patch_payment(self):
+        """ Change the status of a Payment with one UPDATE """
+        payment_id = Payment.find_by_order_id('15189')[0].id
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.split()[0])
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            resp = self.app.patch('/payments/{}'.format(payment_id),
+                                  data=json.dumps(dict(payment_status='PAID')),
+                                  content_type='application/json')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # SQLite has no RETURNING, so the row is read first
+        self.assertEqual(statements, ['SELECT', 'UPDATE'])
+        data = json.loads(resp.data)
+        self.assertEqual(data['payment_status'], 'PaymentStatus.PAID')
+        self.assertEqual(data['order_id'], 15189)
+        self.assertEqual(resp.headers['ETag'], self.app.get('/payments/{}'.format(payment_id)).headers['ETag'])
+        self.assertEqual(Payment.find(payment_id).payment_status, PaymentStatus.PAID)
+
+    def test_patch_payment_if_match(self):
+        """ Patch a Payment only while it matches the If-Match ETag """
+        payment_id = Payment.find_by_order_id('15189')[0].id
+        etag = self.app.get('/payments/{}'.format(payment_id)).headers['ETag']
+        patch_url = '/payments/{}'.format(payment_id)
+        resp = self.app.patch(patch_url, data=json.dumps(dict(payment_method_type='DEBIT')),
+                              content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.patch(patch_url, data=json.dumps(dict(payment_method_type='PAYPAL')),
+                              content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.patch(patch_url, data=json.dumps(dict(payment_method_type='PAYPAL')),
+                              content_type='application/json', headers={'If-Match': '"other"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(Payment.find(payment_id).payment_method_type, PaymentMethodType.DEBIT)
+
+    def test_patch_payment_bad_request(self):
+        """ Validate the patched fields like a full Payment """
+        payment_id = Payment.find_by_order_id('15189')[0].id
+        for data in (dict(payment_status='LOST'), dict(customer_id='1'), dict(id=7), {}, []):
+            resp = self.app.patch('/payments/{}'.format(payment_id), data=json.dumps(data),
+                                  content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch('/payments/0', data=json.dumps(dict(order_id=1)),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+    def test_transition_payment_status(self):
+        """ Move Payments by id and by filter to a new status """
+        ids = [payment.id for payment in Payment.find_by_customer_id(14121)]
+        resp = self.app.put('/payments/status',
+                            data=json.dumps(dict(from_status='PROCESSING', to_status='PAID', ids=ids)),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['updated'], 1)
+        self.assertEqual(len(data['skipped']), 1)
+        resp = self.app.put('/payments/status',
+                            data=json.dumps(dict(from_status='PAID', to_status='UNPAID', customer_id=12302)),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['updated'], 2)
+        self.assertEqual(len(Payment.find_by_payment_status('UNPAID')), 2)
+
+
+    def test_transition_payment_status_bad_request(self):
+        """ Move Payments with a bad transition """
+        for body in (dict(from_status='PAID', to_status='DONE'), dict(to_status='PAID'),
+                     dict(from_status='PAID', to_status='UNPAID', ids='1,2'),
+                     dict(from_status='PAID', to_status='UNPAID', payment_method_type='CASH'),
+                     dict(from_status='PAID', to_status='UNPAID', ids=5),
+                     dict(from_status='PAID', to_status='UNPAID', ids=[True]),
+                     dict(from_status='PAID', to_status='UNPAID', customer_id=[1, 2]),
+                     dict(from_status='PAID', to_status='UNPAID', order_id='1'),
+                     dict(from_status='PAID', to_status='UNPAID', customer_id=12302, status='PAID'),
+                     dict(from_status='PAID', to_status='UNPAID')):
+            resp = self.app.put('/payments/status', data=json.dumps(body),
+                                content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(Payment.find_by_payment_status('UNPAID')), 0)
+
+
     def test_update_payment_not_found(self):
         """ Update an existing Payment Resource not in DB"""
         payment = Payment.find_by_order_id('15189')[0];
@@ -261,10 +711,78 @@ class TestPaymentServer(unittest.TestCase):
         new_count = self.get_all_payments_count()
         self.assertEqual(new_count, payments_count - 1)
 
+    def test_delete_payment_single_statement(self):
+        """ Delete a Payment with one DELETE and honour If-Match """
+        payment_id = Payment.find_by_order_id(15189)[0].id
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.split()[0])
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            resp = self.app.delete('/payments/{}'.format(payment_id), headers={'If-Match': '"{}-7"'.format(payment_id)})
+            self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+            del statements[:]
+            resp = self.app.delete('/payments/{}'.format(payment_id))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(statements, ['DELETE'])
+        self.assertIsNone(Payment.find(payment_id))
+        resp = self.app.delete('/payments/{}'.format(payment_id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_delete_payments_by_filter(self):
+        """ Delete the Payments matching filters in chunks """
+        service.app.config['BATCH_CHUNK_SIZE'] = 1
+        try:
+            resp = self.app.delete('/payments', query_string='customer_id=12302,99&payment_status=PAID')
+        finally:
+            service.app.config['BATCH_CHUNK_SIZE'] = 500
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {'deleted': 2})
+        self.assertEqual(self.get_all_payments_count(), 2)
+        resp = self.app.delete('/payments', query_string='payment_status=PROCESSING')
+        self.assertEqual(json.loads(resp.data), {'deleted': 1})
+        resp = self.app.delete('/payments')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_all_payments_count(), 1)
+
     def test_payments_reset(self):
         resp = self.app.delete("/payments/reset")
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
 
+    def test_query_budgets(self):
+        """ Answer every endpoint within its budget of statements """
+        payment_id = Payment.find_by_order_id(15189)[0].id
+        new_payment = json.dumps(dict(customer_id=53121, order_id=15190, payment_method_type='DEBIT',
+                                      payment_status='PAID', default_payment_type=False))
+        self.assert_query_budget(1, 'get', '/payments/{}'.format(payment_id))
+        self.assert_query_budget(1, 'get', '/payments', query_string='customer_id=12302')
+        self.assert_query_budget(1, 'get', '/payments/stats')
+        self.assert_query_budget(2, 'post', '/payments', data=new_payment,
+                                 content_type='application/json')
+        self.assert_query_budget(3, 'put', '/payments/{}'.format(payment_id), data=new_payment,
+                                 content_type='application/json')
+        # SQLite has no RETURNING, so the row is read first
+        self.assert_query_budget(2, 'patch', '/payments/{}'.format(payment_id),
+                                 data=json.dumps(dict(payment_status='PAID')),
+                                 content_type='application/json')
+        # the rows of the customer are locked before they are updated
+        self.assert_query_budget(5, 'put', '/payments/{}/default'.format(payment_id))
+        self.assert_query_budget(1, 'delete', '/payments/{}'.format(payment_id))
+
+    def test_query_headers(self):
+        """ Report the statements of a request in debug mode only """
+        resp = self.app.get('/payments')
+        self.assertNotIn('X-Query-Count', resp.headers)
+        service.app.debug = True
+        try:
+            resp = self.app.get('/payments')
+        finally:
+            service.app.debug = False
+        self.assertEqual(resp.headers['X-Query-Count'], '1')
+        self.assertGreaterEqual(float(resp.headers['X-Query-Time']), 0)
+
     def test_health(self):
         """ Test the server health checker """
         resp = self.app.get('/health')
@@ -274,9 +792,76 @@ class TestPaymentServer(unittest.TestCase):
         self.assertEqual(data['status'], 'OK')
         self.assertEqual(data['url'].split('/')[3], 'health')
 
+    def test_read_from_replica(self):
+        """ Read from the replica, and from the primary right after a write """
+        service.app.config['SQLALCHEMY_BINDS'] = {'replica0': service.app.config['SQLALCHEMY_DATABASE_URI']}
+        service.app.config['READ_REPLICAS'] = ['replica0']
+        db.session.remove()
+        replica = db.get_engine(service.app, bind='replica0')
+        queries = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+        event.listen(replica, 'before_cursor_execute', count)
+        try:
+            resp = self.app.get('/payments/1')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertTrue(queries)
+            del queries[:]
+            new_payment = dict(customer_id=53121, order_id=15190, payment_method_type="DEBIT", payment_status="PAID", default_payment_type=False)
+            resp = self.app.post('/payments', data=json.dumps(new_payment), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            self.assertIn('X-Primary-Until', resp.headers)
+            # the cookie keeps this client on the primary
+            resp = self.app.get('/payments/{}'.format(json.loads(resp.data)['id']))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(queries, [])
+            # other clients read from the replica again
+            resp = service.app.test_client().get('/payments/1')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertTrue(queries)
+        finally:
+            event.remove(replica, 'before_cursor_execute', count)
+            service.app.config['SQLALCHEMY_BINDS'] = {}
+            service.app.config['READ_REPLICAS'] = []
+            db.session.remove()
+
+    def test_replica_reads_are_not_cached(self):
+        """ Do not cache the Payments read from a replica that may be behind """
+        service.app.config['SQLALCHEMY_BINDS'] = {'replica0': service.app.config['SQLALCHEMY_DATABASE_URI']}
+        service.app.config['READ_REPLICAS'] = ['replica0']
+        Payment.init_cache(maxsize=100, ttl=60)
+        db.session.remove()
+        try:
+            resp = self.app.get('/payments/1')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp = self.app.get('/payments?customer_id=12310')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(Payment.cache), 0)
+        finally:
+            Payment.cache = None
+            service.app.config['SQLALCHEMY_BINDS'] = {}
+            service.app.config['READ_REPLICAS'] = []
+            db.session.remove()
+
+    def test_connection_pool(self):
+        """ Report the live state of the connection pool """
+        resp = self.app.get('/internal/pool')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertIn('pool', data)
+
 ######################################################################
 # Utility functions
 ######################################################################
+    def assert_query_budget(self, budget, method, url, **kwargs):
+        """ Makes a request and fails if it runs more than budget statements """
+        with service.query_stats.record() as log:
+            resp = getattr(self.app, method)(url, **kwargs)
+        self.assertLess(resp.status_code, 400)
+        self.assertLessEqual(log.count, budget, '{} {} ran {} statements: {}'.format(
+            method.upper(), url, log.count, list(log.statements.elements())))
+        return resp
+
     def get_all_payments_count(self):
         """ get the current number of total payments from data store """
         resp = self.app.get('/payments')
@@ -288,14 +873,29 @@ class TestPaymentServer(unittest.TestCase):
 # Patch Mock Tests
 ######################################################################
 
-    @patch('app.service.Payment.find_by_customer_id')
+    def test_get_payment_stats(self):
+        """ Count the Payments per status and method type """
+        resp = self.app.get('/payments/stats?customer_id=12302,99')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['total'], 4)
+        self.assertEqual(data['payment_status'], {'PAID': 3, 'PROCESSING': 1})
+        self.assertEqual(data['payment_method_type'], {'CREDIT': 2, 'DEBIT': 1, 'PAYPAL': 1})
+        self.assertEqual(data['customers'], [
+            {'customer_id': 12302, 'total': 2, 'payment_status': {'PAID': 2},
+             'payment_method_type': {'CREDIT': 1, 'DEBIT': 1}},
+            {'customer_id': 99, 'total': 0, 'payment_status': {}, 'payment_method_type': {}}])
+        resp = self.app.get('/payments/stats?customer_id=x')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('app.service.Payment.search')
     def test_bad_request(self, bad_request_mock):
         """ Test a Bad Request error from Find By Customer Id """
         bad_request_mock.side_effect = DataValidationError()
         resp = self.app.get('/payments', query_string='customer_id=111x50')
-        #self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
-    @patch('app.service.Payment.find_by_order_id')
+    @patch('app.service.Payment.search')
     def test_mock_search_data(self, payment_find_mock):
         """ Test showing how to mock data """
         payment_find_mock.return_value = [MagicMock(serialize=lambda: {'order_id': '01'})]
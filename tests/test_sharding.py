@@ -0,0 +1,297 @@
+"""
+Test cases for spreading the Payments over several databases by customer_id
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from app.models import Payment, PaymentCounter, PaymentMethodType, PaymentShard, PaymentStatus, db
+from app.sharding import current_shard, fan_out, jump_hash, on_shard
+from app.custom_exceptions import DataValidationError
+from app import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+SHARDS = ['shard0', 'shard1', 'shard2']
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestJumpHash(unittest.TestCase):
+    """ Test Cases for the consistent hash """
+
+    def test_spread(self):
+        """ Spread the keys evenly over the buckets """
+        counts = [0] * 4
+        for key in range(4000):
+            counts[jump_hash(key, 4)] += 1
+        for count in counts:
+            self.assertGreater(count, 800)
+
+    def test_minimal_moves(self):
+        """ Only move keys to the new bucket when one is added """
+        for key in range(1000):
+            bucket = jump_hash(key, 5)
+            self.assertIn(bucket, (jump_hash(key, 4), 4))
+
+
+class TestSharding(unittest.TestCase):
+    """ Test Cases for the sharded Payments """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        cls.directory = tempfile.mkdtemp()
+        cls.binds = app.config['SQLALCHEMY_BINDS']
+        app.config['SQLALCHEMY_BINDS'] = dict(
+            (shard, 'sqlite:///' + os.path.join(cls.directory, shard + '.db')) for shard in SHARDS)
+
+    @classmethod
+    def tearDownClass(cls):
+        app.config['SQLALCHEMY_BINDS'] = cls.binds
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        Payment.init_shards(SHARDS)
+        Payment.remove_all()
+
+    def tearDown(self):
+        db.session.remove()
+        Payment.shards = []
+        db.drop_all()
+
+    def make_payments(self, customers, orders=1):
+        """ Saves orders Payments for each of the customers """
+        payments = []
+        for customer_id in customers:
+            for order_id in range(orders):
+                payment = Payment(customer_id=customer_id, order_id=order_id,
+                                  payment_method_type=PaymentMethodType.CREDIT,
+                                  payment_status=PaymentStatus.PROCESSING,
+                                  default_payment_type=False)
+                payment.save()
+                payments.append(payment)
+        return payments
+
+    def count_on(self, shard):
+        """ Returns the number of Payments stored on a shard """
+        with on_shard(shard):
+            count = Payment.query.count()
+        db.session.remove()
+        return count
+
+    def test_save_on_customer_shard(self):
+        """ Store every Payment on the shard of its customer """
+        payments = self.make_payments(range(1, 31))
+        self.assertEqual(sorted(payment.id for payment in payments), list(range(1, 31)))
+        for shard in SHARDS:
+            self.assertGreater(self.count_on(shard), 0)
+        payment = Payment.find(payments[7].id)
+        self.assertEqual(payment.customer_id, 8)
+        payment.payment_status = PaymentStatus.PAID
+        payment.save()
+        db.session.remove()
+        self.assertEqual(Payment.find(payments[7].id).payment_status, PaymentStatus.PAID)
+        Payment.find(payments[7].id).delete()
+        self.assertIsNone(Payment.find(payments[7].id))
+        self.assertEqual(sum(self.count_on(shard) for shard in SHARDS), 29)
+
+    def test_find_on_one_shard(self):
+        """ Look a Payment up on the shard its id was handed out for """
+        payment_id = self.make_payments(range(1, 7))[3].id
+        db.session.remove()
+        asked = []
+        def record(shard):
+            return lambda *args: asked.append(shard)
+        listeners = [(db.get_engine(bind=shard), record(shard)) for shard in SHARDS]
+        for engine, listener in listeners:
+            event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(Payment.find(payment_id).customer_id, 4)
+            self.assertEqual(asked, [Payment.shard_of(4)])
+            db.session.remove()
+            # ids handed out before the directory was kept are looked for everywhere
+            PaymentShard.query.filter_by(payment_id=payment_id).delete()
+            db.session.commit()
+            del asked[:]
+            self.assertEqual(Payment.find(payment_id).customer_id, 4)
+            self.assertEqual(sorted(asked), sorted(SHARDS + [Payment.shard_of(4)]))
+        finally:
+            for engine, listener in listeners:
+                event.remove(engine, 'before_cursor_execute', listener)
+
+    def test_customer_cannot_change_shard(self):
+        """ Reject an update that would move a Payment to another shard """
+        payment = self.make_payments([1])[0]
+        other = next(customer_id for customer_id in range(2, 100)
+                     if Payment.shard_of(customer_id) != Payment.shard_of(1))
+        payment.customer_id = other
+        self.assertRaises(DataValidationError, payment.save)
+
+    def test_search_across_shards(self):
+        """ Merge the pages of every shard in sort order """
+        self.make_payments(range(1, 11), orders=3)
+        payments = Payment.search(limit=7, sort='-customer_id')
+        self.assertEqual([payment.cursor('-customer_id') for payment in payments],
+                         [(10, 30), (10, 29), (10, 28), (9, 27), (9, 26), (9, 25), (8, 24)])
+        payments = Payment.search(limit=5, after=12)
+        self.assertEqual([payment.id for payment in payments], [13, 14, 15, 16, 17])
+        self.assertEqual([payment.id for payment in Payment.search(stream=True)],
+                         list(range(1, 31)))
+        self.assertEqual(Payment.estimated_count(), 30)
+
+    def test_single_customer_query(self):
+        """ Only ask the shard of the customer """
+        self.make_payments(range(1, 11), orders=2)
+        shard = Payment.shard_of(4)
+        seen = []
+        original = Payment.filtered
+        def filtered(**filters):
+            seen.append(current_shard())
+            return original(**filters)
+        Payment.filtered = staticmethod(filtered)
+        try:
+            payments = Payment.find_by_customer_id(4)
+        finally:
+            Payment.filtered = staticmethod(original)
+        self.assertEqual(seen, [shard])
+        self.assertEqual([payment.id for payment in payments], [7, 8])
+
+    def test_bulk_writes(self):
+        """ Insert and transition many Payments on every shard """
+        payments = [Payment(customer_id=customer_id, order_id=1,
+                            payment_method_type=PaymentMethodType.DEBIT,
+                            payment_status=PaymentStatus.PROCESSING, default_payment_type=False)
+                    for customer_id in range(1, 21)]
+        ids = Payment.create_many(payments)
+        self.assertEqual(ids, list(range(1, 21)))
+        self.assertEqual(Payment.find(5).customer_id, 5)
+        updated, skipped = Payment.transition_status(PaymentStatus.PROCESSING, PaymentStatus.PAID,
+                                                     ids=[1, 2, 3, 99])
+        self.assertEqual((updated, skipped), (3, [99]))
+        updated, _ = Payment.transition_status(PaymentStatus.PROCESSING, PaymentStatus.PAID)
+        self.assertEqual(updated, 17)
+        self.assertEqual(set(Payment.statistics()),
+                         {(None, PaymentStatus.PAID, PaymentMethodType.DEBIT, 20)})
+        self.assertEqual(Payment.delete_many(customer_id=[1, 2, 3]), 3)
+        self.assertEqual(Payment.delete_many(payment_status=PaymentStatus.PAID, chunk_size=4), 17)
+        self.assertEqual(Payment.delete_by_id(4), 0)
+        self.assertEqual(PaymentShard.query.count(), 0)
+
+    def test_directory_follows_writes(self):
+        """ Remove the directory entries of deleted Payments and of failed inserts """
+        payments = self.make_payments(range(1, 5))
+        payments[0].delete()
+        self.assertEqual(Payment.delete_by_id(payments[1].id), 1)
+        self.assertEqual(sorted(row.payment_id for row in PaymentShard.query),
+                         [payments[2].id, payments[3].id])
+        db.session.remove()
+        # the next id is already taken on the shard of customer 1
+        with on_shard(Payment.shard_of(1)):
+            db.session.execute(Payment.__table__.insert(), dict(
+                id=5, customer_id=1, order_id=1, payment_method_type=PaymentMethodType.CREDIT,
+                payment_status=PaymentStatus.PAID, default_payment_type=False))
+            db.session.commit()
+        payment = Payment(customer_id=1, order_id=2, payment_method_type=PaymentMethodType.CREDIT,
+                          payment_status=PaymentStatus.PAID, default_payment_type=False)
+        self.assertRaises(IntegrityError, payment.save)
+        self.assertIsNone(PaymentShard.query.get(5))
+        db.session.remove()
+        payments = [Payment(customer_id=customer_id, order_id=3,
+                            payment_method_type=PaymentMethodType.DEBIT,
+                            payment_status=PaymentStatus.PAID, default_payment_type=False)
+                    for customer_id in (1, 1)]
+        # ids 6 and 7 are handed out, 7 is taken now
+        with on_shard(Payment.shard_of(1)):
+            db.session.execute(Payment.__table__.update().where(Payment.__table__.c.id == 5)
+                               .values(id=7))
+            db.session.commit()
+        self.assertRaises(IntegrityError, Payment.create_many, payments)
+        self.assertEqual(PaymentShard.query.filter(PaymentShard.payment_id >= 5).count(), 0)
+
+    def test_set_default(self):
+        """ Set the default Payment of a customer on its shard """
+        payments = self.make_payments([5], orders=2)
+        payment = Payment.set_default_for_customer(payments[1].id)
+        self.assertTrue(payment.default_payment_type)
+        self.assertIsNone(Payment.set_default_for_customer(99))
+
+    def test_move_customer(self):
+        """ Move a customer to another shard and keep finding it """
+        Payment.init_counters()
+        try:
+            ids = [payment.id for payment in self.make_payments([1, 2], orders=3)]
+            source = Payment.shard_of(1)
+            target = next(shard for shard in SHARDS if shard != source)
+            self.assertEqual(Payment.move_customer(1, target), 3)
+            self.assertEqual(Payment.shard_of(1), target)
+            self.assertEqual([payment.id for payment in Payment.find_by_customer_id(1)],
+                             ids[:3])
+            payment = Payment.find(ids[0])
+            payment.payment_status = PaymentStatus.PAID
+            payment.save()
+            self.assertEqual(self.count_on(source), 3 if Payment.shard_of(2) == source else 0)
+            with on_shard(target):
+                counted = set(PaymentCounter.query.filter(PaymentCounter.count > 0)
+                              .with_entities(PaymentCounter.payment_status, PaymentCounter.count))
+            db.session.remove()
+            self.assertIn((PaymentStatus.PAID, 1), counted)
+            # moving it back home drops the directory entry
+            self.assertEqual(Payment.move_customer(1, source), 3)
+            self.assertEqual(Payment.shard_of(1), source)
+        finally:
+            Payment.counters = False
+
+    def test_rebalance(self):
+        """ Move customers until the shards hold about as many Payments """
+        busy = [customer_id for customer_id in range(1, 100)
+                if Payment.shard_of(customer_id) == 'shard0'][:6]
+        self.make_payments(busy, orders=2)
+        moves = Payment.rebalance(dry_run=True)
+        self.assertTrue(moves)
+        self.assertEqual(self.count_on('shard0'), 12)
+        Payment.rebalance()
+        self.assertEqual([self.count_on(shard) for shard in SHARDS], [4, 4, 4])
+        self.assertEqual(len(Payment.all()), 12)
+
+    def test_pin_customers(self):
+        """ Keep the customers in place when a shard is added """
+        self.make_payments(range(1, 41))
+        before = dict((customer_id, Payment.shard_of(customer_id)) for customer_id in range(1, 41))
+        pinned = Payment.pin_customers(SHARDS + ['shard3'])
+        self.assertTrue(0 < pinned < 20)
+        Payment.shards = SHARDS + ['shard3']
+        self.assertEqual(dict((customer_id, Payment.shard_of(customer_id))
+                              for customer_id in range(1, 41)), before)
+
+    def test_fan_out_order(self):
+        """ Return the results in shard order """
+        self.assertEqual(fan_out(current_shard, SHARDS, db.session), SHARDS)
+
+    def test_service_across_shards(self):
+        """ Serve the Payments of every shard over HTTP """
+        client = app.test_client()
+        for customer_id in range(1, 7):
+            resp = client.post('/payments', content_type='application/json',
+                               data=json.dumps(dict(customer_id=customer_id, order_id=1,
+                                                    payment_method_type='CREDIT',
+                                                    payment_status='PAID',
+                                                    default_payment_type=False)))
+            self.assertEqual(resp.status_code, 201)
+        resp = client.get('/payments?limit=4')
+        self.assertEqual([payment['id'] for payment in json.loads(resp.data)], [1, 2, 3, 4])
+        resp = client.get('/payments/5')
+        self.assertEqual(json.loads(resp.data)['customer_id'], 5)
+        self.assertEqual(client.delete('/payments/5').status_code, 204)
+        self.assertEqual(client.get('/payments/5').status_code, 404)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()